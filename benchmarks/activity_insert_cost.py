@@ -0,0 +1,104 @@
+"""
+Insert cost of the activity index plan before and after the 27374439c64c migration
+
+    poetry run python -m benchmarks.activity_insert_cost --rows 200000
+
+Creates one unpartitioned table per index plan in a scratch schema, inserts the same generated activities
+into both, a batch into each in turn so they see the same conditions, the way the activity consumer does,
+and reports the throughput and the size of the indexes. Needs a migrated database, as the tables are
+modelled on activity, and drops its scratch schema afterwards.
+"""
+import statistics
+import time
+
+from itertools import islice
+
+import psycopg
+import typer
+
+from psycopg import sql
+
+from benchmarks.seed import generate_activities
+from hubble.config import settings
+from hubble.messaging.writers import ACTIVITY_COLUMNS
+
+SCHEMA = "hubble_benchmark"
+
+# one B-tree per column, as created by 7d573978e8cc
+INDEXES_BEFORE = [
+    f"({column})"
+    for column in (
+        "activity_identifier",
+        "associated_value",
+        "campaigns",
+        "created_at",
+        "datetime",
+        "reasons",
+        "retailer",
+        "summary",
+        "type",
+        "underlying_datetime",
+        "user_id",
+    )
+]
+# as created by 27374439c64c
+INDEXES_AFTER = [
+    "(activity_identifier)",
+    "(retailer, user_id, datetime)",
+    "(retailer, lower(associated_value))",
+    "(retailer, type, datetime)",
+    "USING gin (campaigns)",
+    "USING gin (reasons)",
+    "USING brin (datetime)",
+    "USING brin (created_at)",
+]
+PLANS = {"before": INDEXES_BEFORE, "after": INDEXES_AFTER}
+
+
+def create_table(conn: psycopg.Connection, name: str, indexes: list[str]) -> sql.Composed:
+    table = sql.Identifier(SCHEMA, name)
+    conn.execute(sql.SQL("CREATE TABLE {} (LIKE public.activity INCLUDING DEFAULTS)").format(table))
+    conn.execute(sql.SQL("ALTER TABLE {} ADD PRIMARY KEY (id, datetime)").format(table))
+    for definition in indexes:
+        conn.execute(sql.SQL("CREATE INDEX ON {} {}").format(table, sql.SQL(definition)))
+
+    return sql.SQL("INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (id, datetime) DO NOTHING").format(
+        table,
+        sql.SQL(", ").join(map(sql.Identifier, ACTIVITY_COLUMNS)),
+        sql.SQL(", ").join(map(sql.Placeholder, ACTIVITY_COLUMNS)),
+    )
+
+
+def main(
+    rows: int = typer.Option(200_000, help="activities to insert into each table"),  # noqa: B008
+    batch_rows: int = typer.Option(500, help="activities inserted per transaction"),  # noqa: B008
+) -> None:
+    with psycopg.connect(settings.PSYCOPG_URI, autocommit=True) as conn:
+        conn.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(SCHEMA)))
+        conn.execute(sql.SQL("CREATE SCHEMA {}").format(sql.Identifier(SCHEMA)))
+        try:
+            inserts = {plan: create_table(conn, plan, indexes) for plan, indexes in PLANS.items()}
+            timings: dict[str, list[float]] = {plan: [] for plan in PLANS}
+            activities = generate_activities(rows)
+            while batch := list(islice(activities, batch_rows)):
+                for plan, insert_sql in inserts.items():
+                    started = time.perf_counter()
+                    with conn.transaction(), conn.cursor() as cur:
+                        cur.executemany(insert_sql, batch)
+                    timings[plan].append(time.perf_counter() - started)
+
+            typer.echo(f"{'plan':<8}{'indexes':>8}{'rows/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'index MB':>10}")
+            for plan, batch_timings in timings.items():
+                index_bytes = conn.execute("SELECT pg_indexes_size(%s::regclass)", (f"{SCHEMA}.{plan}",)).fetchone()
+                typer.echo(
+                    f"{plan:<8}{len(PLANS[plan]) + 1:>8}{rows / sum(batch_timings):>10.0f}"
+                    f"{statistics.median(batch_timings) * 1000:>9.1f}"
+                    f"{statistics.quantiles(batch_timings, n=20)[-1] * 1000:>9.1f}"
+                    f"{(index_bytes[0] if index_bytes else 0) / 1024**2:>10.1f}"
+                )
+        finally:
+            conn.execute(sql.SQL("DROP SCHEMA {} CASCADE").format(sql.Identifier(SCHEMA)))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,57 @@
+"""
+Page latency of hubble.query keyset pagination against OFFSET pagination, by page depth
+
+    poetry run python -m benchmarks.activity_query_pagination --rows 3000000
+
+Seeds the activity table with generated activities up to --rows, the largest retailer getting over a quarter
+of them, then pages through that retailer's activities both ways and reports how long fetching a page takes
+at increasing depths. Only run it against a database set aside for benchmarking.
+"""
+import time
+
+import psycopg
+import typer
+
+from benchmarks.seed import account_holder, retailer_slug, seed_activity_table
+from hubble.config import settings
+from hubble.db.session import engine
+from hubble.query import ActivityFilter, build_activities_query, query_activities
+
+DEPTHS = (1, 10, 100, 1000, 5000)
+
+
+def main(
+    rows: int = typer.Option(3_000_000, help="activities to seed the activity table with"),  # noqa: B008
+    page_size: int = typer.Option(100, help="activities per page"),  # noqa: B008
+) -> None:
+    with psycopg.connect(settings.PSYCOPG_URI) as conn:
+        typer.echo(f"Seeded {seed_activity_table(conn, rows)} activities")
+
+    retailer = retailer_slug(0)
+    scenarios = {
+        "retailer": ActivityFilter(retailer=retailer),
+        "type": ActivityFilter(retailer=retailer, types=["TX_HISTORY"]),
+        "campaign": ActivityFilter(retailer=retailer, campaigns=["CAMPAIGN_1"]),
+        "account holder": ActivityFilter(retailer=retailer, user_id=account_holder(0, 0)[0]),
+    }
+    typer.echo(f"{'scenario':<16}{'page':>6}{'keyset ms':>11}{'offset ms':>11}")
+    with engine.connect() as conn:
+        for scenario, filters in scenarios.items():
+            cursor = None
+            for page in range(1, DEPTHS[-1] + 1):
+                started = time.perf_counter()
+                result = query_activities(conn, filters, page_size=page_size, cursor=cursor)
+                keyset_time = time.perf_counter() - started
+                if page in DEPTHS:
+                    offset_query = build_activities_query(filters, page_size=page_size).offset((page - 1) * page_size)
+                    started = time.perf_counter()
+                    conn.execute(offset_query).all()
+                    offset_time = time.perf_counter() - started
+                    typer.echo(f"{scenario:<16}{page:>6}{keyset_time * 1000:>11.1f}{offset_time * 1000:>11.1f}")
+
+                if (cursor := result.next_cursor) is None:
+                    break
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,89 @@
+"""
+Cost of finding an account holder's activities for right to be forgotten, ILIKE OR uuid against the UNION lookup
+
+    poetry run python -m benchmarks.rtbf_lookup --rows 3000000
+
+Seeds the activity table with generated activities up to --rows, then runs EXPLAIN ANALYZE on both ways of
+selecting the activities anonymise_activities updates, for account holders of the largest retailer, and
+reports their latency and whether their plans scan any partition sequentially. Only run it against a
+database set aside for benchmarking.
+"""
+import statistics
+
+from typing import TYPE_CHECKING
+
+import psycopg
+import typer
+
+from psycopg import sql
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import psycopg as psycopg_dialect
+
+from benchmarks.seed import account_holder, retailer_slug, seed_activity_table
+from hubble.config import settings
+from hubble.db.models import Activity
+from hubble.query import select_account_holder_activities
+
+if TYPE_CHECKING:
+    from sqlalchemy import CompoundSelect, Select
+
+ACTIVITY_TYPES = ("ACCOUNT_REQUEST", "EMAIL_EVENT")
+
+activity_table = Activity.__table__
+
+
+def select_before(retailer: str, user_id: str, email: str) -> "Select":
+    # as anonymise_activities used to select them
+    columns = activity_table.c
+    return select(columns.id, columns.datetime).where(
+        columns.retailer == retailer,
+        columns.type.in_(ACTIVITY_TYPES),
+        columns.associated_value.ilike(email) | (columns.user_id == user_id),
+    )
+
+
+def explain(conn: psycopg.Connection, query: "Select | CompoundSelect") -> tuple[float, int]:
+    """Returns the execution time in milliseconds and the number of sequential scans of a query"""
+    compiled = query.compile(dialect=psycopg_dialect.dialect(), compile_kwargs={"render_postcompile": True})
+    row = conn.execute(
+        sql.SQL("EXPLAIN (ANALYZE, FORMAT JSON) {}").format(sql.SQL(str(compiled))), compiled.params
+    ).fetchone()
+    plan = row[0] if row else []
+    nodes = [plan[0]["Plan"]]
+    seq_scans = 0
+    while nodes:
+        node = nodes.pop()
+        seq_scans += node["Node Type"] == "Seq Scan"
+        nodes.extend(node.get("Plans", []))
+
+    return plan[0]["Execution Time"], seq_scans
+
+
+def main(
+    rows: int = typer.Option(3_000_000, help="activities to seed the activity table with"),  # noqa: B008
+    holders: int = typer.Option(20, help="account holders to look up"),  # noqa: B008
+) -> None:
+    with psycopg.connect(settings.PSYCOPG_URI) as conn:
+        typer.echo(f"Seeded {seed_activity_table(conn, rows)} activities")
+
+        retailer = retailer_slug(0)
+        results: dict[str, list[tuple[float, int]]] = {"ilike or": [], "union": []}
+        for n in range(holders):
+            user_id, email = account_holder(0, n)
+            results["ilike or"].append(explain(conn, select_before(retailer, user_id, email)))
+            results["union"].append(
+                explain(
+                    conn,
+                    select_account_holder_activities(retailer, user_id=user_id, email=email, types=ACTIVITY_TYPES),
+                )
+            )
+
+    typer.echo(f"{'lookup':<10}{'median ms':>11}{'max ms':>11}{'seq scans':>11}")
+    for lookup, timings in results.items():
+        times = [time for time, _ in timings]
+        seq_scans = sum(scans for _, scans in timings)
+        typer.echo(f"{lookup:<10}{statistics.median(times):>11.2f}{max(times):>11.2f}{seq_scans:>11}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
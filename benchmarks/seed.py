@@ -0,0 +1,90 @@
+import random
+import uuid
+
+from collections.abc import Generator
+from datetime import UTC, datetime, timedelta
+from itertools import islice
+
+import psycopg
+
+from psycopg.types.json import Jsonb
+
+from hubble.messaging.writers import CopyActivityWriter
+
+ACTIVITY_TYPES = ("TX_HISTORY", "BALANCE_CHANGE", "ACCOUNT_REQUEST", "EMAIL_EVENT", "CAMPAIGN", "REWARD_STATUS")
+REASONS = ("Purchase", "Refund", "Reward issued", "Campaign ended", "Account created")
+# share of activities that are part of a campaign
+CAMPAIGN_SHARE = 0.7
+
+
+def retailer_slug(n: int) -> str:
+    return f"retailer-{n:03d}"
+
+
+def account_holder(retailer: int, n: int) -> tuple[str, str]:
+    """Returns the uuid and email of the nth account holder of a retailer, the same on every run"""
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f"{retailer}:{n}")), f"Holder.{n}+{retailer}@Example.com"
+
+
+def generate_activities(
+    rows: int,
+    *,
+    retailers: int = 20,
+    holders_per_retailer: int = 10_000,
+    start: datetime | None = None,
+    span_days: int = 90,
+    seed: int = 0,
+) -> Generator[dict, None, None]:
+    """
+    Yields insert-ready activity rows with datetimes increasing from start, as they would be ingested
+
+    Retailer sizes are skewed, the first retailers getting most of the activities, and account holders are
+    drawn from a fixed population per retailer so lookups by uuid or email find several rows.
+    """
+    rand = random.Random(seed)
+    span = timedelta(days=span_days)
+    start = start or datetime.now(tz=UTC) - span
+    step = span / max(rows, 1)
+    retailer_weights = [1 / (n + 1) for n in range(retailers)]
+    for i in range(rows):
+        retailer = rand.choices(range(retailers), retailer_weights)[0]
+        user_id, email = account_holder(retailer, rand.randrange(holders_per_retailer))
+        activity_type = rand.choice(ACTIVITY_TYPES)
+        happened_at = start + step * i
+        yield {
+            "id": uuid.uuid4(),
+            "type": activity_type,
+            "datetime": happened_at,
+            "underlying_datetime": happened_at - timedelta(minutes=rand.randrange(60 * 24)),
+            "summary": f"{activity_type.replace('_', ' ').title()} for {email}",
+            "reasons": rand.sample(REASONS, rand.randrange(1, 3)),
+            "activity_identifier": str(uuid.UUID(int=rand.getrandbits(128))),
+            "user_id": user_id,
+            "associated_value": email if activity_type == "ACCOUNT_REQUEST" else str(rand.randrange(10_000)),
+            "retailer": retailer_slug(retailer),
+            "campaigns": [f"CAMPAIGN_{rand.randrange(10)}"] if rand.random() < CAMPAIGN_SHARE else [],
+            "data": Jsonb({"fields": [{"field_name": "email", "value": email}], "amount": rand.randrange(10_000)}),
+        }
+
+
+def seed_activity_table(conn: psycopg.Connection, rows: int, *, span_days: int = 90, batch_rows: int = 50_000) -> int:
+    """
+    Tops the activity table up to rows generated activities, returns how many were added
+
+    Generated activities are told apart by their retailer slugs, so this should still only be run against a
+    database set aside for benchmarking.
+    """
+    count = conn.execute("SELECT count(*) FROM activity WHERE retailer LIKE 'retailer-%'").fetchone()
+    existing = count[0] if count else 0
+    writer = CopyActivityWriter()
+    writer.prepare(conn)
+    activities = generate_activities(max(rows - existing, 0), span_days=span_days, seed=existing)
+    added = 0
+    while batch := list(islice(activities, batch_rows)):
+        with conn.transaction(), conn.cursor() as cur:
+            added += len(writer.write(cur, batch))
+
+    if added:
+        conn.execute("ANALYZE activity")
+
+    return added
@@ -0,0 +1,111 @@
+"""workload driven activity indexes
+
+Replaces the B-tree on nearly every activity column with indexes for the actual access paths:
+
+- (retailer, user_id, datetime): an account holder's activities, newest first or over a time range
+- (retailer, lower(associated_value)): right to be forgotten lookups by case insensitive email
+- (retailer, type, datetime): a retailer's activities of a type over a time range
+- GIN on campaigns and reasons: array containment (@>), which a B-tree cannot serve
+- BRIN on datetime and created_at: both grow with insertion order, so a few pages of block ranges are
+  enough for time range scans across retailers
+- activity_identifier keeps its B-tree for lookups of the object an activity is about
+
+summary, underlying_datetime and the single column retailer, type, user_id and associated_value
+B-trees are dropped, the latter being covered by the composite indexes.
+
+Revision ID: 27374439c64c
+Revises: c42190b79347
+Create Date: 2026-10-18 11:02:17.504913
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "27374439c64c"
+down_revision = "c42190b79347"
+branch_labels = None
+depends_on = None
+
+
+NEW_INDEXES = {
+    "ix_activity_retailer_user_id_datetime": "(retailer, user_id, datetime)",
+    "ix_activity_retailer_lower_associated_value": "(retailer, lower(associated_value))",
+    "ix_activity_retailer_type_datetime": "(retailer, type, datetime)",
+    "ix_activity_campaigns_gin": "USING gin (campaigns)",
+    "ix_activity_reasons_gin": "USING gin (reasons)",
+    "ix_activity_datetime_brin": "USING brin (datetime)",
+    "ix_activity_created_at_brin": "USING brin (created_at)",
+}
+DROPPED_INDEXES = {
+    f"ix_activity_{column}": f"({column})"
+    for column in (
+        "associated_value",
+        "campaigns",
+        "created_at",
+        "datetime",
+        "reasons",
+        "retailer",
+        "summary",
+        "type",
+        "underlying_datetime",
+        "user_id",
+    )
+}
+
+
+def _partitions() -> list[str]:
+    return list(
+        op.get_bind()
+        .execute(sa.text("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'activity'::regclass"))
+        .scalars()
+    )
+
+
+def _is_invalid(index: str) -> bool:
+    return bool(
+        op.get_bind()
+        .execute(
+            sa.text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:index)"), {"index": index}
+        )
+        .scalar()
+    )
+
+
+def create_index_concurrently(name: str, definition: str) -> None:
+    """
+    Builds an index on activity without blocking writes
+
+    CREATE INDEX CONCURRENTLY is not supported on partitioned tables, so the index is created on the parent
+    only, which is instant and leaves it invalid, then built concurrently on each partition and attached to
+    it. The parent index becomes valid once every partition has been attached.
+    """
+    op.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY activity {definition}")
+    for partition in _partitions():
+        partition_index = name.replace("ix_activity_", f"ix_{partition}_", 1)
+        # left behind by a concurrent build that failed, e.g. when the migration was interrupted
+        if _is_invalid(partition_index):
+            op.execute(f"DROP INDEX CONCURRENTLY {partition_index}")
+        op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} ON {partition} {definition}")
+        op.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, definition in NEW_INDEXES.items():
+            create_index_concurrently(name, definition)
+
+        # dropping a partitioned index cannot be done concurrently, it only holds its lock for as long as it
+        # takes to remove the files though
+        for name in DROPPED_INDEXES:
+            op.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, definition in DROPPED_INDEXES.items():
+            create_index_concurrently(name, definition)
+
+        for name in NEW_INDEXES:
+            op.execute(f"DROP INDEX IF EXISTS {name}")
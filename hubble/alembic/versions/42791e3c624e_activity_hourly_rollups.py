@@ -0,0 +1,43 @@
+"""activity hourly rollups
+
+Creates the rollup tables of hubble.rollups. They start out empty, the rebuild-activity-rollups command
+backfills them from the activity table.
+
+Revision ID: 42791e3c624e
+Revises: 8a87b9f673b6
+Create Date: 2026-10-18 14:02:11.503214
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "42791e3c624e"
+down_revision = "8a87b9f673b6"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "activity_hourly_rollup",
+        sa.Column("retailer", sa.String(), nullable=False),
+        sa.Column("hour", sa.DateTime(), nullable=False),
+        sa.Column("type", sa.String(), nullable=False),
+        sa.Column("campaign", sa.String(), nullable=False),
+        sa.Column("activities", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("retailer", "hour", "type", "campaign"),
+    )
+    op.create_table(
+        "activity_hourly_user",
+        sa.Column("retailer", sa.String(), nullable=False),
+        sa.Column("hour", sa.DateTime(), nullable=False),
+        sa.Column("user_id", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("retailer", "hour", "user_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("activity_hourly_user")
+    op.drop_table("activity_hourly_rollup")
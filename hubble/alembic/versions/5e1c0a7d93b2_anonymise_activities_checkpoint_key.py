@@ -0,0 +1,51 @@
+"""anonymise activities checkpoint key
+
+Adds the task key anonymise-activities tasks save their progress under, for a retry to carry on from the
+last committed chunk.
+
+Revision ID: 5e1c0a7d93b2
+Revises: 42791e3c624e
+Create Date: 2026-10-18 16:21:47.118904
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5e1c0a7d93b2"
+down_revision = "42791e3c624e"
+branch_labels = None
+depends_on = None
+
+TASK_TYPE_NAME = "anonymise-activities"
+KEY_NAME = "anonymise_checkpoint"
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    metadata = sa.MetaData()
+    task_type = sa.Table("task_type", metadata, autoload_with=conn)
+    task_type_key = sa.Table("task_type_key", metadata, autoload_with=conn)
+    conn.execute(
+        task_type_key.insert().from_select(
+            ["name", "type", "task_type_id"],
+            sa.select(sa.literal(KEY_NAME), sa.literal_column("'STRING'"), task_type.c.task_type_id).where(
+                task_type.c.name == TASK_TYPE_NAME
+            ),
+        )
+    )
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    metadata = sa.MetaData()
+    task_type = sa.Table("task_type", metadata, autoload_with=conn)
+    task_type_key = sa.Table("task_type_key", metadata, autoload_with=conn)
+    conn.execute(
+        task_type_key.delete().where(
+            task_type_key.c.name == KEY_NAME,
+            task_type_key.c.task_type_id == task_type.c.task_type_id,
+            task_type.c.name == TASK_TYPE_NAME,
+        )
+    )
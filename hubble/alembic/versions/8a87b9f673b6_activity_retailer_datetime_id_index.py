@@ -0,0 +1,58 @@
+"""activity retailer datetime id index
+
+Backs the keyset pagination of hubble.query over all of a retailer's activities, which none of the indexes
+can return in (datetime, id) order without sorting the retailer's rows first.
+
+Revision ID: 8a87b9f673b6
+Revises: 27374439c64c
+Create Date: 2026-10-18 12:20:48.118032
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8a87b9f673b6"
+down_revision = "27374439c64c"
+branch_labels = None
+depends_on = None
+
+
+INDEX_NAME = "ix_activity_retailer_datetime_id"
+
+
+def _partitions() -> list[str]:
+    return list(
+        op.get_bind()
+        .execute(sa.text("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'activity'::regclass"))
+        .scalars()
+    )
+
+
+def _is_invalid(index: str) -> bool:
+    return bool(
+        op.get_bind()
+        .execute(
+            sa.text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:index)"), {"index": index}
+        )
+        .scalar()
+    )
+
+
+def upgrade() -> None:
+    # built concurrently partition by partition, see 27374439c64c
+    with op.get_context().autocommit_block():
+        op.execute(f"CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON ONLY activity (retailer, datetime, id)")
+        for partition in _partitions():
+            partition_index = INDEX_NAME.replace("ix_activity_", f"ix_{partition}_", 1)
+            if _is_invalid(partition_index):
+                op.execute(f"DROP INDEX CONCURRENTLY {partition_index}")
+            op.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} ON {partition} (retailer, datetime, id)"
+            )
+            op.execute(f"ALTER INDEX {INDEX_NAME} ATTACH PARTITION {partition_index}")
+
+
+def downgrade() -> None:
+    op.execute(f"DROP INDEX IF EXISTS {INDEX_NAME}")
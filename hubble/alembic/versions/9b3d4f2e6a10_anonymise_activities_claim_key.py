@@ -0,0 +1,51 @@
+"""anonymise activities claim key
+
+Adds the task key a run of anonymise-activities claims a task under, with the run's task id and the time it
+last refreshed the claim.
+
+Revision ID: 9b3d4f2e6a10
+Revises: 5e1c0a7d93b2
+Create Date: 2026-10-18 19:02:11.604215
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9b3d4f2e6a10"
+down_revision = "5e1c0a7d93b2"
+branch_labels = None
+depends_on = None
+
+TASK_TYPE_NAME = "anonymise-activities"
+KEY_NAME = "anonymise_claim"
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    metadata = sa.MetaData()
+    task_type = sa.Table("task_type", metadata, autoload_with=conn)
+    task_type_key = sa.Table("task_type_key", metadata, autoload_with=conn)
+    conn.execute(
+        task_type_key.insert().from_select(
+            ["name", "type", "task_type_id"],
+            sa.select(sa.literal(KEY_NAME), sa.literal_column("'STRING'"), task_type.c.task_type_id).where(
+                task_type.c.name == TASK_TYPE_NAME
+            ),
+        )
+    )
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    metadata = sa.MetaData()
+    task_type = sa.Table("task_type", metadata, autoload_with=conn)
+    task_type_key = sa.Table("task_type_key", metadata, autoload_with=conn)
+    conn.execute(
+        task_type_key.delete().where(
+            task_type_key.c.name == KEY_NAME,
+            task_type_key.c.task_type_id == task_type.c.task_type_id,
+            task_type.c.name == TASK_TYPE_NAME,
+        )
+    )
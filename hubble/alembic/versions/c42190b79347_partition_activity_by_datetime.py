@@ -0,0 +1,189 @@
+"""partition activity by datetime
+
+Revision ID: c42190b79347
+Revises: c0f7b19684db
+Create Date: 2026-10-18 10:12:41.381206
+
+"""
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "c42190b79347"
+down_revision = "c0f7b19684db"
+branch_labels = None
+depends_on = None
+
+
+INDEXED_COLUMNS = [
+    "activity_identifier",
+    "associated_value",
+    "campaigns",
+    "created_at",
+    "datetime",
+    "reasons",
+    "retailer",
+    "summary",
+    "type",
+    "underlying_datetime",
+    "user_id",
+]
+
+
+# activities at or after the boundary of the legacy partition, e.g. with far-future datetimes, are set aside here
+# while it is attached and then inserted into the partitioned table, landing in the default partition
+OUTLIERS_TABLE = "activity_legacy_outliers"
+BOUNDARY_CHECK = "activity_legacy_datetime_check"
+# diverts activities written at or after the boundary to the outliers table while the CHECK constraint is in place,
+# which would otherwise reject them and have consumers dead-letter them
+DIVERT_TRIGGER = "activity_legacy_divert_outliers"
+
+
+def _activity_columns() -> list[sa.Column]:
+    return [
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("type", sa.String(), nullable=False),
+        sa.Column("datetime", sa.DateTime(), nullable=False),
+        sa.Column("underlying_datetime", sa.DateTime(), nullable=False),
+        sa.Column("summary", sa.String(), nullable=False),
+        sa.Column("reasons", postgresql.ARRAY(sa.String()), nullable=False),
+        sa.Column("activity_identifier", sa.String(), nullable=False),
+        sa.Column("user_id", sa.String(), nullable=False),
+        sa.Column("associated_value", sa.String(), nullable=False),
+        sa.Column("retailer", sa.String(), nullable=False),
+        sa.Column("campaigns", postgresql.ARRAY(sa.String()), nullable=False),
+        sa.Column(
+            "data", postgresql.JSONB(astext_type=sa.Text()), server_default=sa.text("'{}'::jsonb"), nullable=False
+        ),
+        sa.Column(
+            "created_at", sa.DateTime(), server_default=sa.text("TIMEZONE('utc', CURRENT_TIMESTAMP)"), nullable=False
+        ),
+    ]
+
+
+def _is_invalid(index: str) -> bool:
+    return bool(
+        op.get_bind()
+        .execute(
+            sa.text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:index)"), {"index": index}
+        )
+        .scalar()
+    )
+
+
+def _prepare_legacy_partition() -> datetime:
+    """
+    Readies the existing table to become the partition for everything up to the end of the current month,
+    without blocking writes for longer than it takes to take a lock, and returns that boundary
+
+    The boundary is capped there rather than after the latest activity, as a far-future datetime would otherwise
+    leave create_activity_partitions nothing to create for years. The CHECK constraint matching the partition
+    bound is enforced on new rows as soon as it is added, so once the activities past it have been set aside it
+    is validated without blocking writes, and attaching the partition then skips the scan. Activities written past
+    it meanwhile are set aside by a trigger instead, consumers see them as already stored and acknowledge them.
+    """
+    boundary = (
+        op.get_bind()
+        .execute(sa.text("SELECT date_trunc('month', TIMEZONE('utc', CURRENT_TIMESTAMP)) + INTERVAL '1 month'"))
+        .scalar_one()
+    )
+    # left behind, possibly for another month, when the migration was interrupted
+    op.execute(f"ALTER TABLE activity DROP CONSTRAINT IF EXISTS {BOUNDARY_CHECK}")
+    op.execute(f"DROP TRIGGER IF EXISTS {DIVERT_TRIGGER} ON activity")
+    op.execute(f"CREATE TABLE IF NOT EXISTS {OUTLIERS_TABLE} (LIKE activity)")
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION activity_legacy_divert_outliers() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF NEW.datetime >= TG_ARGV[0]::timestamp THEN
+                INSERT INTO activity_legacy_outliers VALUES (NEW.*);
+                RETURN NULL;
+            END IF;
+            RETURN NEW;
+        END
+        $$
+        """
+    )
+    op.execute(
+        f"CREATE TRIGGER {DIVERT_TRIGGER} BEFORE INSERT ON activity "
+        f"FOR EACH ROW EXECUTE FUNCTION {DIVERT_TRIGGER}('{boundary}')"
+    )
+    op.execute(f"ALTER TABLE activity ADD CONSTRAINT {BOUNDARY_CHECK} CHECK (datetime < '{boundary}') NOT VALID")
+    op.get_bind().execute(
+        sa.text(
+            "WITH moved AS (DELETE FROM activity WHERE datetime >= :boundary RETURNING *) "
+            "INSERT INTO activity_legacy_outliers SELECT * FROM moved"
+        ),
+        {"boundary": boundary},
+    )
+    op.execute(f"ALTER TABLE activity VALIDATE CONSTRAINT {BOUNDARY_CHECK}")
+
+    # the primary key has to include the partition key, its index is built ahead of swapping it in
+    if _is_invalid("activity_legacy_pkey"):
+        op.execute("DROP INDEX CONCURRENTLY activity_legacy_pkey")
+    op.execute("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS activity_legacy_pkey ON activity (id, datetime)")
+    return boundary
+
+
+def upgrade() -> None:
+    # the existing table becomes the partition for everything up to the end of the current month, so no rows
+    # are copied
+    with op.get_context().autocommit_block():
+        boundary = _prepare_legacy_partition()
+
+    op.rename_table("activity", "activity_legacy")
+    for column in INDEXED_COLUMNS:
+        op.execute(f"ALTER INDEX ix_activity_{column} RENAME TO ix_activity_legacy_{column}")
+    op.execute(
+        "ALTER TABLE activity_legacy DROP CONSTRAINT activity_pkey, "
+        "ADD CONSTRAINT activity_legacy_pkey PRIMARY KEY USING INDEX activity_legacy_pkey"
+    )
+    # writes are blocked by the rename until this transaction commits, by then they go to the partitioned table
+    op.execute(f"DROP TRIGGER {DIVERT_TRIGGER} ON activity_legacy")
+    op.execute(f"DROP FUNCTION {DIVERT_TRIGGER}()")
+
+    op.create_table(
+        "activity",
+        *_activity_columns(),
+        sa.PrimaryKeyConstraint("id", "datetime"),
+        postgresql_partition_by="RANGE (datetime)",
+    )
+    for column in INDEXED_COLUMNS:
+        op.create_index(op.f(f"ix_activity_{column}"), "activity", [column], unique=False)
+
+    # the legacy indexes match the partitioned ones, so attaching adopts them instead of building new ones
+    op.execute(f"ALTER TABLE activity ATTACH PARTITION activity_legacy FOR VALUES FROM (MINVALUE) TO ('{boundary}')")
+    op.execute(f"ALTER TABLE activity_legacy DROP CONSTRAINT {BOUNDARY_CHECK}")
+    op.execute("CREATE TABLE activity_default PARTITION OF activity DEFAULT")
+
+    columns = [column.name for column in _activity_columns()]
+    outliers = sa.table(OUTLIERS_TABLE, *map(sa.column, columns))
+    # an activity diverted more than once, when redelivered, is inserted once
+    op.execute(
+        postgresql.insert(sa.table("activity", *map(sa.column, columns)))
+        .from_select(columns, sa.select(outliers))
+        .on_conflict_do_nothing()
+    )
+    op.drop_table(OUTLIERS_TABLE)
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE activity DETACH PARTITION activity_legacy")
+    op.execute("INSERT INTO activity_legacy SELECT * FROM activity")
+    op.drop_table("activity")
+
+    # the same id can have been stored with different datetimes, only the first one stored is kept, as the primary
+    # key on id alone would have done
+    op.execute(
+        "DELETE FROM activity_legacy AS duplicate USING activity_legacy AS kept WHERE duplicate.id = kept.id "
+        "AND (duplicate.created_at, duplicate.ctid) > (kept.created_at, kept.ctid)"
+    )
+    op.drop_constraint("activity_legacy_pkey", "activity_legacy", type_="primary")
+    op.create_primary_key("activity_pkey", "activity_legacy", ["id"])
+    for column in INDEXED_COLUMNS:
+        op.execute(f"ALTER INDEX ix_activity_legacy_{column} RENAME TO ix_activity_{column}")
+    op.rename_table("activity_legacy", "activity")
@@ -0,0 +1,253 @@
+"""
+Hashing of an account holder's personal data in activities, for right to be forgotten requests
+
+What is hashed is declared per activity type in ANONYMISATION_RULES. Anonymiser applies the rules to rows in
+python and ANONYMISED_VALUES_SQL is the same rules compiled into the values of an UPDATE of activity, both
+are kept byte for byte identical. Supporting a new activity type only takes a new rule.
+"""
+import hashlib
+import re
+
+from collections.abc import MutableMapping
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+from uuid import UUID
+
+from sqlalchemy import String, Text, bindparam, case, column, func, literal, select
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, aggregate_order_by
+
+from hubble.db.models import Activity
+
+if TYPE_CHECKING:
+    from sqlalchemy import ColumnElement
+
+ACCOUNT_CREDENTIALS = (
+    "email",
+    "first_name",
+    "last_name",
+    "date_of_birth",
+    "phone",
+    "address_line1",
+    "address_line2",
+    "postcode",
+    "city",
+    "custom",
+)
+EMAIL_PATTERN = r"[\w.+-]+@[\w-]+\.[\w.-]+"
+EMAIL_RE = re.compile(EMAIL_PATTERN)
+
+
+@dataclass(frozen=True)
+class AnonymisationRule:
+    """
+    What to hash in the activities of a type
+
+    columns are hashed whole, emails found in email_columns are hashed where they are, data_paths are paths
+    to values of data hashed whole and data_fields the names of the data["fields"] entries whose value is hashed.
+    Missing values are left alone.
+    """
+
+    columns: tuple[str, ...] = ()
+    email_columns: tuple[str, ...] = ()
+    data_paths: tuple[tuple[str, ...], ...] = ()
+    data_fields: frozenset[str] = frozenset()
+
+    @property
+    def anonymised_columns(self) -> tuple[str, ...]:
+        anonymises_data = bool(self.data_paths or self.data_fields)
+        return (*self.columns, *self.email_columns, *(("data",) if anonymises_data else ()))
+
+
+ANONYMISATION_RULES: dict[str, AnonymisationRule] = {
+    "ACCOUNT_REQUEST": AnonymisationRule(
+        columns=("associated_value",), email_columns=("summary",), data_fields=frozenset(ACCOUNT_CREDENTIALS)
+    ),
+    "EMAIL_EVENT": AnonymisationRule(data_paths=(("email",),)),
+}
+ANONYMISED_ACTIVITY_TYPES = frozenset(ANONYMISATION_RULES)
+
+
+def encode_value(account_holder_uuid: str | UUID, value: Any | None) -> str:
+    """
+    Returns hashlib.sha224 encoded hash str of the input str account_holder_uuid
+
+    If the value to hash isn't the account_holder_uuid, account_holder_uuid is still
+    required as it is used as suffix and the combined str is hashed
+    """
+    identifier = value + str(account_holder_uuid) if value else str(account_holder_uuid)
+    return hashlib.sha224((identifier).encode("utf-8")).hexdigest()
+
+
+def _json_string(value: Any) -> str | None:  # noqa: ANN401
+    # only strings are hashed along with the uuid, anything else is hashed as if it was missing
+    return value if isinstance(value, str) else None
+
+
+class Anonymiser:
+    """
+    Applies ANONYMISATION_RULES for an account holder
+
+    Hashes are remembered for the lifetime of the instance, as the same email turns up in most of an account
+    holder's activities.
+    """
+
+    def __init__(self, account_holder_uuid: str | UUID, rules: dict[str, AnonymisationRule] | None = None) -> None:
+        self.account_holder_uuid = str(account_holder_uuid)
+        self.rules = ANONYMISATION_RULES if rules is None else rules
+        self._hashes: dict[str | None, str] = {}
+
+    def encode(self, value: str | None) -> str:
+        if (hashed := self._hashes.get(value)) is None:
+            hashed = self._hashes[value] = encode_value(self.account_holder_uuid, value)
+
+        return hashed
+
+    def encode_emails(self, value: str) -> str:
+        """
+        Returns value with every email replaced with the hash of the first one
+
+        i.e 'Enrolment Requested for qatest+011@bink.com' becomes
+        'Enrolment Requested for 5a8612c878a17ec322d90d6ae2c26007533b4cb4699b4392d44f106d'
+        """
+        if (match := EMAIL_RE.search(value)) is None:
+            return value
+
+        return EMAIL_RE.sub(self.encode(match[0]), value)
+
+    def _anonymise_data(self, rule: AnonymisationRule, data: dict) -> None:
+        for *parents, key in rule.data_paths:
+            parent: Any = data
+            for parent_key in parents:
+                parent = parent.get(parent_key) if isinstance(parent, dict) else None
+            if isinstance(parent, dict) and key in parent:
+                parent[key] = self.encode(_json_string(parent[key]))
+
+        if rule.data_fields and isinstance(fields := data.get("fields"), list):
+            for field in fields:
+                if field.get("field_name") in rule.data_fields:
+                    field["value"] = self.encode(_json_string(field.get("value")))
+
+    def anonymise(self, activity_type: str, row: MutableMapping[str, Any]) -> bool:
+        """
+        Hashes in place the values of row, a mapping of activity columns to values, the rule for activity_type
+        covers. Returns whether there is such a rule.
+        """
+        if (rule := self.rules.get(activity_type)) is None:
+            return False
+
+        for name in rule.columns:
+            row[name] = self.encode(row[name])
+        for name in rule.email_columns:
+            row[name] = self.encode_emails(row[name])
+        if "data" in rule.anonymised_columns:
+            self._anonymise_data(rule, row["data"])
+
+        return True
+
+
+activity_table = Activity.__table__
+account_holder_uuid_param = bindparam("account_holder_uuid", type_=String)
+
+
+def _sql_encode_value(value: "ColumnElement[str]", account_holder_uuid: "ColumnElement[str]") -> "ColumnElement[str]":
+    """SQL equivalent of encode_value, hashing the same utf-8 bytes"""
+    salted = case((value != "", value.concat(account_holder_uuid)), else_=account_holder_uuid)
+    return func.encode(func.sha224(func.convert_to(salted, "UTF8")), "hex")
+
+
+def _sql_json_string(value: "ColumnElement[dict]", path: tuple[str, ...]) -> "ColumnElement[str]":
+    return case((func.jsonb_typeof(value[path]) == "string", value[path].astext))
+
+
+def _sql_encode_emails(value: "ColumnElement[str]", account_holder_uuid: "ColumnElement[str]") -> "ColumnElement[str]":
+    first_email = func.substring(value, EMAIL_PATTERN)
+    return case(
+        (
+            value.regexp_match(EMAIL_PATTERN),
+            func.regexp_replace(value, EMAIL_PATTERN, _sql_encode_value(first_email, account_holder_uuid), "g"),
+        ),
+        else_=value,
+    )
+
+
+def _sql_encode_fields(
+    data: "ColumnElement[dict]", names: frozenset[str], account_holder_uuid: "ColumnElement[str]"
+) -> "ColumnElement[dict]":
+    # rebuilds data["fields"] in its original order
+    fields = (
+        func.jsonb_array_elements(data["fields"])
+        .table_valued(column("field", JSONB), with_ordinality="position")
+        .render_derived()
+    )
+    field = fields.c.field
+    encoded_field = case(
+        (
+            field["field_name"].astext.in_(sorted(names)),
+            func.jsonb_set(
+                field,
+                literal(["value"], ARRAY(Text)),
+                func.to_jsonb(_sql_encode_value(_sql_json_string(field, ("value",)), account_holder_uuid)),
+            ),
+        ),
+        else_=field,
+    )
+    encoded_fields = select(
+        func.coalesce(func.jsonb_agg(aggregate_order_by(encoded_field, fields.c.position)), func.jsonb_build_array())
+    ).scalar_subquery()
+    return case(
+        (
+            func.jsonb_typeof(data["fields"]) == "array",
+            func.jsonb_set(data, literal(["fields"], ARRAY(Text)), encoded_fields, type_=JSONB),
+        ),
+        else_=data,
+    )
+
+
+def _sql_anonymised_data(rule: AnonymisationRule, account_holder_uuid: "ColumnElement[str]") -> "ColumnElement[dict]":
+    data: ColumnElement[dict] = activity_table.c.data
+    for path in rule.data_paths:
+        # jsonb_set leaves data as it is when there is nothing at path
+        data = func.jsonb_set(
+            data,
+            literal(list(path), ARRAY(Text)),
+            func.to_jsonb(_sql_encode_value(_sql_json_string(data, path), account_holder_uuid)),
+            False,
+            type_=JSONB,
+        )
+    if rule.data_fields:
+        data = _sql_encode_fields(data, rule.data_fields, account_holder_uuid)
+
+    return data
+
+
+def _sql_anonymised_column(
+    rule: AnonymisationRule, name: str, account_holder_uuid: "ColumnElement[str]"
+) -> "ColumnElement":
+    if name == "data":
+        return _sql_anonymised_data(rule, account_holder_uuid)
+    if name in rule.email_columns:
+        return _sql_encode_emails(activity_table.c[name], account_holder_uuid)
+
+    return _sql_encode_value(activity_table.c[name], account_holder_uuid)
+
+
+def anonymised_values_sql(
+    rules: dict[str, AnonymisationRule], account_holder_uuid: "ColumnElement[str]" = account_holder_uuid_param
+) -> dict[str, "ColumnElement"]:
+    """
+    Compiles rules into the values of an UPDATE of activity
+
+    The account holder's uuid is bound separately by default, a column of a table joined to activity hashes
+    the activities of several account holders in one statement.
+    """
+    anonymised: dict[str, list[tuple[ColumnElement[bool], ColumnElement]]] = {}
+    for activity_type, rule in rules.items():
+        for name in rule.anonymised_columns:
+            anonymised.setdefault(name, []).append(
+                (activity_table.c.type == activity_type, _sql_anonymised_column(rule, name, account_holder_uuid))
+            )
+
+    return {name: case(*whens, else_=activity_table.c[name]) for name, whens in anonymised.items()}
+
+
+ANONYMISED_VALUES_SQL = anonymised_values_sql(ANONYMISATION_RULES)
@@ -1,6 +1,17 @@
+import asyncio
+import gzip
 import logging
 import os
+import signal
+import sys
 
+from contextlib import ExitStack
+from datetime import UTC, datetime, timedelta
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import psycopg
 import sentry_sdk
 import typer
 
@@ -11,13 +22,33 @@ from prometheus_client import values
 from prometheus_client.multiprocess import MultiProcessCollector
 from rq import Worker
 
-from hubble.config import redis_raw, settings
+from hubble.config import redis, redis_raw, settings
+from hubble.export import ExportFormat
+from hubble.export import export_activities as export_filtered_activities
+from hubble.messaging.async_consumer import AsyncActivityConsumer
 from hubble.messaging.consumer import ActivityConsumer
+from hubble.messaging.supervisor import ConsumerSupervisor
+from hubble.messaging.topology import claim_partition
+from hubble.pii_audit import AuditCheckpoint, PIIAudit, load_forgotten, plan_audit
+from hubble.query import ActivityFilter
+from hubble.rollups import rebuild_rollups
+from hubble.scheduled_tasks.activity_archive import archive_old_activities
+from hubble.scheduled_tasks.activity_archive import restore_activities as restore_archived_activities
+from hubble.scheduled_tasks.activity_partitions import create_activity_partitions
+from hubble.scheduled_tasks.activity_rollups import reconcile_activity_rollups
+from hubble.scheduled_tasks.anonymise_claims import requeue_stale_anonymise_activities
 from hubble.scheduled_tasks.scheduler import cron_scheduler as scheduler
 from hubble.scheduled_tasks.task_cleanup import cleanup_old_tasks
 from hubble.tasks.error_handlers import job_meta_handler
+from hubble.tasks.right_to_be_forgotten import enqueue_anonymise_activities
 from hubble.version import __version__
 
+if TYPE_CHECKING:
+    from types import FrameType
+    from typing import BinaryIO
+
+    from _typeshed import SupportsWrite
+
 cli = typer.Typer()
 logger = logging.getLogger(__name__)
 
@@ -30,16 +61,67 @@ if settings.SENTRY_DSN:  # pragma: no cover
     )
 
 
-@cli.command()
-def activity_consumer() -> None:
+def _run_activity_consumer(use_async: bool, partition: int | None, slot: int = 0) -> None:
     rmq_conn, exchange = get_connection_and_exchange(
         rabbitmq_dsn=settings.RABBIT_DSN, message_exchange_name=settings.MESSAGE_EXCHANGE
     )
-    ActivityConsumer(
-        rmq_conn,
-        exchange,
-        queue_name=settings.MESSAGE_QUEUE_NAME,
-        routing_key=settings.MESSAGE_ROUTING_KEY,
+    queue_name, routing_key = settings.MESSAGE_QUEUE_NAME, settings.MESSAGE_ROUTING_KEY
+    if partition is not None:
+        # supervised workers claim consecutive partitions starting from --partition
+        exchange, queue_name, routing_key = claim_partition(rmq_conn, exchange, partition + slot)
+
+    if use_async:
+        asyncio.run(AsyncActivityConsumer(rmq_conn, exchange, queue_name=queue_name, routing_key=routing_key).run())
+        return
+
+    consumer = ActivityConsumer(rmq_conn, exchange, queue_name=queue_name, routing_key=routing_key)
+
+    def stop_consumer(signum: int, frame: "FrameType | None") -> None:  # noqa: ARG001
+        # lets the consume loop exit cleanly, flushing the pending batch
+        consumer.should_stop = True
+
+    signal.signal(signal.SIGTERM, stop_consumer)
+    consumer.run()
+
+
+@cli.command()
+def activity_consumer(
+    use_async: bool = typer.Option(False, "--async", help="Run the consume loop on asyncio."),  # noqa: B008
+    workers: int = typer.Option(  # noqa: B008
+        1, "--workers", min=1, help="Number of consumer processes to run under a supervisor."
+    ),
+    partition: int = typer.Option(  # noqa: B008
+        None, "--partition", min=0, help="Partition to consume when CONSUMER_PARTITIONS is set, first of --workers."
+    ),
+) -> None:
+    if settings.CONSUMER_PARTITIONS and (partition is None or partition + workers > settings.CONSUMER_PARTITIONS):
+        raise typer.BadParameter(
+            f"--partition and --workers must claim partitions between 0 and {settings.CONSUMER_PARTITIONS - 1}"
+        )
+    if not settings.CONSUMER_PARTITIONS and partition is not None:
+        raise typer.BadParameter("--partition requires CONSUMER_PARTITIONS to be set")
+
+    if workers == 1:
+        if settings.ACTIVATE_CONSUMER_METRICS:
+            logger.info("Starting prometheus metrics server...")
+            start_prometheus_server(settings.PROMETHEUS_HTTP_SERVER_PORT)
+        _run_activity_consumer(use_async, partition)
+        return
+
+    if settings.ACTIVATE_CONSUMER_METRICS:
+        # workers write their samples to PROMETHEUS_MULTIPROC_DIR and the supervisor serves the aggregate
+        values.ValueClass = values.MultiProcessValue()
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        logger.info("Starting prometheus metrics server...")
+        start_prometheus_server(settings.PROMETHEUS_HTTP_SERVER_PORT, registry=registry)
+
+    ConsumerSupervisor(
+        partial(_run_activity_consumer, use_async, partition),
+        workers=workers,
+        restart_delay=settings.CONSUMER_WORKER_RESTART_DELAY_SECS,
+        shutdown_timeout=settings.CONSUMER_WORKER_SHUTDOWN_TIMEOUT_SECS,
+        metrics=settings.ACTIVATE_CONSUMER_METRICS,
     ).run()
 
 
@@ -68,6 +150,10 @@ def task_worker(burst: bool = False) -> None:  # pragma: no cover
 @cli.command()
 def cron_scheduler(
     task_cleanup: bool = True,
+    activity_partitions: bool = True,
+    activity_archive: bool = True,
+    activity_rollups: bool = True,
+    anonymise_stale_claims: bool = True,
 ) -> None:
 
     logger.info("Initialising scheduler...")
@@ -77,11 +163,155 @@ def cron_scheduler(
             schedule_fn=lambda: settings.TASK_CLEANUP_SCHEDULE,
             coalesce_jobs=True,
         )
+    if activity_partitions:
+        scheduler.add_job(
+            create_activity_partitions,
+            schedule_fn=lambda: settings.ACTIVITY_PARTITION_SCHEDULE,
+            coalesce_jobs=True,
+        )
+    if activity_archive:
+        scheduler.add_job(
+            archive_old_activities,
+            schedule_fn=lambda: settings.ACTIVITY_ARCHIVE_SCHEDULE,
+            coalesce_jobs=True,
+        )
+    if activity_rollups and settings.ACTIVITY_ROLLUPS_ENABLED:
+        scheduler.add_job(
+            reconcile_activity_rollups,
+            schedule_fn=lambda: settings.ACTIVITY_ROLLUP_RECONCILE_SCHEDULE,
+            coalesce_jobs=True,
+        )
+    if anonymise_stale_claims:
+        scheduler.add_job(
+            requeue_stale_anonymise_activities,
+            schedule_fn=lambda: settings.ANONYMISE_ACTIVITIES_STALE_CLAIMS_SCHEDULE,
+            coalesce_jobs=True,
+        )
 
     logger.info(f"Starting scheduler {cron_scheduler}...")
     scheduler.run()
 
 
+@cli.command()
+def restore_activities(
+    archive: Path = typer.Argument(  # noqa: B008
+        ..., exists=True, file_okay=False, help="Directory written by a run of the archive_old_activities job."
+    ),
+) -> None:
+    with psycopg.connect(settings.PSYCOPG_URI) as conn:
+        restored = restore_archived_activities(conn, archive)
+
+    logger.info(f"Restored {restored} activities from {archive}")
+
+
+@cli.command()
+def rebuild_activity_rollups(
+    datetime_from: datetime = typer.Option(  # noqa: B008
+        ..., "--from", help="UTC datetime of the first hour to rebuild the rollups of."
+    ),
+    datetime_to: datetime = typer.Option(  # noqa: B008
+        None, "--to", help="UTC datetime to rebuild the rollups up to, defaults to now."
+    ),
+) -> None:
+    end = datetime.now(tz=UTC) if datetime_to is None else datetime_to.replace(tzinfo=UTC)
+    with psycopg.connect(settings.PSYCOPG_URI) as conn:
+        hours = rebuild_rollups(conn, datetime_from.replace(tzinfo=UTC), end)
+
+    logger.info(f"Rebuilt {hours} hours of activity rollups")
+
+
+@cli.command()
+def export_activities(  # noqa: PLR0913
+    retailer: str = typer.Option(..., help="Slug of the retailer to export the activities of."),  # noqa: B008
+    activity_types: list[str] = typer.Option(  # noqa: B008
+        None, "--type", help="Only export activities of this type, can be repeated."
+    ),
+    datetime_from: datetime = typer.Option(  # noqa: B008
+        None, "--from", help="Only export activities that happened at or after this UTC datetime."
+    ),
+    datetime_to: datetime = typer.Option(  # noqa: B008
+        None, "--to", help="Only export activities that happened before this UTC datetime."
+    ),
+    export_format: ExportFormat = typer.Option(ExportFormat.NDJSON, "--format"),  # noqa: B008
+    output: Path = typer.Option(  # noqa: B008
+        None, "--output", "-o", dir_okay=False, help="File to write to instead of stdout."
+    ),
+    compress: bool = typer.Option(False, "--gzip", help="Compress the output with gzip."),  # noqa: B008
+) -> None:
+    filters = ActivityFilter(
+        retailer=retailer, types=activity_types, datetime_from=datetime_from, datetime_to=datetime_to
+    )
+    if output is None:
+        # keeps log records out of the export
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+                handler.setStream(sys.stderr)
+
+    with ExitStack() as stack:
+        stream: "BinaryIO" = sys.stdout.buffer if output is None else stack.enter_context(output.open("wb"))
+        out: "SupportsWrite[bytes]" = (
+            stack.enter_context(gzip.GzipFile(fileobj=stream, mode="wb")) if compress else stream
+        )
+        conn = stack.enter_context(psycopg.connect(settings.PSYCOPG_URI))
+        export_filtered_activities(conn, out, filters, export_format)
+
+
+@cli.command()
+def audit_pii(  # noqa: PLR0913
+    report: Path = typer.Option(  # noqa: B008
+        ..., "--report", "-o", dir_okay=False, help="File the findings are written to, as NDJSON."
+    ),
+    checkpoint: Path = typer.Option(  # noqa: B008
+        None,
+        "--checkpoint",
+        dir_okay=False,
+        help="File progress is saved to, the report's with a .checkpoint suffix by default, resumed from if it exists.",
+    ),
+    retailer: str = typer.Option(None, help="Only audit the activities of this retailer."),  # noqa: B008
+    datetime_from: datetime = typer.Option(  # noqa: B008
+        None, "--from", help="UTC datetime to audit activities from, defaults to the oldest."
+    ),
+    datetime_to: datetime = typer.Option(  # noqa: B008
+        None, "--to", help="UTC datetime to audit activities up to, defaults to now."
+    ),
+    range_days: int = typer.Option(  # noqa: B008
+        1, "--range-days", min=1, help="Days of activities scanned by a worker at a time."
+    ),
+    workers: int = typer.Option(4, "--workers", min=1, help="Number of worker processes."),  # noqa: B008
+    requeue: bool = typer.Option(  # noqa: B008
+        False, "--requeue", help="Enqueue anonymise-activities tasks for the account holders found."
+    ),
+) -> None:
+    checkpoint_path = checkpoint or report.with_name(report.name + ".checkpoint")
+    resume = checkpoint_path.exists()
+    with psycopg.connect(settings.PSYCOPG_URI) as conn:
+        if resume:
+            audit_checkpoint = AuditCheckpoint.load(checkpoint_path)
+            logger.info(f"Resuming the audit of {checkpoint_path}")
+        else:
+            audit_checkpoint = plan_audit(
+                conn,
+                timedelta(days=range_days),
+                retailer,
+                datetime_from and datetime_from.replace(tzinfo=UTC),
+                datetime_to and datetime_to.replace(tzinfo=UTC),
+            )
+        forgotten = load_forgotten(redis, conn, settings.ANONYMISE_ACTIVITIES_TASK_NAME, audit_checkpoint.retailer)
+
+    with report.open("a" if resume else "w") as out:
+        found = PIIAudit(
+            settings.PSYCOPG_URI,
+            forgotten,
+            audit_checkpoint,
+            checkpoint_path,
+            out,
+            workers=workers,
+            requeue=enqueue_anonymise_activities if requeue else None,
+        ).run()
+
+    logger.info(f"Found {found} activities with un-hashed emails of forgotten account holders, see {report}")
+
+
 @cli.callback()
 def callback() -> None:
     """
@@ -50,6 +50,17 @@ class Settings(BaseSettings):
         return db_uri
 
     PG_CONNECTION_POOLING: bool = True
+    # activity consumer psycopg pool, see psycopg_pool.ConnectionPool for details
+    PG_POOL_MIN_SIZE: int = 1
+    PG_POOL_MAX_SIZE: int = 10
+    PG_POOL_MAX_IDLE_SECS: float = 600.0
+    PG_POOL_MAX_LIFETIME_SECS: float = 3600.0
+    PG_POOL_TIMEOUT_SECS: float = 30.0
+    PG_POOL_CHECK_CONNECTIONS: bool = False
+    PG_POOL_STATS_INTERVAL_SECS: float = 60.0
+    # executions of the same query after which psycopg prepares it server side, 0 prepares straight away
+    # and None disables prepared statements, e.g. behind pgbouncer in transaction mode
+    PG_PREPARE_THRESHOLD: int | None = 0
 
     SENTRY_DSN: str | None = None
     SENTRY_ENV: str | None = None
@@ -64,6 +75,50 @@ class Settings(BaseSettings):
     MESSAGE_QUEUE_NAME: str = "hubble-activities"
     MESSAGE_EXCHANGE: str = "hubble-activities"
     MESSAGE_ROUTING_KEY: str = "activity.#"
+    # when set, messages are spread over this many MESSAGE_QUEUE_NAME-<n> queues through an x-consistent-hash
+    # exchange (rabbitmq_consistent_hash_exchange plugin) and each consumer claims one of them with --partition
+    CONSUMER_PARTITIONS: int = 0
+    # message header hashed to pick a partition, carrying the retailer slug so that each retailer's activities stay
+    # in order on one partition. Partitioned consumers refuse to start without one, the routing key is only the
+    # activity type
+    CONSUMER_PARTITION_HASH_HEADER: str | None = "retailer"
+
+    # when enabled, rows from several messages are written in a single transaction and the messages are
+    # acknowledged together once either limit is reached
+    CONSUMER_BATCHING: bool = False
+    CONSUMER_BATCH_MAX_ROWS: int = 500
+    CONSUMER_BATCH_MAX_WAIT_MS: int = 200
+    # when enabled with batching, the batch size limit and prefetch count move between CONSUMER_BATCH_MIN_ROWS and
+    # CONSUMER_BATCH_MAX_ROWS, shrinking when writes take longer than the target latency or fail
+    CONSUMER_ADAPTIVE_BATCHING: bool = False
+    CONSUMER_BATCH_MIN_ROWS: int = 10
+    CONSUMER_TARGET_WRITE_LATENCY_MS: int = 500
+    CONSUMER_BATCH_ROWS_INCREASE_STEP: int = 25
+    CONSUMER_BATCH_ROWS_DECREASE_FACTOR: float = 0.5
+    # activity-consumer --async only: number of batches that can be written to postgres concurrently
+    CONSUMER_ASYNC_MAX_INFLIGHT_BATCHES: int = 4
+    # activity-consumer --workers N only
+    CONSUMER_WORKER_RESTART_DELAY_SECS: float = 5.0
+    CONSUMER_WORKER_SHUTDOWN_TIMEOUT_SECS: float = 30.0
+    # when set, activities that cannot be written because postgres is unreachable are appended to segment files
+    # under this directory, one sub directory per consumer process, and acked. A background thread replays them.
+    CONSUMER_SPOOL_DIR: str | None = None
+    CONSUMER_SPOOL_MAX_BYTES: int = 1024**3
+    CONSUMER_SPOOL_SEGMENT_MAX_BYTES: int = 64 * 1024**2
+    CONSUMER_SPOOL_REPLAY_BATCH_ROWS: int = 5000
+    CONSUMER_SPOOL_REPLAY_INTERVAL_SECS: float = 5.0
+    # "copy" streams rows with a binary COPY, "executemany" runs one INSERT per row
+    ACTIVITY_WRITE_ENGINE: Literal["copy", "executemany"] = "copy"
+    # add persisted activities to the hourly rollup tables of hubble.rollups, in the same transaction. Off by
+    # default, as it adds upserts of contended rows to every batch
+    ACTIVITY_ROLLUPS_ENABLED: bool = False
+    # ids of recently persisted activities kept in memory to drop redeliveries before they reach postgres, 0 disables
+    CONSUMER_RECENT_IDS_CACHE_SIZE: int = 100_000
+    # activities of account holders already forgotten by anonymise-activities are hashed before they are written,
+    # looked up in redis once per batch
+    CONSUMER_ANONYMISE_FORGOTTEN: bool = True
+    # while that lookup fails, batches are not written un-hashed but requeued, this many seconds after the failure
+    CONSUMER_FORGOTTEN_RETRY_DELAY_SECS: float = 5.0
 
     USE_NULL_POOL: bool = False
     DB_CONNECTION_RETRY_TIMES: int = 3
@@ -88,13 +143,46 @@ class Settings(BaseSettings):
         return v or [values["TASK_QUEUE_PREFIX"] + name for name in ("high", "default", "low")]
 
     ANONYMISE_ACTIVITIES_TASK_NAME: str = "anonymise-activities"
+    # "sql" hashes an account holder's activities in postgres with a few UPDATE statements, "orm" loads and
+    # hashes them one by one in python
+    ANONYMISE_ACTIVITIES_ENGINE: Literal["orm", "sql"] = "sql"
+    # activities are hashed and committed in chunks of this many rows, the task saving how far it got with each
+    ANONYMISE_ACTIVITIES_CHUNK_ROWS: int = 1000
+    # activities locked by another transaction are skipped and retried this many times, this many seconds apart,
+    # once every chunk is done. The task is retried when some are still locked
+    ANONYMISE_ACTIVITIES_LOCKED_RETRIES: int = 3
+    ANONYMISE_ACTIVITIES_LOCKED_RETRY_DELAY_SECS: float = 1.0
+    # with the "sql" engine, a task claims up to this many pending tasks of its retailer, itself included, and
+    # hashes all of their account holders' activities together, in the same checkpointed chunks. 1 processes every
+    # task on its own
+    ANONYMISE_ACTIVITIES_BULK_MAX_TASKS: int = 1
+    # a run claims its tasks, refreshing the claims with every chunk. A claim not refreshed for this long was left
+    # by a run that died, the task is taken over by the next job to claim it or requeued on
+    # ANONYMISE_ACTIVITIES_STALE_CLAIMS_SCHEDULE
+    ANONYMISE_ACTIVITIES_CLAIM_STALE_SECS: int = 600
+    ANONYMISE_ACTIVITIES_STALE_CLAIMS_SCHEDULE: str = "*/10 * * * *"
 
     ACTIVATE_TASKS_METRICS: bool = True
+    ACTIVATE_CONSUMER_METRICS: bool = True
     PROMETHEUS_HTTP_SERVER_PORT: int = 9100
 
     REDIS_KEY_PREFIX = "hubble:"
     TASK_CLEANUP_SCHEDULE: str = "0 1 * * *"
     TASK_DATA_RETENTION_DAYS: int = 180
+    ACTIVITY_PARTITION_SCHEDULE: str = "0 2 * * *"
+    # number of monthly activity partitions kept ready after the current one
+    ACTIVITY_PARTITION_PREMAKE_MONTHS: int = 3
+    ACTIVITY_ARCHIVE_SCHEDULE: str = "0 3 * * *"
+    # activities older than this many days are moved to ACTIVITY_ARCHIVE_DIR, nothing is archived when it is unset
+    ACTIVITY_RETENTION_DAYS: int = 730
+    ACTIVITY_ARCHIVE_DIR: str | None = None
+    ACTIVITY_ARCHIVE_BATCH_ROWS: int = 50_000
+    # kept below the scheduled tasks lock timeout, the next run carries on from where this one stopped
+    ACTIVITY_ARCHIVE_MAX_RUNTIME_SECS: int = 3000
+    ACTIVITY_ROLLUP_RECONCILE_SCHEDULE: str = "30 3 * * *"
+    # hours up to this many days back are rebuilt from the activity table, correcting any drift of the rollups,
+    # e.g. from activities written by a consumer running with ACTIVITY_ROLLUPS_ENABLED off
+    ACTIVITY_ROLLUP_RECONCILE_DAYS: int = 2
 
     class Config:
         case_sensitive = True
@@ -2,7 +2,7 @@ from datetime import datetime as dt
 from uuid import UUID
 
 from retry_tasks_lib.db.models import load_models_to_metadata
-from sqlalchemy import String, text
+from sqlalchemy import DDL, BigInteger, Index, String, event, func, text
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
@@ -18,21 +18,73 @@ load_models_to_metadata(Base.metadata)
 
 class Activity(Base):
     __tablename__ = "activity"
+    # every index costs a write per insert, so only the access paths below are indexed:
+    # - an account holder's activities within a retailer, by uuid or case insensitive email
+    # - a retailer's activities over a time range, in the (datetime, id) order hubble.query paginates them in
+    # - a retailer's activities of a type over a time range
+    # - campaign and reason containment and overlap (@>, &&), which a B-tree cannot serve
+    # - time ranges across retailers, BRIN being enough for columns that grow with insertion order
+    # monthly partitions are created ahead of time by the create_activity_partitions scheduled job
+    __table_args__ = (
+        Index("ix_activity_retailer_user_id_datetime", "retailer", "user_id", "datetime"),
+        Index("ix_activity_retailer_lower_associated_value", "retailer", func.lower(text("associated_value"))),
+        Index("ix_activity_retailer_datetime_id", "retailer", "datetime", "id"),
+        Index("ix_activity_retailer_type_datetime", "retailer", "type", "datetime"),
+        Index("ix_activity_campaigns_gin", "campaigns", postgresql_using="gin"),
+        Index("ix_activity_reasons_gin", "reasons", postgresql_using="gin"),
+        Index("ix_activity_datetime_brin", "datetime", postgresql_using="brin"),
+        Index("ix_activity_created_at_brin", "created_at", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (datetime)"},
+    )
 
     id: Mapped[UUID] = mapped_column(primary_key=True)
-    type: Mapped[str] = mapped_column(index=True, nullable=False)
+    type: Mapped[str] = mapped_column(nullable=False)
+    # part of the primary key as the partition key must be included in every unique constraint
     datetime: Mapped[dt] = mapped_column(
-        index=True, nullable=False, doc="The time at which this activity happened on the publisher side"
+        primary_key=True,
+        nullable=False,
+        doc="The time at which this activity happened on the publisher side",
     )
     underlying_datetime: Mapped[dt] = mapped_column(
-        index=True, nullable=False, doc="Timestamp associated with the underlying object e.g. transaction timestamp"
+        nullable=False, doc="Timestamp associated with the underlying object e.g. transaction timestamp"
     )
-    summary: Mapped[str] = mapped_column(index=True, nullable=False)
-    reasons: Mapped[list[str]] = mapped_column(ARRAY(String), index=True, nullable=False)
+    summary: Mapped[str] = mapped_column(nullable=False)
+    reasons: Mapped[list[str]] = mapped_column(ARRAY(String), nullable=False)
     activity_identifier: Mapped[str] = mapped_column(index=True, nullable=False)
-    user_id: Mapped[str] = mapped_column(index=True, nullable=False)
-    associated_value: Mapped[str] = mapped_column(index=True, nullable=False)
-    retailer: Mapped[str] = mapped_column(index=True, nullable=False)
-    campaigns: Mapped[list[str]] = mapped_column(ARRAY(String), nullable=False, index=True)
+    user_id: Mapped[str] = mapped_column(nullable=False)
+    associated_value: Mapped[str] = mapped_column(nullable=False)
+    retailer: Mapped[str] = mapped_column(nullable=False)
+    campaigns: Mapped[list[str]] = mapped_column(ARRAY(String), nullable=False)
     data: Mapped[dict] = mapped_column(JSONB, server_default=text("'{}'::jsonb"), nullable=False)
-    created_at: Mapped[dt] = mapped_column(server_default=utc_timestamp_sql, index=True, nullable=False)
+    created_at: Mapped[dt] = mapped_column(server_default=utc_timestamp_sql, nullable=False)
+
+
+# catches activities outside of the monthly partitions, e.g. ones dated far in the past
+event.listen(
+    Activity.__table__,
+    "after_create",
+    DDL("CREATE TABLE IF NOT EXISTS activity_default PARTITION OF activity DEFAULT"),
+)
+
+
+class ActivityHourlyRollup(Base):
+    """Activities per retailer, hour, type and campaign, maintained by the consumers, see hubble.rollups"""
+
+    __tablename__ = "activity_hourly_rollup"
+
+    retailer: Mapped[str] = mapped_column(primary_key=True)
+    hour: Mapped[dt] = mapped_column(primary_key=True)
+    type: Mapped[str] = mapped_column(primary_key=True)
+    # "" counts every activity of the type, whatever its campaigns
+    campaign: Mapped[str] = mapped_column(primary_key=True)
+    activities: Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+
+class ActivityHourlyUser(Base):
+    """Account holders with activities in an hour of a retailer, maintained by the consumers, see hubble.rollups"""
+
+    __tablename__ = "activity_hourly_user"
+
+    retailer: Mapped[str] = mapped_column(primary_key=True)
+    hour: Mapped[dt] = mapped_column(primary_key=True)
+    user_id: Mapped[str] = mapped_column(primary_key=True)
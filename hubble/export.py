@@ -0,0 +1,84 @@
+"""
+Bulk export of activities, streamed from postgres to a file object so memory use does not grow with the result
+
+CSV is produced by postgres itself with COPY (SELECT ...) TO STDOUT. COPY's text format would escape the
+backslashes JSON is full of, so NDJSON rows are rendered with row_to_json instead and read through a named,
+server-side, cursor a chunk at a time.
+"""
+import logging
+
+from enum import Enum
+from typing import TYPE_CHECKING
+
+from psycopg import sql
+from sqlalchemy import Text, cast, func, select
+from sqlalchemy.dialects.postgresql import psycopg as psycopg_dialect
+
+from hubble.query import ActivityFilter, select_activities
+
+if TYPE_CHECKING:
+    from _typeshed import SupportsWrite
+    from psycopg import Connection
+    from sqlalchemy import Select
+
+logger = logging.getLogger(__name__)
+
+# rows fetched per round trip from the server-side cursor
+NDJSON_FETCH_ROWS = 5000
+
+
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+def _compile(query: "Select") -> tuple[sql.SQL, dict]:
+    # the same SQL that SQLAlchemy would send through psycopg, parameters included
+    compiled = query.compile(dialect=psycopg_dialect.dialect(), compile_kwargs={"render_postcompile": True})
+    return sql.SQL(str(compiled)), compiled.params
+
+
+def export_csv(conn: "Connection", out: "SupportsWrite[bytes]", query: "Select") -> int:
+    statement, params = _compile(query)
+    with conn.cursor() as cur:
+        with cur.copy(sql.SQL("COPY ({}) TO STDOUT (FORMAT csv, HEADER)").format(statement), params) as copy:
+            for data in copy:
+                out.write(data)
+
+        return cur.rowcount
+
+
+def export_ndjson(conn: "Connection", out: "SupportsWrite[bytes]", query: "Select") -> int:
+    rows = query.subquery("activity_row")
+    # cast to text so the rows are written as postgres rendered them, rather than parsed and encoded again
+    statement, params = _compile(
+        select(cast(func.row_to_json(rows.table_valued()), Text)).order_by(rows.c.datetime, rows.c.id)
+    )
+    exported = 0
+    with conn.transaction(), conn.cursor(name="activity_export") as cur:
+        cur.itersize = NDJSON_FETCH_ROWS
+        cur.execute(statement, params)
+        for (row,) in cur:
+            out.write(row.encode())
+            out.write(b"\n")
+            exported += 1
+
+    return exported
+
+
+def export_activities(
+    conn: "Connection",
+    out: "SupportsWrite[bytes]",
+    filters: ActivityFilter,
+    export_format: ExportFormat = ExportFormat.NDJSON,
+) -> int:
+    """Writes every activity matching filters to out, oldest first, and returns how many were written"""
+    query = select_activities(filters, newest_first=False)
+    match export_format:
+        case ExportFormat.CSV:
+            exported = export_csv(conn, out, query)
+        case ExportFormat.NDJSON:
+            exported = export_ndjson(conn, out, query)
+
+    logger.info("Exported %s activities of %s as %s", exported, filters.retailer, export_format.value)
+    return exported
@@ -0,0 +1,115 @@
+"""
+Index of the account holders whose activities have been anonymised
+
+Activities of an account holder can arrive after the anonymise-activities task forgot them, from late publishers
+or dead letter replays. The task records every account holder it completes in a redis hash per retailer, which
+the consumers look up once per batch to hash these activities the same way before they are stored.
+
+An account holder is recorded under their uuid and a digest of their email, matching activities the way
+select_account_holder_activities does, both mapping to the uuid their values are hashed with.
+"""
+import hashlib
+
+from collections import defaultdict
+from collections.abc import Collection, Iterable, Iterator
+from typing import TYPE_CHECKING
+
+from hubble.anonymisation import ANONYMISED_ACTIVITY_TYPES, Anonymiser
+from hubble.config import settings
+
+if TYPE_CHECKING:
+    from redis import Redis
+
+
+def forgotten_key(retailer: str) -> str:
+    return f"{settings.REDIS_KEY_PREFIX}forgotten-account-holders:{retailer}"
+
+
+def uuid_field(user_id: str) -> str:
+    return f"uuid:{user_id}"
+
+
+def email_field(email: str) -> str:
+    # emails are compared case insensitively
+    return "email:" + hashlib.sha256(email.lower().encode("utf-8")).hexdigest()
+
+
+def forget_account_holders(redis: "Redis", retailer: str, account_holders: Iterable[tuple[str, str]]) -> None:
+    """Records account holders, as (uuid, email) pairs, whose activities of retailer have been anonymised"""
+    fields: dict[str | bytes, str] = {}
+    for account_holder_uuid, email in account_holders:
+        fields[uuid_field(account_holder_uuid)] = account_holder_uuid
+        fields[email_field(email)] = account_holder_uuid
+    if fields:
+        redis.hset(forgotten_key(retailer), mapping=fields)
+
+
+def forgotten_account_holders(
+    redis: "Redis", retailers: Collection[str] | None = None
+) -> Iterator[tuple[str, str, str]]:
+    """
+    Yields the (retailer, field, account holder uuid) of every account holder recorded, of retailers or of all of
+    them, a hash at a time. redis must decode responses.
+    """
+    keys = (
+        [forgotten_key(retailer) for retailer in retailers] if retailers else redis.scan_iter(match=forgotten_key("*"))
+    )
+    prefix = forgotten_key("")
+    for key in keys:
+        for field, account_holder_uuid in redis.hscan_iter(key):
+            yield key.removeprefix(prefix), field, account_holder_uuid
+
+
+def _anonymise(anonymiser: Anonymiser, activity: dict) -> None:
+    # data is wrapped in Jsonb by then, the dict it wraps is hashed in place
+    row = activity | {"data": activity["data"].obj}
+    anonymiser.anonymise(activity["type"], row)
+    activity.update(row, data=activity["data"])
+
+
+def _lookup_fields(activity: dict) -> tuple[str, str]:
+    return uuid_field(str(activity["user_id"])), email_field(str(activity["associated_value"]))
+
+
+def _lookup_account_holders(
+    redis: "Redis", activities_by_retailer: dict[str, list[dict]]
+) -> Iterator[tuple[dict, str | None]]:
+    """Yields each activity with the uuid of the forgotten account holder it belongs to, if any"""
+    with redis.pipeline(transaction=False) as pipe:
+        for retailer, activities in activities_by_retailer.items():
+            pipe.hmget(
+                forgotten_key(retailer), [field for activity in activities for field in _lookup_fields(activity)]
+            )
+        found = pipe.execute()
+
+    for activities, account_holder_uuids in zip(activities_by_retailer.values(), found, strict=True):
+        for activity, by_uuid, by_email in zip(
+            activities, account_holder_uuids[::2], account_holder_uuids[1::2], strict=True
+        ):
+            # as with select_account_holders_activities, the account holder of the uuid wins over that of the email
+            yield activity, by_uuid or by_email
+
+
+def anonymise_forgotten(redis: "Redis", activities: list[dict]) -> int:
+    """
+    Hashes in place the activities of forgotten account holders, as prepared for insertion by the consumers,
+    with a single round trip to redis, which must decode responses. Returns the number of activities hashed.
+    """
+    activities_by_retailer: defaultdict[str, list[dict]] = defaultdict(list)
+    for activity in activities:
+        if activity["type"] in ANONYMISED_ACTIVITY_TYPES:
+            activities_by_retailer[activity["retailer"]].append(activity)
+    if not activities_by_retailer:
+        return 0
+
+    anonymisers: dict[str, Anonymiser] = {}
+    hashed = 0
+    for activity, account_holder_uuid in _lookup_account_holders(redis, activities_by_retailer):
+        if account_holder_uuid is None:
+            continue
+        if (anonymiser := anonymisers.get(account_holder_uuid)) is None:
+            anonymiser = anonymisers[account_holder_uuid] = Anonymiser(account_holder_uuid)
+        _anonymise(anonymiser, activity)
+        hashed += 1
+
+    return hashed
@@ -0,0 +1,90 @@
+import time
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Generic, TypeVar
+
+from cosmos_message_lib.schemas import ActivitySchema
+from psycopg.types.json import Jsonb
+from pydantic import validate_model
+
+if TYPE_CHECKING:
+    import psycopg
+
+MessageT = TypeVar("MessageT")
+
+DEAD_LETTER_ERROR_HEADER = "x-hubble-error"
+DEAD_LETTER_SQLSTATE_HEADER = "x-hubble-sqlstate"
+
+
+def prepare_for_insert(val: ActivitySchema) -> dict:
+    payload = val.dict()
+    payload["data"] = Jsonb(payload["data"])
+    return payload
+
+
+def validate_activity(data: dict) -> dict:
+    """
+    Fast path equivalent of prepare_for_insert(ActivitySchema(**data))
+
+    validate_model is what ActivitySchema.__init__ runs, so the same inputs are rejected, but its output
+    is used as the row straight away instead of building a model and deep copying it with .dict()
+    """
+    if not isinstance(data, dict):
+        # ActivitySchema(**data) would fail to unpack it
+        raise TypeError(f"Activity must be an object, got {type(data).__name__}")
+
+    values, _, validation_error = validate_model(ActivitySchema, data)
+    if validation_error:
+        raise validation_error
+
+    values["data"] = Jsonb(values["data"])
+    return values
+
+
+def activities_from_body(body: dict | list[dict]) -> list[dict]:
+    """Validates a message body, which can hold one or many activities, and prepares its rows for insertion"""
+    if isinstance(body, list):
+        return [validate_activity(data) for data in body]
+
+    return [validate_activity(body)]
+
+
+def activity_body(activity: dict) -> dict:
+    """Turns a prepared activity back into a message body, e.g. to dead-letter it or spool it to disk"""
+    return activity | {"data": activity["data"].obj}
+
+
+def dead_letter_headers(error: "psycopg.Error") -> dict[str, str]:
+    headers = {DEAD_LETTER_ERROR_HEADER: f"{type(error).__name__}: {error}"}
+    if error.sqlstate:
+        headers[DEAD_LETTER_SQLSTATE_HEADER] = error.sqlstate
+
+    return headers
+
+
+@dataclass
+class ActivityBatch(Generic[MessageT]):
+    """Activities waiting to be persisted together with the messages they came from"""
+
+    messages: list[MessageT] = field(default_factory=list)
+    activities: list[dict] = field(default_factory=list)
+    started_at: float | None = None
+    _messages_by_activity: dict[int, MessageT] = field(default_factory=dict, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.activities)
+
+    def add(self, message: MessageT, activities: list[dict]) -> None:
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+
+        self.messages.append(message)
+        self.activities.extend(activities)
+        self._messages_by_activity.update((id(activity), message) for activity in activities)
+
+    def message_for(self, activity: dict) -> MessageT:
+        """Returns the message an activity of this batch came from"""
+        return self._messages_by_activity[id(activity)]
+
+    def age(self) -> float:
+        return time.monotonic() - self.started_at if self.started_at is not None else 0.0
@@ -0,0 +1,344 @@
+import asyncio
+import logging
+import signal
+import time
+
+from contextlib import suppress
+from typing import TYPE_CHECKING
+
+import aio_pika
+
+from aio_pika.exceptions import AMQPError, ChannelInvalidStateError
+from kombu.serialization import dumps, loads
+from redis import RedisError
+
+from hubble.config import redis, settings
+from hubble.forgotten import anonymise_forgotten
+from hubble.messaging.activities import ActivityBatch, activities_from_body, activity_body, dead_letter_headers
+from hubble.messaging.backpressure import AdaptiveBatchController
+from hubble.messaging.consumer import MAX_PREFETCH_COUNT
+from hubble.messaging.deduplication import RecentActivityIds
+from hubble.messaging.pool import is_connection_failure, make_async_connection_pool, report_pool_stats
+from hubble.messaging.prometheus import (
+    record_batch_rows_limit,
+    record_consumed_batch,
+    record_dropped_duplicates,
+    record_forgotten_activities,
+    record_persist_timings,
+    record_requeued_batch,
+    record_validation,
+)
+from hubble.messaging.spool import SpoolFullError, SpoolReplayer, make_spool
+from hubble.messaging.topology import ActivityTopology
+from hubble.messaging.writers import RejectedActivity, awrite_isolating_failures, get_activity_writer
+from hubble.rollups import ActivityRollup
+
+if TYPE_CHECKING:
+    from uuid import UUID
+
+    from aio_pika.abc import AbstractChannel, AbstractExchange, AbstractIncomingMessage
+    from kombu import Connection, Exchange
+
+logger = logging.getLogger(__name__)
+
+ACCEPTED_CONTENT_TYPES = {"application/json"}
+
+
+class AsyncActivityConsumer:
+    """
+    asyncio flavour of ActivityConsumer
+
+    Batches are written on their own tasks, so up to CONSUMER_ASYNC_MAX_INFLIGHT_BATCHES commits can be
+    in progress while new deliveries keep arriving. As batches can complete out of order their messages
+    are acknowledged individually rather than with multiple=True.
+    """
+
+    def __init__(
+        self,
+        rmq_conn: "Connection",
+        exchange: "Exchange",
+        *,
+        queue_name: str,
+        routing_key: str,
+    ) -> None:
+        self.queue_name = queue_name
+        self._rmq_conn = rmq_conn
+        self._topology = ActivityTopology(exchange, queue_name=queue_name, routing_key=routing_key)
+        self._channel: "AbstractChannel | None" = None
+        self._deadletter_exchange: "AbstractExchange | None" = None
+        self._activity_writer = get_activity_writer()
+        self._pg_conn_pool = make_async_connection_pool(configure=self._activity_writer.aprepare)
+        logger.info(f"Activity write engine: {self._activity_writer.name}")
+        self._rollups: bool = settings.ACTIVITY_ROLLUPS_ENABLED
+        self._anonymise_forgotten: bool = settings.CONSUMER_ANONYMISE_FORGOTTEN
+        self._forgotten_retry_delay: float = settings.CONSUMER_FORGOTTEN_RETRY_DELAY_SECS
+
+        self._batch_max_rows: int = settings.CONSUMER_BATCH_MAX_ROWS if settings.CONSUMER_BATCHING else 1
+        self._batch_max_wait: float = settings.CONSUMER_BATCH_MAX_WAIT_MS / 1000
+        self._batch: ActivityBatch["AbstractIncomingMessage"] = ActivityBatch()
+        self._batch_controller: AdaptiveBatchController | None = None
+        if settings.CONSUMER_BATCHING and settings.CONSUMER_ADAPTIVE_BATCHING:
+            self._batch_controller = AdaptiveBatchController.from_settings()
+        self._recent_ids = RecentActivityIds(settings.CONSUMER_RECENT_IDS_CACHE_SIZE)
+        self._spool = make_spool()
+        self._spool_replayer: SpoolReplayer | None = None
+        if self._spool:
+            self._spool_replayer = SpoolReplayer.from_settings(self._spool, get_activity_writer())
+            logger.info(f"Spooling to {self._spool.directory} while postgres is unavailable")
+        self._max_inflight_batches: int = settings.CONSUMER_ASYNC_MAX_INFLIGHT_BATCHES
+        self._inflight_limit = asyncio.Semaphore(self._max_inflight_batches)
+        self._inflight: set[asyncio.Task] = set()
+        logger.info(
+            f"Batching: {settings.CONSUMER_BATCHING} (max rows: {self._batch_max_rows}, "
+            f"max wait: {self._batch_max_wait}s, max in flight: {self._max_inflight_batches})"
+        )
+
+    @property
+    def prefetch_count(self) -> int:
+        # enough for a batch to fill up while the maximum number of batches are being written
+        return min(self._batch_max_rows * (self._max_inflight_batches + 1), MAX_PREFETCH_COUNT)
+
+    async def run(self) -> None:
+        deadletter_exchange_name = await self.declare_topology()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        if self._spool_replayer:
+            self._spool_replayer.start()
+
+        async with self._pg_conn_pool:
+            rmq_conn = await aio_pika.connect_robust(settings.RABBIT_DSN)
+            # declared again on every reconnection, as the sync consumer does
+            rmq_conn.reconnect_callbacks.add(self.redeclare_topology)
+            async with rmq_conn:
+                self._channel = channel = await rmq_conn.channel()
+                await channel.set_qos(prefetch_count=self.prefetch_count)
+                self._deadletter_exchange = await channel.get_exchange(deadletter_exchange_name, ensure=False)
+                queue = await channel.get_queue(self.queue_name, ensure=True)
+                consumer_tag = await queue.consume(self.on_message)
+                flusher = asyncio.create_task(self.flush_periodically())
+                pool_reporter = asyncio.create_task(self.report_pool_stats_periodically())
+                logger.info("Consuming from %s...", self.queue_name)
+
+                await stop.wait()
+
+                logger.info("Shutting down...")
+                await queue.cancel(consumer_tag)
+                flusher.cancel()
+                pool_reporter.cancel()
+                await self.shutdown()
+
+        if self._spool_replayer:
+            await asyncio.to_thread(self._spool_replayer.stop)
+
+    async def declare_topology(self) -> str:
+        def declare() -> str:
+            # on a connection of its own, the one it was given may have gone stale while consuming
+            with self._rmq_conn.clone() as rmq_conn:
+                return self._topology.declare(rmq_conn)
+
+        # kombu declares with blocking I/O, kept off the event loop
+        return await asyncio.to_thread(declare)
+
+    async def redeclare_topology(self, *_: object) -> None:
+        try:
+            await self.declare_topology()
+        except Exception:
+            logger.exception("Could not declare %s and its dead letter exchange again", self.queue_name)
+
+    async def shutdown(self) -> None:
+        self.flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._batch_max_wait / 2)
+            if self._batch.messages and self._batch.age() >= self._batch_max_wait:
+                self.flush()
+
+    async def report_pool_stats_periodically(self) -> None:
+        if settings.PG_POOL_STATS_INTERVAL_SECS <= 0:
+            return
+
+        while True:
+            await asyncio.sleep(settings.PG_POOL_STATS_INTERVAL_SECS)
+            report_pool_stats(self._pg_conn_pool)
+
+    async def on_message(self, message: "AbstractIncomingMessage") -> None:
+        started = time.perf_counter()
+        try:
+            body = loads(message.body, message.content_type, message.content_encoding, accept=ACCEPTED_CONTENT_TYPES)
+            activities = activities_from_body(body)
+        except Exception:
+            record_validation(duration=time.perf_counter() - started, valid=False)
+            logger.exception("Could not consume message %s\nBody:\n%s", message, message.body)
+            await message.reject()
+            return
+
+        record_validation(duration=time.perf_counter() - started, valid=True)
+        self._batch.add(message, activities)
+        if len(self._batch) >= self._batch_max_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._batch.messages:
+            return
+
+        batch, self._batch = self._batch, ActivityBatch()
+        task = asyncio.create_task(self.write_batch(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._batch_written)
+
+    def _batch_written(self, task: asyncio.Task) -> None:
+        self._inflight.discard(task)
+        # write_batch handles its errors, anything left would otherwise only be reported on garbage collection
+        if not task.cancelled() and (ex := task.exception()) is not None:
+            logger.error("Writing a batch failed", exc_info=ex)
+
+    async def persist(self, activities: list[dict]) -> tuple[set["UUID"], list[RejectedActivity]]:
+        if self._anonymise_forgotten:
+            record_forgotten_activities(await asyncio.to_thread(anonymise_forgotten, redis, activities))
+
+        started = time.perf_counter()
+        async with self._pg_conn_pool.connection() as conn:
+            connected = time.perf_counter()
+            async with conn.cursor() as cur, conn.transaction():
+                result = await awrite_isolating_failures(conn, cur, self._activity_writer, activities)
+                if self._rollups:
+                    # last statement of the transaction, so the rollup rows stay locked as briefly as possible
+                    await ActivityRollup.of_inserted(activities, result[0], conn.info.timezone).aflush(cur)
+                written = time.perf_counter()
+            committed = time.perf_counter()
+
+        record_persist_timings(
+            connection_wait=connected - started, write=written - connected, commit=committed - written
+        )
+        return result
+
+    async def dead_letter(
+        self, batch: ActivityBatch["AbstractIncomingMessage"], rejected: list[RejectedActivity]
+    ) -> None:
+        if not rejected:
+            return
+
+        if (exchange := self._deadletter_exchange) is None:
+            raise RuntimeError("Cannot dead-letter activities before the consumer is running")
+
+        for activity, error in rejected:
+            message = batch.message_for(activity)
+            logger.error("Dead-lettering activity %s from message %s: %s", activity["id"], message.delivery_tag, error)
+            content_type, content_encoding, body = dumps(activity_body(activity), serializer="json")
+            await exchange.publish(
+                aio_pika.Message(
+                    body.encode(content_encoding),
+                    content_type=content_type,
+                    content_encoding=content_encoding,
+                    headers={**dead_letter_headers(error)},
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key=message.routing_key or "",
+            )
+
+    async def adapt_batch_size(self, rows: int, latency: float | None) -> None:
+        """Lets the adaptive batch controller react to a written batch, latency is None when it failed"""
+        if self._batch_controller is None:
+            return
+
+        if latency is None:
+            changed = self._batch_controller.record_failure()
+        else:
+            changed = self._batch_controller.record_success(rows, latency)
+
+        if changed:
+            self._batch_max_rows = self._batch_controller.batch_rows
+            record_batch_rows_limit(self._batch_max_rows)
+            if self._channel is not None:
+                await self._channel.set_qos(prefetch_count=self.prefetch_count)
+
+    async def spool_batch(
+        self,
+        batch: ActivityBatch["AbstractIncomingMessage"],
+        activities: list[dict],
+        error: Exception,
+    ) -> bool:
+        """Spools the activities of a batch when postgres is unreachable, returns whether they were spooled"""
+        if self._spool is None or not is_connection_failure(error):
+            return False
+
+        try:
+            await asyncio.to_thread(self._spool.append, activities)
+        except (SpoolFullError, OSError) as ex:
+            logger.error("Could not spool %s activities: %s", len(activities), ex)
+            return False
+
+        logger.warning("Postgres unavailable (%s), spooled %s activities to disk", error, len(activities))
+        self._recent_ids.add(activity["id"] for activity in activities)
+        for message in batch.messages:
+            await message.ack()
+        record_consumed_batch(batch, [])
+        return True
+
+    async def requeue_batch(self, batch: ActivityBatch["AbstractIncomingMessage"]) -> None:
+        for message in batch.messages:
+            # already acked, or on a closed channel and redelivered by the broker anyway
+            with suppress(AMQPError, ChannelInvalidStateError):
+                await message.nack(requeue=True)
+        record_requeued_batch(batch)
+
+    async def write_batch(self, batch: ActivityBatch["AbstractIncomingMessage"]) -> None:
+        async with self._inflight_limit:
+            activities = self._recent_ids.filter_new(batch.activities)
+            started = time.perf_counter()
+            try:
+                inserted, rejected = await self.persist(activities) if activities else (set(), [])
+            except Exception as ex:
+                await self.adapt_batch_size(len(batch), None)
+                if await self.spool_batch(batch, activities, ex):
+                    return
+
+                logger.exception(
+                    "Problem when persiting data. Requeuing %s messages...", len(batch.messages), exc_info=ex
+                )
+                if isinstance(ex, RedisError):
+                    # as the sync consumer, holding its in flight slot so that no other batch is written meanwhile
+                    await asyncio.sleep(self._forgotten_retry_delay)
+                await self.requeue_batch(batch)
+                return
+
+            if activities:
+                await self.adapt_batch_size(len(batch), time.perf_counter() - started)
+
+            try:
+                await self.acknowledge_batch(batch, activities, inserted, rejected)
+            except Exception:
+                # the rest of the batch is committed by now, its persisted rows are skipped as duplicates once
+                # the batch is redelivered
+                logger.exception("Problem when acknowledging data. Requeuing %s messages...", len(batch.messages))
+                await self.requeue_batch(batch)
+
+    async def acknowledge_batch(
+        self,
+        batch: ActivityBatch["AbstractIncomingMessage"],
+        activities: list[dict],
+        inserted: set["UUID"],
+        rejected: list[RejectedActivity],
+    ) -> None:
+        await self.dead_letter(batch, rejected)
+        rejected_ids = {activity["id"] for activity, _ in rejected}
+        self._recent_ids.add(activity["id"] for activity in activities if activity["id"] not in rejected_ids)
+        for message in batch.messages:
+            await message.ack()
+        record_consumed_batch(batch, rejected)
+        record_dropped_duplicates(
+            cached=len(batch) - len(activities), database=len(activities) - len(inserted) - len(rejected)
+        )
+        logger.debug(
+            "Persisted %s of %s activity objects from %s messages, dead-lettered %s",
+            len(inserted),
+            len(batch),
+            len(batch.messages),
+            len(rejected),
+        )
@@ -0,0 +1,78 @@
+import logging
+
+from hubble.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveBatchController:
+    """
+    Adjusts the batch size limit, and with it the prefetch count, to how postgres is coping
+
+    The limit grows additively while full batches are persisted within the target latency and is cut
+    multiplicatively when a batch is slower than that or fails, so the consumer pulls fewer messages
+    from the broker as soon as writes slow down and recovers gradually once they speed up again.
+    """
+
+    def __init__(
+        self,
+        *,
+        min_rows: int,
+        max_rows: int,
+        target_latency: float,
+        increase_step: int,
+        decrease_factor: float,
+    ) -> None:
+        if not 0 < min_rows <= max_rows:
+            raise ValueError(f"Invalid batch size bounds: {min_rows} - {max_rows}")
+        if not 0 < decrease_factor < 1:
+            raise ValueError(f"Decrease factor must be between 0 and 1, got {decrease_factor}")
+
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.target_latency = target_latency
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.batch_rows = max_rows
+
+    @classmethod
+    def from_settings(cls) -> "AdaptiveBatchController":
+        return cls(
+            min_rows=settings.CONSUMER_BATCH_MIN_ROWS,
+            max_rows=settings.CONSUMER_BATCH_MAX_ROWS,
+            target_latency=settings.CONSUMER_TARGET_WRITE_LATENCY_MS / 1000,
+            increase_step=settings.CONSUMER_BATCH_ROWS_INCREASE_STEP,
+            decrease_factor=settings.CONSUMER_BATCH_ROWS_DECREASE_FACTOR,
+        )
+
+    def _set_batch_rows(self, batch_rows: int, reason: str) -> bool:
+        batch_rows = max(self.min_rows, min(batch_rows, self.max_rows))
+        if batch_rows == self.batch_rows:
+            return False
+
+        logger.log(
+            logging.WARNING if batch_rows < self.batch_rows else logging.INFO,
+            "Batch size limit changed from %s to %s rows (%s)",
+            self.batch_rows,
+            batch_rows,
+            reason,
+        )
+        self.batch_rows = batch_rows
+        return True
+
+    def record_success(self, rows: int, latency: float) -> bool:
+        """Records a persisted batch, returns whether the batch size limit changed"""
+        if latency > self.target_latency:
+            return self._set_batch_rows(
+                int(self.batch_rows * self.decrease_factor), f"took {latency:.3f}s to write {rows} rows"
+            )
+
+        # partial batches were flushed on their time limit, so more rows would not have helped
+        if rows >= self.batch_rows:
+            return self._set_batch_rows(self.batch_rows + self.increase_step, "writes within target latency")
+
+        return False
+
+    def record_failure(self) -> bool:
+        """Records a batch that could not be persisted, returns whether the batch size limit changed"""
+        return self._set_batch_rows(int(self.batch_rows * self.decrease_factor), "write failed")
@@ -1,23 +1,55 @@
 import logging
+import time
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 
 import psycopg
 
 from cosmos_message_lib.consumer import AbstractMessageConsumer
-from cosmos_message_lib.schemas import ActivitySchema
-from psycopg.types.json import Jsonb
-from psycopg_pool import ConnectionPool
+from kombu import Producer
+from redis import RedisError
 
-from hubble.config import settings
+from hubble.config import redis, settings
+from hubble.forgotten import anonymise_forgotten
+from hubble.messaging.activities import (
+    ActivityBatch,
+    activities_from_body,
+    activity_body,
+    dead_letter_headers,
+    prepare_for_insert,
+)
+from hubble.messaging.backpressure import AdaptiveBatchController
+from hubble.messaging.deduplication import RecentActivityIds
+from hubble.messaging.pool import connect, is_connection_failure, make_connection_pool, report_pool_stats
+from hubble.messaging.prometheus import (
+    record_batch_rows_limit,
+    record_consumed_batch,
+    record_dropped_duplicates,
+    record_forgotten_activities,
+    record_persist_timings,
+    record_requeued_batch,
+    record_validation,
+)
+from hubble.messaging.spool import SpoolFullError, SpoolReplayer, make_spool
+from hubble.messaging.topology import ActivityTopology
+from hubble.messaging.writers import RejectedActivity, get_activity_writer, write_isolating_failures
+from hubble.rollups import ActivityRollup
 
 if TYPE_CHECKING:
-    from kombu import Connection, Exchange
+    from collections.abc import Callable, Generator
+    from uuid import UUID
+
+    from kombu import Connection, Consumer, Exchange, Queue
     from kombu.message import Message
+    from kombu.transport.base import StdChannel
     from psycopg.connection import Connection as PGConn
+    from psycopg_pool import ConnectionPool
 
 logger = logging.getLogger(__name__)
 
+# maximum value accepted by basic.qos prefetch_count (unsigned short)
+MAX_PREFETCH_COUNT = 65535
+
 
 class ActivityConsumer(AbstractMessageConsumer):
     def __init__(
@@ -28,70 +60,256 @@ class ActivityConsumer(AbstractMessageConsumer):
         queue_name: str,
         routing_key: str,
     ) -> None:
-        self._pg_conn_pool: ConnectionPool | None = None
+        self._pg_conn_pool: "ConnectionPool | None" = None
         self._pg_pooling: bool = settings.PG_CONNECTION_POOLING
         logger.info(f"Connection pooling: {self._pg_pooling}")
+        self._activity_writer = get_activity_writer()
+        logger.info(f"Activity write engine: {self._activity_writer.name}")
         if self._pg_pooling:
-            self._pg_conn_pool = ConnectionPool(settings.PSYCOPG_URI, min_size=1, max_size=10)
+            self._pg_conn_pool = make_connection_pool(configure=self._activity_writer.prepare)
+        self._pool_stats_interval: float = settings.PG_POOL_STATS_INTERVAL_SECS
+        self._pool_stats_due_at = time.monotonic() + self._pool_stats_interval
+
+        self._rollups: bool = settings.ACTIVITY_ROLLUPS_ENABLED
+        self._anonymise_forgotten: bool = settings.CONSUMER_ANONYMISE_FORGOTTEN
+        self._forgotten_retry_delay: float = settings.CONSUMER_FORGOTTEN_RETRY_DELAY_SECS
+
+        self._batching: bool = settings.CONSUMER_BATCHING
+        self._batch_max_rows: int = settings.CONSUMER_BATCH_MAX_ROWS if self._batching else 1
+        self._batch_max_wait: float = settings.CONSUMER_BATCH_MAX_WAIT_MS / 1000
+        self._batch: ActivityBatch["Message"] = ActivityBatch()
+        self._batch_controller: AdaptiveBatchController | None = None
+        if self._batching and settings.CONSUMER_ADAPTIVE_BATCHING:
+            self._batch_controller = AdaptiveBatchController.from_settings()
+        self._consumers: list["Consumer"] = []
+        self._recent_ids = RecentActivityIds(settings.CONSUMER_RECENT_IDS_CACHE_SIZE)
+        self._spool = make_spool()
+        self._spool_replayer: SpoolReplayer | None = None
+        if self._spool:
+            self._spool_replayer = SpoolReplayer.from_settings(self._spool, get_activity_writer())
+            logger.info(f"Spooling to {self._spool.directory} while postgres is unavailable")
+        logger.info(f"Batching: {self._batching} (max rows: {self._batch_max_rows}, max wait: {self._batch_max_wait}s)")
+
+        super().__init__(rmq_conn, exchange, queue_name=queue_name, routing_key=routing_key)
+        # the same queues and exchanges as the async consumer, declared by get_consumers
+        self._topology = ActivityTopology(exchange, queue_name=queue_name, routing_key=routing_key)
+        self.queue = self._topology.consumed_queue
+
+    def get_consumers(self, make_consumer: "Callable[..., Consumer]", channel: "StdChannel") -> list["Consumer"]:
+        # on every (re)connection, so that the dead letter exchange exists before anything is dead-lettered to it
+        self._topology.declare(self.connection)
+        return super().get_consumers(make_consumer, channel)
 
-        super().__init__(rmq_conn, exchange, queue_name=queue_name, routing_key=routing_key, use_deadletter=True)
+    def deadletter_exchange(self, channel: "StdChannel") -> "Exchange":
+        return self._topology.deadletter_exchange(channel)
 
-    @staticmethod
-    def prepare_for_insert(val: ActivitySchema) -> dict:
-        payload = val.dict()
-        payload["data"] = Jsonb(payload["data"])
-        return payload
+    def deadletter_queue(self, channel: "StdChannel") -> "Queue":
+        return self._topology.deadletter_queue(channel)
+
+    prepare_for_insert = staticmethod(prepare_for_insert)
+    activities_from_body = staticmethod(activities_from_body)
 
     def get_pg_conn(self) -> "PGConn":
         if self._pg_conn_pool:
             return self._pg_conn_pool.getconn()
 
-        return psycopg.connect(settings.PSYCOPG_URI)
+        conn = connect()
+        try:
+            self._activity_writer.prepare(conn)
+        except psycopg.Error:
+            conn.close()
+            raise
+        return conn
+
+    def release_pg_conn(self, conn: "PGConn") -> None:
+        if self._pg_conn_pool:
+            self._pg_conn_pool.putconn(conn)
+        else:
+            conn.close()
+
+    def run(self, *args: Any, **kwargs: Any) -> None:  # noqa: ANN401
+        if self._spool_replayer:
+            self._spool_replayer.start()
+        try:
+            super().run(*args, **kwargs)
+        finally:
+            if self._spool_replayer:
+                self._spool_replayer.stop()
+
+    def consume(self, *args: Any, **kwargs: Any) -> "Generator":  # noqa: ANN401
+        # wake up from drain_events often enough to honour the batch time limit when the queue is quiet
+        if self._batching:
+            kwargs.setdefault("safety_interval", self._batch_max_wait)
+
+        return super().consume(*args, **kwargs)
+
+    def on_consume_ready(
+        self,
+        connection: "Connection",
+        channel: "StdChannel",
+        consumers: list["Consumer"],
+        **kwargs: Any,  # noqa: ANN401
+    ) -> None:
+        super().on_consume_ready(connection, channel, consumers, **kwargs)
+        if self._batching:
+            self._consumers = consumers
+            self.apply_prefetch_count()
+
+    def apply_prefetch_count(self) -> None:
+        # every message carries at least one row so this allows a batch to fill up before its time limit
+        prefetch_count = min(self._batch_max_rows, MAX_PREFETCH_COUNT)
+        for consumer in self._consumers:
+            consumer.qos(prefetch_count=prefetch_count)
+
+    def adapt_batch_size(self, rows: int, latency: float | None) -> None:
+        """Lets the adaptive batch controller react to a flush, latency is None when it failed"""
+        if self._batch_controller is None:
+            return
+
+        if latency is None:
+            changed = self._batch_controller.record_failure()
+        else:
+            changed = self._batch_controller.record_success(rows, latency)
+
+        if changed:
+            self._batch_max_rows = self._batch_controller.batch_rows
+            self.apply_prefetch_count()
+            record_batch_rows_limit(self._batch_max_rows)
+
+    def on_connection_revived(self) -> None:
+        super().on_connection_revived()
+        if self._batch.messages:
+            # unacked deliveries from a dead channel will be redelivered by the broker
+            logger.warning("Discarding %s unacknowledged messages from a lost connection", len(self._batch.messages))
+            self._batch = ActivityBatch()
+
+    def on_iteration(self) -> None:
+        super().on_iteration()
+        if self._pg_conn_pool and self._pool_stats_interval > 0 and time.monotonic() >= self._pool_stats_due_at:
+            self._pool_stats_due_at = time.monotonic() + self._pool_stats_interval
+            report_pool_stats(self._pg_conn_pool)
+        if self._batch.messages and self._batch.age() >= self._batch_max_wait:
+            self.flush()
+
+    def on_consume_end(self, connection: "Connection", channel: "StdChannel") -> None:
+        self.flush()
+        super().on_consume_end(connection, channel)
 
     def on_message(self, body: dict | list[dict], message: "Message") -> None:
-        activities: list[ActivitySchema] = []
+        started = time.perf_counter()
         try:
-            if isinstance(body, list):
-                activities = [self.prepare_for_insert(ActivitySchema(**data)) for data in body]
-            else:
-                activities = [self.prepare_for_insert(ActivitySchema(**body))]
+            activities = self.activities_from_body(body)
         except Exception:
+            record_validation(duration=time.perf_counter() - started, valid=False)
             logger.exception("Could not consume message %s\nBody:\n%s", message, body)
             message.reject()
-        else:
-            conn = self.get_pg_conn()
-            try:
-                with conn.cursor() as cur:
-                    cur.executemany(
-                        "INSERT INTO activity "
-                        "VALUES "
-                        "("
-                        "%(id)s, "
-                        "%(type)s, "
-                        "%(datetime)s, "
-                        "%(underlying_datetime)s, "
-                        "%(summary)s, "
-                        "%(reasons)s, "
-                        "%(activity_identifier)s, "
-                        "%(user_id)s, "
-                        "%(associated_value)s, "
-                        "%(retailer)s, "
-                        "%(campaigns)s, "
-                        "%(data)s"
-                        ");",
-                        activities,
-                    )
-
-            except psycopg.Error as ex:
-                logger.exception("Problem when persiting data. Requeuing...", exc_info=ex)
-                conn.rollback()
-                message.requeue()
-            else:
-                conn.commit()
-                message.ack()
-                logger.debug("Persisted %s activity objects", len(activities))
-            finally:
-                if self._pg_conn_pool:
-                    self._pg_conn_pool.putconn(conn)
-                else:
-                    conn.close()
+            return
+
+        record_validation(duration=time.perf_counter() - started, valid=True)
+
+        self._batch.add(message, activities)
+        if len(self._batch) >= self._batch_max_rows or self._batch.age() >= self._batch_max_wait:
+            self.flush()
+
+    def persist(self, activities: list[dict]) -> tuple[set["UUID"], list[RejectedActivity]]:
+        if self._anonymise_forgotten:
+            record_forgotten_activities(anonymise_forgotten(redis, activities))
+
+        started = time.perf_counter()
+        conn = self.get_pg_conn()
+        connected = time.perf_counter()
+        try:
+            with conn.cursor() as cur, conn.transaction():
+                result = write_isolating_failures(conn, cur, self._activity_writer, activities)
+                if self._rollups:
+                    # last statement of the transaction, so the rollup rows stay locked as briefly as possible
+                    ActivityRollup.of_inserted(activities, result[0], conn.info.timezone).flush(cur)
+                written = time.perf_counter()
+            committed = time.perf_counter()
+        finally:
+            self.release_pg_conn(conn)
+
+        record_persist_timings(
+            connection_wait=connected - started, write=written - connected, commit=committed - written
+        )
+        return result
+
+    def dead_letter(self, batch: ActivityBatch["Message"], rejected: list[RejectedActivity]) -> None:
+        for activity, error in rejected:
+            message = batch.message_for(activity)
+            logger.error("Dead-lettering activity %s from message %s: %s", activity["id"], message.delivery_tag, error)
+            Producer(message.channel).publish(
+                activity_body(activity),
+                exchange=self.deadletter_exchange(message.channel),
+                routing_key=message.delivery_info.get("routing_key", ""),
+                serializer="json",
+                headers=dead_letter_headers(error),
+            )
+
+    def spool_batch(
+        self, batch: ActivityBatch["Message"], activities: list[dict], error: psycopg.Error | RedisError
+    ) -> bool:
+        """Spools the activities of a batch when postgres is unreachable, returns whether they were spooled"""
+        if self._spool is None or not is_connection_failure(error):
+            return False
+
+        try:
+            self._spool.append(activities)
+        except (SpoolFullError, OSError) as ex:
+            logger.error("Could not spool %s activities: %s", len(activities), ex)
+            return False
+
+        logger.warning("Postgres unavailable (%s), spooled %s activities to disk", error, len(activities))
+        self._recent_ids.add(activity["id"] for activity in activities)
+        batch.messages[-1].ack(multiple=True)
+        record_consumed_batch(batch, [])
+        return True
+
+    def requeue_batch(self, batch: ActivityBatch["Message"], error: psycopg.Error | RedisError) -> None:
+        if isinstance(error, RedisError):
+            # activities of forgotten account holders cannot be told apart, nothing is written until redis is
+            # back. Redelivered straight away, the batch would fail again as fast as the broker can send it
+            time.sleep(self._forgotten_retry_delay)
+        for message in batch.messages:
+            message.requeue()
+        record_requeued_batch(batch)
+
+    def flush(self) -> None:
+        if not self._batch.messages:
+            return
+
+        batch, self._batch = self._batch, ActivityBatch()
+        activities = self._recent_ids.filter_new(batch.activities)
+        started = time.perf_counter()
+        try:
+            inserted, rejected = self.persist(activities) if activities else (set(), [])
+        except (psycopg.Error, RedisError) as ex:
+            self.adapt_batch_size(len(batch), None)
+            if self.spool_batch(batch, activities, ex):
+                return
+
+            logger.exception("Problem when persiting data. Requeuing %s messages...", len(batch.messages), exc_info=ex)
+            self.requeue_batch(batch, ex)
+            return
+
+        if activities:
+            self.adapt_batch_size(len(batch), time.perf_counter() - started)
+
+        # the rest of the batch is committed by now, if publishing fails the whole batch is redelivered
+        # and its persisted rows are skipped as duplicates
+        self.dead_letter(batch, rejected)
+        rejected_ids = {activity["id"] for activity, _ in rejected}
+        self._recent_ids.add(activity["id"] for activity in activities if activity["id"] not in rejected_ids)
+        # deliveries on a channel are acked in order, so acking the last one acks the whole batch
+        batch.messages[-1].ack(multiple=True)
+        record_consumed_batch(batch, rejected)
+        record_dropped_duplicates(
+            cached=len(batch) - len(activities), database=len(activities) - len(inserted) - len(rejected)
+        )
+        logger.debug(
+            "Persisted %s of %s activity objects from %s messages, dead-lettered %s",
+            len(inserted),
+            len(batch),
+            len(batch.messages),
+            len(rejected),
+        )
@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from collections.abc import Iterable
+
+
+class RecentActivityIds:
+    """
+    Bounded LRU of the ids of recently persisted activities
+
+    Used to drop redelivered activities before they reach postgres, the database still skips any
+    activity that is not, or no longer, in here and conflicts on ACTIVITY_CONFLICT_COLUMNS, its id and datetime
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._ids: OrderedDict[str, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, activity_id: object) -> bool:
+        return str(activity_id) in self._ids
+
+    def add(self, activity_ids: Iterable[object]) -> None:
+        if self.max_size <= 0:
+            return
+
+        for activity_id in map(str, activity_ids):
+            self._ids[activity_id] = None
+            self._ids.move_to_end(activity_id)
+
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def filter_new(self, activities: list[dict]) -> list[dict]:
+        """Returns the activities that have not been persisted recently, dropping repeated ids within the list"""
+        seen: set[str] = set()
+        new_activities: list[dict] = []
+        for activity in activities:
+            activity_id = str(activity["id"])
+            if activity_id in self._ids:
+                self._ids.move_to_end(activity_id)
+            elif activity_id not in seen:
+                seen.add(activity_id)
+                new_activities.append(activity)
+
+        return new_activities
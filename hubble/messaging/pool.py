@@ -0,0 +1,81 @@
+import logging
+
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+import psycopg
+
+from psycopg_pool import AsyncConnectionPool, ConnectionPool, PoolClosed, PoolTimeout, TooManyRequests
+
+from hubble.config import settings
+from hubble.messaging.prometheus import record_pg_pool_stats
+
+logger = logging.getLogger(__name__)
+
+POOL_NAME = "activity-consumer"
+CONNECT_KWARGS: dict[str, Any] = {"application_name": "hubble", "prepare_threshold": settings.PG_PREPARE_THRESHOLD}
+# besides the connection exceptions of class 08, the server ending its connections: admin_shutdown, crash_shutdown
+# and cannot_connect_now
+CONNECTION_LOST_SQLSTATES = frozenset({"57P01", "57P02", "57P03"})
+
+
+def _pool_kwargs() -> dict[str, Any]:
+    return {
+        "kwargs": CONNECT_KWARGS,
+        "min_size": settings.PG_POOL_MIN_SIZE,
+        "max_size": settings.PG_POOL_MAX_SIZE,
+        "max_idle": settings.PG_POOL_MAX_IDLE_SECS,
+        "max_lifetime": settings.PG_POOL_MAX_LIFETIME_SECS,
+        "timeout": settings.PG_POOL_TIMEOUT_SECS,
+        "name": POOL_NAME,
+    }
+
+
+def connect() -> psycopg.Connection:
+    return psycopg.connect(settings.PSYCOPG_URI, **CONNECT_KWARGS)
+
+
+def make_connection_pool(configure: Callable[[psycopg.Connection], None] | None = None) -> ConnectionPool:
+    """configure is called with every new connection of the pool, e.g. ActivityWriter.prepare"""
+    check = ConnectionPool.check_connection if settings.PG_POOL_CHECK_CONNECTIONS else None
+    return ConnectionPool(settings.PSYCOPG_URI, check=check, configure=configure, **_pool_kwargs())
+
+
+def make_async_connection_pool(
+    configure: Callable[[psycopg.AsyncConnection], Awaitable[None]] | None = None
+) -> AsyncConnectionPool:
+    check = AsyncConnectionPool.check_connection if settings.PG_POOL_CHECK_CONNECTIONS else None
+    return AsyncConnectionPool(settings.PSYCOPG_URI, check=check, configure=configure, open=False, **_pool_kwargs())
+
+
+def is_connection_failure(error: BaseException) -> bool:
+    """
+    Whether error means postgres is unreachable, a connection that could not be made or was lost, rather than a
+    statement failing on a live connection (a cancelled query, a lock timeout) or the pool running out of connections
+    """
+    if not isinstance(error, psycopg.OperationalError) or isinstance(error, PoolTimeout | PoolClosed | TooManyRequests):
+        return False
+
+    # errors raised by libpq, such as a refused connection or one closed unexpectedly, have no sqlstate
+    return error.sqlstate is None or error.sqlstate.startswith("08") or error.sqlstate in CONNECTION_LOST_SQLSTATES
+
+
+def report_pool_stats(pool: ConnectionPool | AsyncConnectionPool) -> None:
+    """Logs and records the pool's gauges and the counters accumulated since the previous report"""
+    stats = pool.pop_stats()
+    level = logging.WARNING if stats.get("requests_waiting") or stats.get("requests_errors") else logging.INFO
+    logger.log(
+        level,
+        "Postgres pool %s: %s/%s connections in use, %s clients waiting, %s requests (%s errors, %sms waiting), "
+        "%s connection errors, %s connections lost",
+        pool.name,
+        stats["pool_size"] - stats["pool_available"],
+        stats["pool_size"],
+        stats.get("requests_waiting", 0),
+        stats.get("requests_num", 0),
+        stats.get("requests_errors", 0),
+        stats.get("requests_wait_ms", 0),
+        stats.get("connections_errors", 0),
+        stats.get("connections_lost", 0),
+    )
+    record_pg_pool_stats(stats)
@@ -0,0 +1,226 @@
+from collections import Counter as Tally
+from typing import TYPE_CHECKING
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from hubble.config import settings
+from hubble.tasks.prometheus import METRIC_NAME_PREFIX
+
+if TYPE_CHECKING:
+    from hubble.messaging.activities import ActivityBatch
+    from hubble.messaging.writers import RejectedActivity
+
+BATCH_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+VALIDATION_TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+consumer_worker_restarts_total = Counter(
+    name=f"{METRIC_NAME_PREFIX}consumer_worker_restarts_total",
+    documentation="Counter for activity consumer worker processes restarted by the supervisor.",
+    labelnames=("app",),
+)
+
+activities_duplicates_dropped_total = Counter(
+    name=f"{METRIC_NAME_PREFIX}activities_duplicates_dropped_total",
+    documentation="Counter for redelivered activities that were not inserted again.",
+    labelnames=("app", "stage"),
+)
+
+activity_messages_total = Counter(
+    name=f"{METRIC_NAME_PREFIX}activity_messages_total",
+    documentation="Counter for activity messages consumed, rejected as invalid or requeued.",
+    labelnames=("app", "outcome"),
+)
+
+activity_rows_total = Counter(
+    name=f"{METRIC_NAME_PREFIX}activity_rows_total",
+    documentation="Counter for activity rows consumed, dead-lettered as rejected by postgres or requeued.",
+    labelnames=("app", "outcome"),
+)
+
+activities_consumed_total = Counter(
+    name=f"{METRIC_NAME_PREFIX}activities_consumed_total",
+    documentation="Counter for activity rows consumed per retailer and activity type.",
+    labelnames=("app", "retailer", "activity_type"),
+)
+
+activity_batch_messages = Histogram(
+    name=f"{METRIC_NAME_PREFIX}activity_batch_messages",
+    documentation="Number of messages in each activity batch flushed to postgres",
+    labelnames=("app",),
+    buckets=BATCH_SIZE_BUCKETS,
+)
+
+activity_batch_rows = Histogram(
+    name=f"{METRIC_NAME_PREFIX}activity_batch_rows",
+    documentation="Number of rows in each activity batch flushed to postgres",
+    labelnames=("app",),
+    buckets=BATCH_SIZE_BUCKETS,
+)
+
+activity_validation_time = Histogram(
+    name=f"{METRIC_NAME_PREFIX}activity_validation_time",
+    documentation="Time taken to validate the activities of a message",
+    labelnames=("app",),
+    buckets=VALIDATION_TIME_BUCKETS,
+)
+
+activity_pg_connection_wait_time = Histogram(
+    name=f"{METRIC_NAME_PREFIX}activity_pg_connection_wait_time",
+    documentation="Time taken to check out a postgres connection from the pool",
+    labelnames=("app",),
+)
+
+activity_write_time = Histogram(
+    name=f"{METRIC_NAME_PREFIX}activity_write_time",
+    documentation="Time taken to write an activity batch, before committing it",
+    labelnames=("app",),
+)
+
+activity_commit_time = Histogram(
+    name=f"{METRIC_NAME_PREFIX}activity_commit_time",
+    documentation="Time taken to commit an activity batch",
+    labelnames=("app",),
+)
+
+activity_batch_rows_limit = Gauge(
+    name=f"{METRIC_NAME_PREFIX}activity_batch_rows_limit",
+    documentation="Current batch size limit of an adaptive activity consumer",
+    labelnames=("app",),
+    multiprocess_mode="liveall",
+)
+
+pg_pool_connections = Gauge(
+    name=f"{METRIC_NAME_PREFIX}pg_pool_connections",
+    documentation="Connections held by the activity consumer postgres pool",
+    labelnames=("app", "state"),
+    multiprocess_mode="livesum",
+)
+
+pg_pool_requests_waiting = Gauge(
+    name=f"{METRIC_NAME_PREFIX}pg_pool_requests_waiting",
+    documentation="Clients waiting for a connection from the activity consumer postgres pool",
+    labelnames=("app",),
+    multiprocess_mode="livesum",
+)
+
+pg_pool_errors_total = Counter(
+    name=f"{METRIC_NAME_PREFIX}pg_pool_errors_total",
+    documentation="Counter for activity consumer postgres pool errors.",
+    labelnames=("app", "error"),
+)
+
+activity_spool_bytes = Gauge(
+    name=f"{METRIC_NAME_PREFIX}activity_spool_bytes",
+    documentation="Size of the activities spooled to disk while postgres was unavailable",
+    labelnames=("app",),
+    multiprocess_mode="livesum",
+)
+
+activity_spool_rows_total = Counter(
+    name=f"{METRIC_NAME_PREFIX}activity_spool_rows_total",
+    documentation="Counter for activity rows spooled to disk, replayed to postgres or rejected while replaying.",
+    labelnames=("app", "operation"),
+)
+
+activities_forgotten_anonymised_total = Counter(
+    name=f"{METRIC_NAME_PREFIX}activities_forgotten_anonymised_total",
+    documentation="Counter for consumed activities of forgotten account holders hashed before they were written.",
+    labelnames=("app",),
+)
+
+# psycopg_pool stats counting errors, reset by pop_stats
+PG_POOL_ERROR_STATS = ("requests_errors", "returns_bad", "connections_errors", "connections_lost")
+
+
+def record_dropped_duplicates(*, cached: int, database: int) -> None:
+    if not settings.ACTIVATE_CONSUMER_METRICS:
+        return
+
+    for stage, count in (("cache", cached), ("database", database)):
+        if count:
+            activities_duplicates_dropped_total.labels(app=settings.PROJECT_NAME, stage=stage).inc(count)
+
+
+def record_validation(*, duration: float, valid: bool) -> None:
+    if not settings.ACTIVATE_CONSUMER_METRICS:
+        return
+
+    activity_validation_time.labels(app=settings.PROJECT_NAME).observe(duration)
+    if not valid:
+        activity_messages_total.labels(app=settings.PROJECT_NAME, outcome="rejected").inc()
+
+
+def record_persist_timings(*, connection_wait: float, write: float, commit: float) -> None:
+    if not settings.ACTIVATE_CONSUMER_METRICS:
+        return
+
+    activity_pg_connection_wait_time.labels(app=settings.PROJECT_NAME).observe(connection_wait)
+    activity_write_time.labels(app=settings.PROJECT_NAME).observe(write)
+    activity_commit_time.labels(app=settings.PROJECT_NAME).observe(commit)
+
+
+def record_batch_rows_limit(rows: int) -> None:
+    if settings.ACTIVATE_CONSUMER_METRICS:
+        activity_batch_rows_limit.labels(app=settings.PROJECT_NAME).set(rows)
+
+
+def record_pg_pool_stats(stats: dict[str, int]) -> None:
+    if not settings.ACTIVATE_CONSUMER_METRICS:
+        return
+
+    in_use = stats["pool_size"] - stats["pool_available"]
+    pg_pool_connections.labels(app=settings.PROJECT_NAME, state="in_use").set(in_use)
+    pg_pool_connections.labels(app=settings.PROJECT_NAME, state="idle").set(stats["pool_available"])
+    pg_pool_requests_waiting.labels(app=settings.PROJECT_NAME).set(stats.get("requests_waiting", 0))
+    for error in PG_POOL_ERROR_STATS:
+        if count := stats.get(error):
+            pg_pool_errors_total.labels(app=settings.PROJECT_NAME, error=error).inc(count)
+
+
+def record_spool_size(size: int) -> None:
+    if settings.ACTIVATE_CONSUMER_METRICS:
+        activity_spool_bytes.labels(app=settings.PROJECT_NAME).set(size)
+
+
+def record_spooled_rows(operation: str, rows: int) -> None:
+    if settings.ACTIVATE_CONSUMER_METRICS and rows:
+        activity_spool_rows_total.labels(app=settings.PROJECT_NAME, operation=operation).inc(rows)
+
+
+def record_forgotten_activities(rows: int) -> None:
+    if settings.ACTIVATE_CONSUMER_METRICS and rows:
+        activities_forgotten_anonymised_total.labels(app=settings.PROJECT_NAME).inc(rows)
+
+
+def _record_batch_size(batch: "ActivityBatch") -> None:
+    activity_batch_messages.labels(app=settings.PROJECT_NAME).observe(len(batch.messages))
+    activity_batch_rows.labels(app=settings.PROJECT_NAME).observe(len(batch))
+
+
+def record_requeued_batch(batch: "ActivityBatch") -> None:
+    if not settings.ACTIVATE_CONSUMER_METRICS:
+        return
+
+    _record_batch_size(batch)
+    activity_messages_total.labels(app=settings.PROJECT_NAME, outcome="requeued").inc(len(batch.messages))
+    activity_rows_total.labels(app=settings.PROJECT_NAME, outcome="requeued").inc(len(batch))
+
+
+def record_consumed_batch(batch: "ActivityBatch", rejected: list["RejectedActivity"]) -> None:
+    """Records a batch whose messages were acked, rejected rows were dead-lettered and the rest committed"""
+    if not settings.ACTIVATE_CONSUMER_METRICS:
+        return
+
+    _record_batch_size(batch)
+    activity_messages_total.labels(app=settings.PROJECT_NAME, outcome="consumed").inc(len(batch.messages))
+    activity_rows_total.labels(app=settings.PROJECT_NAME, outcome="consumed").inc(len(batch) - len(rejected))
+    if rejected:
+        activity_rows_total.labels(app=settings.PROJECT_NAME, outcome="rejected").inc(len(rejected))
+
+    rejected_ids = {activity["id"] for activity, _ in rejected}
+    consumed = Tally(
+        (activity["retailer"], activity["type"]) for activity in batch.activities if activity["id"] not in rejected_ids
+    )
+    for (retailer, activity_type), count in consumed.items():
+        labels = {"app": settings.PROJECT_NAME, "retailer": retailer, "activity_type": activity_type}
+        activities_consumed_total.labels(**labels).inc(count)
@@ -0,0 +1,242 @@
+import fcntl
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import zlib
+
+from itertools import islice
+from pathlib import Path
+from typing import IO, TYPE_CHECKING
+
+import psycopg
+
+from kombu.serialization import dumps, loads
+
+from hubble.config import settings
+from hubble.messaging.activities import activity_body, validate_activity
+from hubble.messaging.pool import connect
+from hubble.messaging.prometheus import record_spool_size, record_spooled_rows
+from hubble.messaging.writers import write_isolating_failures
+from hubble.rollups import ActivityRollup
+
+if TYPE_CHECKING:
+    from collections.abc import Generator, Iterable
+
+    from hubble.messaging.writers import ActivityWriter
+
+logger = logging.getLogger(__name__)
+
+# every record is prefixed with the length and crc32 of its payload, so a torn write at the end of a
+# segment is detected and skipped on replay
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_GLOB = "segment-*.log"
+
+
+class SpoolFullError(Exception):
+    pass
+
+
+class ActivitySpool:
+    """
+    Append-only log of activities, split into segment files, that could not be written to postgres
+
+    Each append is flushed and fsynced before returning, so the messages the activities came from can be
+    acknowledged. Segments are replayed oldest first and deleted once their activities are in postgres.
+    A lock file stops two processes from using the same directory.
+    """
+
+    def __init__(self, directory: Path, *, max_bytes: int, segment_max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_max_bytes = segment_max_bytes
+        directory.mkdir(parents=True, exist_ok=True)
+        self._lock_file = (directory / "lock").open("w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError as ex:
+            raise RuntimeError(f"Spool directory {directory} is in use by another process") from ex
+
+        self._lock = threading.Lock()
+        self._segments = sorted(directory.glob(SEGMENT_GLOB))
+        self._size = sum(segment.stat().st_size for segment in self._segments)
+        # segment being appended to, always the last one in _segments when set
+        self._current: IO[bytes] | None = None
+        record_spool_size(self._size)
+        if self._segments:
+            logger.warning("Found %s spooled bytes in %s segments in %s", self._size, len(self._segments), directory)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _encode(activity: dict) -> bytes:
+        _, content_encoding, payload = dumps(activity_body(activity), serializer="json")
+        data = payload.encode(content_encoding)
+        return RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+    def _open_segment(self) -> IO[bytes]:
+        if self._current is not None:
+            self._current.close()
+
+        sequence = int(self._segments[-1].stem.removeprefix("segment-")) + 1 if self._segments else 0
+        path = self.directory / f"segment-{sequence:020d}.log"
+        self._current = path.open("ab")
+        self._segments.append(path)
+        # make the new directory entry durable as well as the records written to it
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        return self._current
+
+    def append(self, activities: list[dict]) -> None:
+        data = b"".join(map(self._encode, activities))
+        with self._lock:
+            if self._size + len(data) > self.max_bytes:
+                record_spooled_rows("overflowed", len(activities))
+                raise SpoolFullError(f"Spooling {len(data)} bytes would exceed the {self.max_bytes} bytes limit")
+
+            segment = self._current
+            if segment is None or (segment.tell() and segment.tell() + len(data) > self.segment_max_bytes):
+                segment = self._open_segment()
+
+            segment.write(data)
+            segment.flush()
+            os.fsync(segment.fileno())
+            self._size += len(data)
+            record_spool_size(self._size)
+
+        record_spooled_rows("spooled", len(activities))
+
+    def take_segment(self) -> Path | None:
+        """Returns the oldest segment, closing it first if activities are still being appended to it"""
+        with self._lock:
+            if not self._segments:
+                return None
+
+            if self._current is not None and len(self._segments) == 1:
+                self._current.close()
+                self._current = None
+
+            return self._segments[0]
+
+    def release_segment(self, segment: Path) -> None:
+        """Deletes a segment once all of its activities have been replayed"""
+        with self._lock:
+            self._size -= segment.stat().st_size
+            segment.unlink()
+            self._segments.remove(segment)
+            record_spool_size(self._size)
+
+    @staticmethod
+    def read_segment(segment: Path) -> "Generator[dict, None, None]":
+        with segment.open("rb") as f:
+            while header := f.read(RECORD_HEADER.size):
+                length, crc = RECORD_HEADER.unpack(header) if len(header) == RECORD_HEADER.size else (0, 0)
+                data = f.read(length)
+                if not length or len(data) < length or zlib.crc32(data) != crc:
+                    logger.error("Skipping the incomplete record at offset %s of %s", f.tell(), segment)
+                    return
+
+                yield validate_activity(loads(data, "application/json", "utf-8"))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._current is not None:
+                self._current.close()
+                self._current = None
+
+        self._lock_file.close()
+
+
+def make_spool() -> ActivitySpool | None:
+    if not settings.CONSUMER_SPOOL_DIR:
+        return None
+
+    # supervised workers keep their process name across restarts, so each one picks up its own segments
+    return ActivitySpool(
+        Path(settings.CONSUMER_SPOOL_DIR) / multiprocessing.current_process().name,
+        max_bytes=settings.CONSUMER_SPOOL_MAX_BYTES,
+        segment_max_bytes=settings.CONSUMER_SPOOL_SEGMENT_MAX_BYTES,
+    )
+
+
+def _chunks(activities: "Iterable[dict]", size: int) -> "Generator[list[dict], None, None]":
+    iterator = iter(activities)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class SpoolReplayer(threading.Thread):
+    """Drains spooled segments into postgres in large batches whenever it can connect to it"""
+
+    def __init__(
+        self,
+        spool: ActivitySpool,
+        writer: "ActivityWriter",
+        *,
+        batch_rows: int,
+        interval: float,
+        rollups: bool = False,
+    ) -> None:
+        super().__init__(name="activity-spool-replayer", daemon=True)
+        self.spool = spool
+        self.writer = writer
+        self.batch_rows = batch_rows
+        self.interval = interval
+        self.rollups = rollups
+        self._stopping = threading.Event()
+
+    @classmethod
+    def from_settings(cls, spool: ActivitySpool, writer: "ActivityWriter") -> "SpoolReplayer":
+        return cls(
+            spool,
+            writer,
+            batch_rows=settings.CONSUMER_SPOOL_REPLAY_BATCH_ROWS,
+            interval=settings.CONSUMER_SPOOL_REPLAY_INTERVAL_SECS,
+            rollups=settings.ACTIVITY_ROLLUPS_ENABLED,
+        )
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self) -> None:
+        while not self._stopping.wait(self.interval):
+            if not self.spool.size:
+                continue
+
+            try:
+                self.replay()
+            except psycopg.OperationalError as ex:
+                logger.warning("Cannot replay spooled activities yet: %s", ex)
+            except Exception:
+                logger.exception("Failed to replay spooled activities")
+
+    def replay_segment(self, conn: psycopg.Connection, segment: Path) -> None:
+        for activities in _chunks(self.spool.read_segment(segment), self.batch_rows):
+            with conn.transaction(), conn.cursor() as cur:
+                inserted, rejected = write_isolating_failures(conn, cur, self.writer, activities)
+                if self.rollups:
+                    ActivityRollup.of_inserted(activities, inserted, conn.info.timezone).flush(cur)
+
+            for activity, error in rejected:
+                logger.error("Dropping spooled activity rejected by postgres: %s\nBody:\n%s", error, activity)
+
+            record_spooled_rows("replayed", len(activities) - len(rejected))
+            record_spooled_rows("rejected", len(rejected))
+
+    def replay(self) -> None:
+        # rows are inserted with ON CONFLICT DO NOTHING, so a segment interrupted half way is safe to replay again
+        with connect() as conn:
+            self.writer.prepare(conn)
+            while not self._stopping.is_set() and (segment := self.spool.take_segment()) is not None:
+                logger.info("Replaying spooled activities from %s...", segment)
+                self.replay_segment(conn, segment)
+                self.spool.release_segment(segment)
@@ -0,0 +1,124 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+from multiprocessing.connection import wait
+from typing import TYPE_CHECKING
+
+from prometheus_client import multiprocess
+
+from hubble.config import settings
+from hubble.messaging.prometheus import consumer_worker_restarts_total
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from multiprocessing.context import ForkProcess
+    from types import FrameType
+
+logger = logging.getLogger(__name__)
+
+# how often the supervisor wakes up to restart workers when none of them exits
+POLL_INTERVAL_SECS = 1.0
+
+
+def _run_worker(target: "Callable[[int], None]", slot: int) -> None:
+    # the supervisor's signal handlers are inherited through fork, workers set up their own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    target(slot)
+
+
+class ConsumerSupervisor:
+    """
+    Runs `target(slot)` in `workers` forked processes, restarting any that exits until asked to stop
+
+    Slots go from 0 to workers - 1 and a restarted worker keeps the slot of the one it replaces.
+
+    On SIGTERM or SIGINT each worker is sent a SIGTERM and given shutdown_timeout seconds to finish
+    its current batch before being killed.
+    """
+
+    def __init__(
+        self,
+        target: "Callable[[int], None]",
+        *,
+        workers: int,
+        restart_delay: float,
+        shutdown_timeout: float,
+        metrics: bool = False,
+    ) -> None:
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.metrics = metrics
+        self._ctx = multiprocessing.get_context("fork")
+        self._processes: dict[int, "ForkProcess"] = {}
+        self._started_at: dict[int, float] = {}
+        self._stopping = False
+
+    def _on_signal(self, signum: int, frame: "FrameType | None") -> None:  # noqa: ARG002
+        logger.info("Received %s, stopping %s workers...", signal.Signals(signum).name, len(self._processes))
+        self._stopping = True
+
+    def _start_worker(self, slot: int) -> None:
+        process = self._ctx.Process(target=_run_worker, args=(self.target, slot), name=f"activity-consumer-{slot}")
+        process.start()
+        self._processes[slot] = process
+        self._started_at[slot] = time.monotonic()
+        logger.info("Started worker %s (pid: %s)", slot, process.pid)
+
+    def _reap_worker(self, slot: int) -> None:
+        process = self._processes.pop(slot)
+        process.join()
+        logger.log(
+            logging.INFO if self._stopping else logging.WARNING,
+            "Worker %s (pid: %s) exited with code %s",
+            slot,
+            process.pid,
+            process.exitcode,
+        )
+        if self.metrics and process.pid is not None:
+            multiprocess.mark_process_dead(process.pid)
+
+    def _restart_due(self, slot: int) -> bool:
+        # avoid a hot restart loop when workers crash straight away, e.g. while postgres is unreachable
+        return time.monotonic() - self._started_at.get(slot, 0.0) >= self.restart_delay
+
+    def _supervise(self) -> None:
+        for slot in [slot for slot, process in self._processes.items() if not process.is_alive()]:
+            self._reap_worker(slot)
+
+        for slot in range(self.workers):
+            if slot not in self._processes and not self._stopping and self._restart_due(slot):
+                if self.metrics:
+                    consumer_worker_restarts_total.labels(app=settings.PROJECT_NAME).inc()
+                self._start_worker(slot)
+
+    def _shutdown(self) -> None:
+        for process in self._processes.values():
+            if process.is_alive() and process.pid is not None:
+                process.terminate()
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        for slot, process in list(self._processes.items()):
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.error("Worker %s (pid: %s) did not stop in time, killing it", slot, process.pid)
+                process.kill()
+            self._reap_worker(slot)
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        for slot in range(self.workers):
+            self._start_worker(slot)
+
+        while not self._stopping:
+            wait([process.sentinel for process in self._processes.values()], timeout=POLL_INTERVAL_SECS)
+            self._supervise()
+
+        self._shutdown()
+        logger.info("All workers stopped")
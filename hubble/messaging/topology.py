@@ -0,0 +1,155 @@
+import logging
+
+from typing import TYPE_CHECKING
+
+from amqp.exceptions import PreconditionFailed
+from kombu import Exchange, Producer, Queue
+from kombu.exceptions import ChannelError
+
+from hubble.config import settings
+
+if TYPE_CHECKING:
+    from kombu import Connection
+
+logger = logging.getLogger(__name__)
+
+# every partition queue is bound with the same weight, so each one gets an equal share of the hash space
+PARTITION_BINDING_WEIGHT = "1"
+
+
+class ActivityTopology:
+    """
+    The queues and exchanges activities are consumed from, declared with kombu by both consumers
+
+    queue_name is bound to exchange with routing_key. Its dead letter exchange takes the messages RabbitMQ
+    dead-letters from it as well as the activities the consumers dead-letter, whatever their routing key, and
+    routes them to its dead letter queue.
+    """
+
+    def __init__(self, exchange: Exchange, *, queue_name: str, routing_key: str) -> None:
+        self.exchange = exchange
+        self.deadletter_exchange = Exchange(f"{queue_name}-dlx", type="topic", durable=True)
+        self.deadletter_queue = Queue(
+            f"{queue_name}-dlq", exchange=self.deadletter_exchange, routing_key="#", durable=True
+        )
+        self.queue = Queue(
+            queue_name,
+            exchange=exchange,
+            routing_key=routing_key,
+            durable=True,
+            queue_arguments={"x-dead-letter-exchange": self.deadletter_exchange.name},
+        )
+
+    @property
+    def consumed_queue(self) -> Queue:
+        """queue as consumed from, by name only, as it is declared by declare"""
+        return Queue(self.queue.name, no_declare=True)
+
+    def declare(self, rmq_conn: "Connection") -> str:
+        """
+        Declares the queues and exchanges, and their bindings, returning the name of the dead letter exchange
+
+        A queue declared by a release that left dead-lettering to cosmos-message-lib has other arguments and
+        cannot be declared again with these, it is only bound then. The messages RabbitMQ dead-letters from it keep
+        going to the library's dead letter exchange until it is recreated, see the README.
+        """
+        with rmq_conn.channel() as channel:
+            self.deadletter_queue(channel).declare()
+
+        try:
+            with rmq_conn.channel() as channel:
+                self.queue(channel).declare()
+        except PreconditionFailed:
+            logger.warning(
+                "Queue %s exists with other arguments, it keeps its dead letter exchange instead of %s",
+                self.queue.name,
+                self.deadletter_exchange.name,
+            )
+            # the failed declaration closed the channel
+            with rmq_conn.channel() as channel:
+                queue = Queue(self.queue.name, exchange=self.exchange, routing_key=self.queue.routing_key)(channel)
+                queue.queue_declare(passive=True)
+                queue.exchange.declare()
+                queue.queue_bind()
+
+        return self.deadletter_exchange.name
+
+
+def partition_queue_name(partition: int) -> str:
+    return f"{settings.MESSAGE_QUEUE_NAME}-{partition}"
+
+
+def partition_exchange(exchange: Exchange) -> Exchange:
+    if not settings.CONSUMER_PARTITION_HASH_HEADER:
+        # the routing key would spread each retailer's activities over every partition
+        raise ValueError("CONSUMER_PARTITION_HASH_HEADER must be set to partition activities")
+
+    return Exchange(
+        f"{exchange.name}-partitioned",
+        type="x-consistent-hash",
+        durable=True,
+        arguments={"hash-header": settings.CONSUMER_PARTITION_HASH_HEADER},
+    )
+
+
+def drain_legacy_queue(rmq_conn: "Connection", exchange: Exchange) -> int:
+    """
+    Unbinds the unpartitioned MESSAGE_QUEUE_NAME queue from exchange, so that it stops getting a copy of every
+    message, and moves the messages left on it back to exchange to be hashed onto the partition queues
+
+    Returns the number of messages moved, none when the queue does not exist.
+    """
+    moved = 0
+    with rmq_conn.channel() as channel:
+        legacy = Queue(settings.MESSAGE_QUEUE_NAME, exchange=exchange, routing_key=settings.MESSAGE_ROUTING_KEY)(
+            channel
+        )
+        try:
+            legacy.queue_declare(passive=True)
+        except ChannelError:
+            return moved
+
+        legacy.unbind_from(exchange, routing_key=settings.MESSAGE_ROUTING_KEY)
+        producer = Producer(channel)
+        while (message := legacy.get(no_ack=False)) is not None:
+            producer.publish(
+                message.body,
+                exchange=exchange,
+                routing_key=message.delivery_info["routing_key"],
+                headers=message.headers,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+            )
+            message.ack()
+            moved += 1
+
+    if moved:
+        logger.warning("Moved %s messages from %s to the partition queues", moved, settings.MESSAGE_QUEUE_NAME)
+    return moved
+
+
+def claim_partition(rmq_conn: "Connection", exchange: Exchange, partition: int) -> tuple[Exchange, str, str]:
+    """
+    Declares the partitioned topology and returns the exchange, queue name and routing key to consume partition with
+
+    All partition queues are declared up front, whether claimed or not, as the consistent hash exchange
+    only spreads messages over the queues bound to it. The unpartitioned queue is drained into them, as it
+    would otherwise strand the messages published before the switch to partitions.
+    """
+    if not 0 <= partition < settings.CONSUMER_PARTITIONS:
+        raise ValueError(f"Partition {partition} is out of range, there are {settings.CONSUMER_PARTITIONS}")
+
+    partitioned = partition_exchange(exchange)
+    with rmq_conn.channel() as channel:
+        exchange.maybe_bind(channel).declare()
+        partitioned.maybe_bind(channel).declare()
+        partitioned.bind_to(exchange, routing_key=settings.MESSAGE_ROUTING_KEY)
+
+    for other_partition in range(settings.CONSUMER_PARTITIONS):
+        ActivityTopology(
+            partitioned, queue_name=partition_queue_name(other_partition), routing_key=PARTITION_BINDING_WEIGHT
+        ).declare(rmq_conn)
+
+    drain_legacy_queue(rmq_conn, exchange)
+    logger.info("Claimed partition %s of %s", partition, settings.CONSUMER_PARTITIONS)
+    return partitioned, partition_queue_name(partition), PARTITION_BINDING_WEIGHT
@@ -0,0 +1,243 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, tzinfo
+from typing import TYPE_CHECKING, Any, NamedTuple
+from uuid import UUID
+
+import psycopg
+
+from psycopg import sql
+
+from hubble.config import settings
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
+    from psycopg import AsyncConnection, AsyncCursor, Connection, Cursor
+
+ACTIVITY_COLUMNS = (
+    "id",
+    "type",
+    "datetime",
+    "underlying_datetime",
+    "summary",
+    "reasons",
+    "activity_identifier",
+    "user_id",
+    "associated_value",
+    "retailer",
+    "campaigns",
+    "data",
+)
+# postgres types of ACTIVITY_COLUMNS, as created by the 7d573978e8cc migration
+ACTIVITY_COLUMN_TYPES = (
+    "uuid",
+    "varchar",
+    "timestamp",
+    "timestamp",
+    "varchar",
+    "varchar[]",
+    "varchar",
+    "varchar",
+    "varchar",
+    "varchar",
+    "varchar[]",
+    "jsonb",
+)
+# redelivered activities conflict on these and are skipped rather than failing the whole batch, activity is
+# partitioned by datetime so its primary key, the only unique index, has to include it. An activity published
+# again with the same id but another datetime does not conflict and is stored twice, only RecentActivityIds,
+# by id alone and within a single consumer process, drops it
+ACTIVITY_CONFLICT_COLUMNS = ("id", "datetime")
+# errors caused by the content of a row, anything else (e.g. a lost connection) fails the whole batch
+ROW_LEVEL_ERRORS = (psycopg.DataError, psycopg.IntegrityError)
+
+
+class ActivityWriter(ABC):
+    """
+    Writes prepared activities to the activity table using an open cursor, leaving the transaction to the caller
+
+    write and awrite are the blocking and asyncio flavours of the same operation, both return the ids of the
+    rows inserted, activities already in the table are skipped. The cursor must return tuple rows. Connections
+    are readied for them by prepare, or aprepare, once, e.g. when a pool opens them.
+    """
+
+    name: str
+
+    @abstractmethod
+    def prepare(self, conn: "Connection") -> None:
+        """Readies a new connection, with no transaction in progress, to be written to"""
+
+    @abstractmethod
+    async def aprepare(self, conn: "AsyncConnection") -> None:
+        """asyncio flavour of prepare"""
+
+    @abstractmethod
+    def write(self, cur: "Cursor", activities: list[dict]) -> set[UUID]:
+        ...
+
+    @abstractmethod
+    async def awrite(self, cur: "AsyncCursor", activities: list[dict]) -> set[UUID]:
+        ...
+
+
+class ExecuteManyActivityWriter(ActivityWriter):
+    name = "executemany"
+
+    insert_sql = sql.SQL("INSERT INTO activity ({}) VALUES ({}) ON CONFLICT ({}) DO NOTHING RETURNING id").format(
+        sql.SQL(", ").join(map(sql.Identifier, ACTIVITY_COLUMNS)),
+        sql.SQL(", ").join(map(sql.Placeholder, ACTIVITY_COLUMNS)),
+        sql.SQL(", ").join(map(sql.Identifier, ACTIVITY_CONFLICT_COLUMNS)),
+    )
+
+    # inserts straight into activity, connections need nothing more
+    def prepare(self, conn: "Connection") -> None:
+        pass
+
+    async def aprepare(self, conn: "AsyncConnection") -> None:
+        pass
+
+    def write(self, cur: "Cursor", activities: list[dict]) -> set[UUID]:
+        cur.executemany(self.insert_sql, activities, returning=True)
+        # one result per activity, empty when it was skipped
+        inserted: set[UUID] = set()
+        while True:
+            inserted.update(activity_id for (activity_id,) in cur.fetchall())
+            if not cur.nextset():
+                return inserted
+
+    async def awrite(self, cur: "AsyncCursor", activities: list[dict]) -> set[UUID]:
+        await cur.executemany(self.insert_sql, activities, returning=True)
+        inserted: set[UUID] = set()
+        while True:
+            inserted.update(activity_id for (activity_id,) in await cur.fetchall())
+            if not cur.nextset():
+                return inserted
+
+
+class CopyActivityWriter(ActivityWriter):
+    """
+    Streams activities to postgres with a binary COPY, one statement per batch instead of one per row
+
+    COPY has no ON CONFLICT clause, so rows are copied into a session scoped staging table and moved
+    to activity with a single INSERT ... SELECT that skips conflicting ids. The staging table is created by
+    prepare and emptied on commit, rows staged by an earlier write of the same transaction are moved again
+    and skipped as conflicts.
+    """
+
+    name = "copy"
+
+    create_staging_sql = sql.SQL(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS activity_staging (LIKE activity INCLUDING DEFAULTS) "
+        "ON COMMIT DELETE ROWS"
+    )
+    copy_sql = sql.SQL("COPY activity_staging ({}) FROM STDIN (FORMAT BINARY)").format(
+        sql.SQL(", ").join(map(sql.Identifier, ACTIVITY_COLUMNS))
+    )
+    move_staged_sql = sql.SQL(
+        "INSERT INTO activity ({columns}) SELECT {columns} FROM activity_staging "
+        "ON CONFLICT ({conflict_columns}) DO NOTHING RETURNING id"
+    ).format(
+        columns=sql.SQL(", ").join(map(sql.Identifier, ACTIVITY_COLUMNS)),
+        conflict_columns=sql.SQL(", ").join(map(sql.Identifier, ACTIVITY_CONFLICT_COLUMNS)),
+    )
+
+    def prepare(self, conn: "Connection") -> None:
+        conn.execute(self.create_staging_sql)
+        conn.commit()
+
+    async def aprepare(self, conn: "AsyncConnection") -> None:
+        await conn.execute(self.create_staging_sql)
+        await conn.commit()
+
+    @staticmethod
+    def _to_db_value(value: Any, column_type: str, tz: tzinfo) -> Any:  # noqa: ANN401
+        # binary dumpers are picked by column type rather than by python type, so values need to match them exactly
+        match column_type:
+            case "uuid" if not isinstance(value, UUID):
+                return UUID(str(value))
+            case "varchar" if not isinstance(value, str):
+                return str(value)
+            # an INSERT would cast a timestamptz to timestamp using the session time zone, do the same here
+            case "timestamp" if isinstance(value, datetime) and value.tzinfo is not None:
+                return value.astimezone(tz).replace(tzinfo=None)
+
+        return value
+
+    @classmethod
+    def _to_copy_rows(cls, activities: list[dict], tz: tzinfo) -> "Generator[list, None, None]":
+        for activity in activities:
+            yield [
+                cls._to_db_value(activity[column], column_type, tz)
+                for column, column_type in zip(ACTIVITY_COLUMNS, ACTIVITY_COLUMN_TYPES, strict=True)
+            ]
+
+    def write(self, cur: "Cursor", activities: list[dict]) -> set[UUID]:
+        with cur.copy(self.copy_sql) as copy:
+            copy.set_types(list(ACTIVITY_COLUMN_TYPES))
+            for row in self._to_copy_rows(activities, cur.connection.info.timezone):
+                copy.write_row(row)
+
+        cur.execute(self.move_staged_sql)
+        return {activity_id for (activity_id,) in cur.fetchall()}
+
+    async def awrite(self, cur: "AsyncCursor", activities: list[dict]) -> set[UUID]:
+        async with cur.copy(self.copy_sql) as copy:
+            copy.set_types(list(ACTIVITY_COLUMN_TYPES))
+            for row in self._to_copy_rows(activities, cur.connection.info.timezone):
+                await copy.write_row(row)
+
+        await cur.execute(self.move_staged_sql)
+        return {activity_id for (activity_id,) in await cur.fetchall()}
+
+
+ACTIVITY_WRITERS: dict[str, type[ActivityWriter]] = {
+    ExecuteManyActivityWriter.name: ExecuteManyActivityWriter,
+    CopyActivityWriter.name: CopyActivityWriter,
+}
+
+
+def get_activity_writer(engine: str | None = None) -> ActivityWriter:
+    return ACTIVITY_WRITERS[engine or settings.ACTIVITY_WRITE_ENGINE]()
+
+
+class RejectedActivity(NamedTuple):
+    activity: dict
+    error: psycopg.Error
+
+
+def write_isolating_failures(
+    conn: "Connection", cur: "Cursor", writer: ActivityWriter, activities: list[dict]
+) -> tuple[set[UUID], list[RejectedActivity]]:
+    """
+    Writes activities in a savepoint, bisecting them on a row level error until the offending rows are isolated
+
+    Returns the ids of the rows inserted and the rejected activities, must be called within a transaction
+    """
+    try:
+        with conn.transaction():
+            return writer.write(cur, activities), []
+    except ROW_LEVEL_ERRORS as ex:
+        if len(activities) == 1:
+            return set(), [RejectedActivity(activities[0], ex)]
+
+    middle = len(activities) // 2
+    inserted_head, rejected_head = write_isolating_failures(conn, cur, writer, activities[:middle])
+    inserted_tail, rejected_tail = write_isolating_failures(conn, cur, writer, activities[middle:])
+    return inserted_head | inserted_tail, rejected_head + rejected_tail
+
+
+async def awrite_isolating_failures(
+    conn: "AsyncConnection", cur: "AsyncCursor", writer: ActivityWriter, activities: list[dict]
+) -> tuple[set[UUID], list[RejectedActivity]]:
+    """asyncio flavour of write_isolating_failures"""
+    try:
+        async with conn.transaction():
+            return await writer.awrite(cur, activities), []
+    except ROW_LEVEL_ERRORS as ex:
+        if len(activities) == 1:
+            return set(), [RejectedActivity(activities[0], ex)]
+
+    middle = len(activities) // 2
+    inserted_head, rejected_head = await awrite_isolating_failures(conn, cur, writer, activities[:middle])
+    inserted_tail, rejected_tail = await awrite_isolating_failures(conn, cur, writer, activities[middle:])
+    return inserted_head | inserted_tail, rejected_head + rejected_tail
@@ -0,0 +1,351 @@
+"""
+Audit of the activity table for emails of forgotten account holders left un-hashed
+
+The activities are split into ranges of datetime, which postgres prunes to the partitions they fall in, and the
+ranges are scanned in parallel by worker processes, each reading its range through a named, server-side, cursor.
+Postgres only returns the activities with something that looks like an email in summary, associated_value or
+the values of data["fields"], which are matched in python against the account holders whose anonymise-activities
+tasks succeeded: an email is residue when it is the email of a forgotten account holder, or when it is found in
+an activity of one.
+
+Emails are deleted from the tasks once they succeed, the emails of forgotten account holders are known from the
+redis index of hubble.forgotten only, by their digest. Account holders forgotten before the index existed are
+known by their uuid.
+
+Progress is saved to a checkpoint file as each range is done, an audit started again with the same checkpoint
+carries on with the ranges left. Findings of a range interrupted half way through are reported again.
+"""
+import json
+import logging
+import multiprocessing
+import os
+
+from collections import defaultdict
+from collections.abc import Callable, Collection, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import psycopg
+
+from psycopg import sql
+
+from hubble.anonymisation import EMAIL_PATTERN, EMAIL_RE
+from hubble.forgotten import email_field, forgotten_account_holders, uuid_field
+
+if TYPE_CHECKING:
+    from typing import TextIO
+
+    from psycopg import Connection
+    from redis import Redis
+
+logger = logging.getLogger(__name__)
+
+# rows fetched per round trip from the server-side cursor
+AUDIT_FETCH_ROWS = 5000
+
+SUCCEEDED_ACCOUNT_HOLDERS_SQL = sql.SQL(
+    """
+    SELECT
+        max(task_type_key_value.value) FILTER (WHERE task_type_key.name = 'retailer_slug'),
+        max(task_type_key_value.value) FILTER (WHERE task_type_key.name = 'account_holder_uuid')
+    FROM retry_task
+    JOIN task_type ON task_type.task_type_id = retry_task.task_type_id
+    JOIN task_type_key_value ON task_type_key_value.retry_task_id = retry_task.retry_task_id
+    JOIN task_type_key ON task_type_key.task_type_key_id = task_type_key_value.task_type_key_id
+    WHERE task_type.name = %(task_type_name)s AND retry_task.status = 'SUCCESS'
+    GROUP BY retry_task.retry_task_id
+    """
+)
+SCAN_RANGE_SQL = sql.SQL(
+    """
+    SELECT id, datetime, retailer, type, user_id, summary, associated_value, data -> 'fields'
+    FROM activity
+    WHERE datetime >= %(start)s AND datetime < %(end)s {retailer}
+    AND (summary ~ %(pattern)s OR associated_value ~ %(pattern)s OR (data -> 'fields')::text ~ %(pattern)s)
+    """
+)
+
+# retailer slug -> field of the index of hubble.forgotten -> account holder uuid
+Forgotten = dict[str, dict[str, str]]
+# (retailer slug, account holder uuid, email) of an account holder to anonymise the activities of again
+Requeue = Callable[[list[tuple[str, str, str]]], Any]
+
+
+@dataclass(frozen=True, order=True)
+class ScanRange:
+    """Activities with a datetime from start, included, to end, excluded"""
+
+    start: datetime
+    end: datetime
+
+    def dumps(self) -> list[str]:
+        return [self.start.isoformat(), self.end.isoformat()]
+
+    @classmethod
+    def loads(cls, value: list[str]) -> "ScanRange":
+        return cls(datetime.fromisoformat(value[0]), datetime.fromisoformat(value[1]))
+
+
+def split_ranges(start: datetime, end: datetime, step: timedelta) -> list[ScanRange]:
+    ranges = []
+    while start < end:
+        ranges.append(ScanRange(start, min(start + step, end)))
+        start += step
+
+    return ranges
+
+
+@dataclass
+class PIIFinding:
+    activity_id: str
+    datetime: datetime
+    retailer: str
+    type: str  # noqa: A003
+    account_holder_uuid: str
+    columns: list[str]
+    # only set when the email found is the forgotten account holder's, and never written to the report
+    email: str | None = None
+
+    def report_line(self) -> str:
+        return json.dumps(
+            {
+                "activity_id": self.activity_id,
+                "datetime": self.datetime.isoformat(),
+                "retailer": self.retailer,
+                "type": self.type,
+                "account_holder_uuid": self.account_holder_uuid,
+                "columns": self.columns,
+                "requeueable": self.email is not None,
+            }
+        )
+
+
+def load_forgotten(redis: "Redis", conn: "Connection", task_type_name: str, retailer: str | None = None) -> Forgotten:
+    """The account holders recorded in the index of hubble.forgotten and those of the tasks that succeeded"""
+    forgotten: defaultdict[str, dict[str, str]] = defaultdict(dict)
+    for retailer_slug, index_field, account_holder_uuid in forgotten_account_holders(
+        redis, [retailer] if retailer else None
+    ):
+        forgotten[retailer_slug][index_field] = account_holder_uuid
+    for retailer_slug, account_holder_uuid in conn.execute(
+        SUCCEEDED_ACCOUNT_HOLDERS_SQL, {"task_type_name": task_type_name}
+    ):
+        if retailer in (None, retailer_slug) and account_holder_uuid:
+            forgotten[retailer_slug][uuid_field(account_holder_uuid)] = account_holder_uuid
+
+    return dict(forgotten)
+
+
+def _found_emails(summary: str, associated_value: str, fields: Any) -> Iterator[tuple[str, str]]:  # noqa: ANN401
+    """Yields the (column, email) of every email in the audited values of an activity"""
+    values: list[tuple[str, Any]] = [("summary", summary), ("associated_value", associated_value)]
+    if isinstance(fields, list):
+        values += [("data.fields", entry.get("value")) for entry in fields if isinstance(entry, dict)]
+
+    for column, value in values:
+        if isinstance(value, str):
+            yield from ((column, email) for email in EMAIL_RE.findall(value))
+
+
+def _requeueable_email(found: list[tuple[str, str, str | None]], owner: str | None) -> tuple[str | None, str | None]:
+    """
+    Returns the first email found of its forgotten account holder, along with their uuid. As with the index, the
+    account holder of the uuid wins over that of the email, whose email is only requeueable if it is theirs.
+    """
+    return next(
+        ((email_owner, email) for _, email, email_owner in found if email_owner and owner in (None, email_owner)),
+        (None, None),
+    )
+
+
+def find_residue(row: tuple, forgotten: Forgotten) -> PIIFinding | None:
+    """
+    Returns the finding for a row of SCAN_RANGE_SQL if it has an email of, or is an activity of, a forgotten
+    account holder
+    """
+    activity_id, when, retailer, activity_type, user_id, summary, associated_value, fields = row
+    if not (account_holders := forgotten.get(retailer)):
+        return None
+
+    owner = account_holders.get(uuid_field(str(user_id)))
+    found = [
+        (column, email, email_owner)
+        for column, email in _found_emails(summary, associated_value, fields)
+        if (email_owner := account_holders.get(email_field(email))) is not None or owner is not None
+    ]
+    if not found:
+        return None
+
+    email_owner, email = _requeueable_email(found, owner)
+    return PIIFinding(
+        str(activity_id),
+        when,
+        retailer,
+        activity_type,
+        owner or email_owner or "",
+        list(dict.fromkeys(column for column, _, _ in found)),
+        email,
+    )
+
+
+_forgotten: Forgotten = {}
+
+
+def _init_worker(forgotten: Forgotten) -> None:
+    global _forgotten
+    _forgotten = forgotten
+
+
+def scan_range(dsn: str, scan: ScanRange, retailer: str | None = None) -> list[PIIFinding]:
+    """Runs in a worker process, with the account holders the pool was initialised with"""
+    statement = SCAN_RANGE_SQL.format(retailer=sql.SQL("AND retailer = %(retailer)s" if retailer else ""))
+    params = {"start": scan.start, "end": scan.end, "retailer": retailer, "pattern": EMAIL_PATTERN}
+    findings = []
+    with psycopg.connect(dsn) as conn, conn.transaction(), conn.cursor(name="pii_audit") as cur:
+        cur.itersize = AUDIT_FETCH_ROWS
+        cur.execute(statement, params)
+        for row in cur:
+            if (finding := find_residue(row, _forgotten)) is not None:
+                findings.append(finding)
+
+    return findings
+
+
+@dataclass
+class AuditCheckpoint:
+    ranges: list[ScanRange]
+    retailer: str | None = None
+    done: set[ScanRange] = field(default_factory=set)
+    # (retailer slug, account holder uuid) already requeued
+    requeued: set[tuple[str, str]] = field(default_factory=set)
+
+    @property
+    def pending(self) -> list[ScanRange]:
+        return [scan for scan in self.ranges if scan not in self.done]
+
+    @classmethod
+    def load(cls, path: Path) -> "AuditCheckpoint":
+        value = json.loads(path.read_text())
+        return cls(
+            ranges=[ScanRange.loads(scan) for scan in value["ranges"]],
+            retailer=value["retailer"],
+            done={ScanRange.loads(scan) for scan in value["done"]},
+            requeued={(retailer, account_holder_uuid) for retailer, account_holder_uuid in value["requeued"]},
+        )
+
+    def save(self, path: Path) -> None:
+        value = {
+            "ranges": [scan.dumps() for scan in self.ranges],
+            "retailer": self.retailer,
+            "done": [scan.dumps() for scan in sorted(self.done)],
+            "requeued": sorted(self.requeued),
+        }
+        # replaced in one go, an interruption never leaves half a checkpoint behind
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(value))
+        os.replace(tmp_path, path)
+
+
+def _naive_utc(value: datetime) -> datetime:
+    # activity.datetime is a timestamp without time zone, in UTC
+    return value.astimezone(UTC).replace(tzinfo=None) if value.tzinfo else value
+
+
+def plan_audit(
+    conn: "Connection",
+    step: timedelta,
+    retailer: str | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+) -> AuditCheckpoint:
+    """
+    Splits the activities from start, the oldest by default, to end, now by default, into ranges of step. Both
+    are compared as naive UTC, as activity.datetime is stored.
+    """
+    if start is None:
+        start = conn.execute("SELECT min(datetime) FROM activity").fetchone()[0]  # type: ignore [index]
+        if start is None:
+            return AuditCheckpoint(ranges=[], retailer=retailer)
+
+    end = datetime.now(tz=UTC) if end is None else end
+    return AuditCheckpoint(ranges=split_ranges(_naive_utc(start), _naive_utc(end), step), retailer=retailer)
+
+
+class PIIAudit:
+    """Scans the pending ranges of a checkpoint in a pool of worker processes, writing findings to report"""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        dsn: str,
+        forgotten: Forgotten,
+        checkpoint: AuditCheckpoint,
+        checkpoint_path: Path,
+        report: "TextIO",
+        *,
+        workers: int = 1,
+        requeue: Requeue | None = None,
+    ) -> None:
+        self.dsn = dsn
+        self.forgotten = forgotten
+        self.checkpoint = checkpoint
+        self.checkpoint_path = checkpoint_path
+        self.report = report
+        self.workers = workers
+        self.requeue = requeue
+
+    def _requeue(self, findings: Collection[PIIFinding]) -> None:
+        account_holders = {
+            (finding.retailer, finding.account_holder_uuid): finding.email
+            for finding in findings
+            if finding.email is not None
+        }
+        if not self.requeue or not (account_holders.keys() - self.checkpoint.requeued):
+            return
+
+        self.requeue(
+            [
+                (retailer, account_holder_uuid, email)
+                for (retailer, account_holder_uuid), email in account_holders.items()
+                if (retailer, account_holder_uuid) not in self.checkpoint.requeued
+            ]
+        )
+        self.checkpoint.requeued.update(account_holders)
+
+    def record(self, scan: ScanRange, findings: Collection[PIIFinding]) -> None:
+        """Reports the findings of a range, and requeues them, before marking it done"""
+        self.report.writelines(finding.report_line() + "\n" for finding in findings)
+        self.report.flush()
+        self._requeue(findings)
+        self.checkpoint.done.add(scan)
+        self.checkpoint.save(self.checkpoint_path)
+        logger.info("Audited activities from %s to %s, %s findings", scan.start, scan.end, len(findings))
+
+    def run(self) -> int:
+        """Returns the number of findings"""
+        pending = self.checkpoint.pending
+        logger.info("Auditing %s of %s ranges of activities", len(pending), len(self.checkpoint.ranges))
+        found = 0
+        # forked workers share the account holders rather than unpickling a copy each
+        with ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self.forgotten,),
+        ) as executor:
+            futures: dict[Future[list[PIIFinding]], ScanRange] = {
+                executor.submit(scan_range, self.dsn, scan, self.checkpoint.retailer): scan for scan in pending
+            }
+            try:
+                for future in as_completed(futures):
+                    findings = future.result()
+                    self.record(futures[future], findings)
+                    found += len(findings)
+            except BaseException:
+                # the ranges not done yet are left for the next run
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        return found
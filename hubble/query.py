@@ -0,0 +1,186 @@
+"""
+Read path for activities, for services and scripts that would otherwise write their own SQL against activity
+
+Results are paginated with a keyset on (datetime, id) rather than OFFSET, so fetching a page costs the same
+however deep into a retailer's activities it is: each page starts right after the last row of the previous
+one in the order of the (retailer, user_id, datetime) and (retailer, type, datetime) indexes.
+"""
+import base64
+import json
+
+from collections.abc import Collection
+from dataclasses import dataclass
+from datetime import datetime
+from typing import TYPE_CHECKING, NamedTuple
+from uuid import UUID
+
+from sqlalchemy import ColumnElement, func, literal, or_, select, union, union_all
+
+from hubble.db.models import Activity
+
+if TYPE_CHECKING:
+    from sqlalchemy import CompoundSelect, Connection, FromClause, Select
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+activity_table = Activity.__table__
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class ActivityFilter:
+    """
+    Activities of a retailer, optionally narrowed down to those matching every other field that is set
+
+    campaigns and reasons match activities with any of the given values, datetime_from is inclusive and
+    datetime_to exclusive.
+    """
+
+    retailer: str
+    user_id: str | None = None
+    types: Collection[str] | None = None
+    campaigns: Collection[str] | None = None
+    reasons: Collection[str] | None = None
+    datetime_from: datetime | None = None
+    datetime_to: datetime | None = None
+
+    def where_clauses(self) -> list[ColumnElement[bool]]:
+        columns = activity_table.c
+        clauses = [columns.retailer == self.retailer]
+        if self.user_id is not None:
+            clauses.append(columns.user_id == self.user_id)
+        if self.types:
+            clauses.append(columns.type.in_(self.types))
+        # && (overlap) is served by the GIN indexes on the array columns
+        if self.campaigns:
+            clauses.append(columns.campaigns.overlap(list(self.campaigns)))
+        if self.reasons:
+            clauses.append(columns.reasons.overlap(list(self.reasons)))
+        if self.datetime_from is not None:
+            clauses.append(columns.datetime >= self.datetime_from)
+        if self.datetime_to is not None:
+            clauses.append(columns.datetime < self.datetime_to)
+
+        return clauses
+
+
+class ActivityPage(NamedTuple):
+    activities: list[dict]
+    # pass to query_activities to get the next page, None when this is the last one
+    next_cursor: str | None
+
+
+def encode_cursor(activity: dict) -> str:
+    position = [activity["datetime"].isoformat(), str(activity["id"])]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        datetime_str, id_str = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(datetime_str), UUID(id_str)
+    except (ValueError, TypeError) as ex:
+        raise InvalidCursorError(f"Invalid cursor: {cursor!r}") from ex
+
+
+def select_activities(filters: ActivityFilter, *, cursor: str | None = None, newest_first: bool = True) -> "Select":
+    """Selects every activity matching filters, in pagination order, starting after cursor if given"""
+    columns = activity_table.c
+    query = select(activity_table).where(*filters.where_clauses())
+    if cursor is not None:
+        after_datetime, after_id = decode_cursor(cursor)
+        # the bound on datetime alone is redundant, but unlike the row comparison it is something the indexes
+        # ending in datetime can start their scan from
+        if newest_first:
+            query = query.where(
+                columns.datetime <= after_datetime, or_(columns.datetime < after_datetime, columns.id < after_id)
+            )
+        else:
+            query = query.where(
+                columns.datetime >= after_datetime, or_(columns.datetime > after_datetime, columns.id > after_id)
+            )
+
+    order_by = (columns.datetime.desc(), columns.id.desc()) if newest_first else (columns.datetime, columns.id)
+    return query.order_by(*order_by)
+
+
+def build_activities_query(
+    filters: ActivityFilter, *, page_size: int, cursor: str | None = None, newest_first: bool = True
+) -> "Select":
+    # one more row than asked for tells whether there is a next page
+    return select_activities(filters, cursor=cursor, newest_first=newest_first).limit(page_size + 1)
+
+
+def query_activities(
+    conn: "Connection",
+    filters: ActivityFilter,
+    *,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: str | None = None,
+    newest_first: bool = True,
+) -> ActivityPage:
+    """Returns a page of the activities matching filters as plain dicts, starting after cursor if given"""
+    if not 0 < page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {MAX_PAGE_SIZE}, got {page_size}")
+
+    query = build_activities_query(filters, page_size=page_size, cursor=cursor, newest_first=newest_first)
+    activities = [dict(row) for row in conn.execute(query).mappings()]
+    if len(activities) > page_size:
+        del activities[page_size:]
+        return ActivityPage(activities, encode_cursor(activities[-1]))
+
+    return ActivityPage(activities, None)
+
+
+def select_account_holder_activities(
+    retailer: str, *, user_id: str, email: str, types: Collection[str]
+) -> "CompoundSelect":
+    """
+    Selects the primary keys of an account holder's activities of the given types, by uuid or email
+
+    Emails are compared case insensitively. The two lookups are combined with UNION rather than OR, so each
+    one is served by its own index, (retailer, user_id, datetime) and (retailer, lower(associated_value)),
+    instead of the planner falling back to scanning all of the retailer's activities.
+    """
+    columns = activity_table.c
+    scope = (columns.retailer == retailer, columns.type.in_(types))
+    return union(
+        select(columns.id, columns.datetime).where(*scope, columns.user_id == user_id),
+        select(columns.id, columns.datetime).where(*scope, func.lower(columns.associated_value) == func.lower(email)),
+    )
+
+
+def select_account_holders_activities(
+    retailer: str, account_holders: "FromClause", *, types: Collection[str]
+) -> "Select":
+    """
+    select_account_holder_activities for many account holders at once, joined from a table, or VALUES list, of them
+
+    account_holders has an account_holder_uuid and an account_holder_email column, the primary key of each
+    activity is selected along with every column of the account holder it belongs to. An activity matching
+    the uuid of one account holder and the email of another belongs to the former.
+    """
+    columns = activity_table.c
+    scope = (columns.retailer == retailer, columns.type.in_(types))
+    holder = account_holders.c
+    matches = union_all(
+        select(columns.id, columns.datetime, *holder, literal(0).label("by_email"))
+        .join_from(activity_table, account_holders, columns.user_id == holder.account_holder_uuid)
+        .where(*scope),
+        select(columns.id, columns.datetime, *holder, literal(1).label("by_email"))
+        .join_from(
+            activity_table,
+            account_holders,
+            func.lower(columns.associated_value) == func.lower(holder.account_holder_email),
+        )
+        .where(*scope),
+    ).subquery()
+    return (
+        select(matches.c.id, matches.c.datetime, *(matches.c[column.name] for column in holder))
+        .distinct(matches.c.id, matches.c.datetime)
+        .order_by(matches.c.id, matches.c.datetime, matches.c.by_email)
+    )
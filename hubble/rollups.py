@@ -0,0 +1,151 @@
+"""
+Hourly activity rollups, for dashboards that would otherwise aggregate the raw activity table
+
+activity_hourly_rollup counts activities per retailer, hour, type and campaign. Each activity is counted once
+under the empty campaign, so totals do not depend on campaigns, and once more under each of its campaigns.
+activity_hourly_user holds the account holders active in each hour of a retailer, so distinct users over any
+range of hours can be counted exactly.
+
+Consumers add the activities of each batch they persist, in the same transaction as the activities themselves,
+and rebuild_rollups recomputes a range of hours from the activity table.
+"""
+import logging
+
+from collections import Counter
+from datetime import UTC, datetime, timedelta, tzinfo
+from typing import TYPE_CHECKING
+
+from psycopg import sql
+
+if TYPE_CHECKING:
+    from collections.abc import Collection
+    from uuid import UUID
+
+    from psycopg import AsyncCursor, Connection, Cursor
+
+logger = logging.getLogger(__name__)
+
+# the campaign activities are counted under regardless of their campaigns
+ALL_CAMPAIGNS = ""
+
+# rows are upserted in key order so that concurrent consumers lock them in the same order
+UPSERT_COUNTS_SQL = sql.SQL(
+    "INSERT INTO activity_hourly_rollup (retailer, hour, type, campaign, activities) "
+    "SELECT * FROM unnest(%s::varchar[], %s::timestamp[], %s::varchar[], %s::varchar[], %s::bigint[]) "
+    "ON CONFLICT (retailer, hour, type, campaign) "
+    "DO UPDATE SET activities = activity_hourly_rollup.activities + EXCLUDED.activities"
+)
+INSERT_USERS_SQL = sql.SQL(
+    "INSERT INTO activity_hourly_user (retailer, hour, user_id) "
+    "SELECT * FROM unnest(%s::varchar[], %s::timestamp[], %s::varchar[]) "
+    "ON CONFLICT (retailer, hour, user_id) DO NOTHING"
+)
+
+# hours rebuilt per transaction, consumers wait for the rollups for as long as it takes to rebuild a step
+REBUILD_STEP = timedelta(hours=1)
+# blocks consumers from updating the rollups until the rebuild commits, so that every activity is counted
+# either by the rebuild or by the consumer that inserted it, never both or neither
+LOCK_ROLLUPS_SQL = sql.SQL("LOCK TABLE activity_hourly_rollup, activity_hourly_user IN SHARE ROW EXCLUSIVE MODE")
+DELETE_COUNTS_SQL = sql.SQL("DELETE FROM activity_hourly_rollup WHERE hour >= %(start)s AND hour < %(end)s")
+DELETE_USERS_SQL = sql.SQL("DELETE FROM activity_hourly_user WHERE hour >= %(start)s AND hour < %(end)s")
+REBUILD_COUNTS_SQL = sql.SQL(
+    "INSERT INTO activity_hourly_rollup (retailer, hour, type, campaign, activities) "
+    "SELECT retailer, date_trunc('hour', datetime), type, campaign, count(*) "
+    "FROM activity CROSS JOIN LATERAL unnest(array_prepend(%(all_campaigns)s::varchar, campaigns)) AS campaign "
+    "WHERE datetime >= %(start)s AND datetime < %(end)s "
+    "GROUP BY 1, 2, 3, 4"
+)
+REBUILD_USERS_SQL = sql.SQL(
+    "INSERT INTO activity_hourly_user (retailer, hour, user_id) "
+    "SELECT DISTINCT retailer, date_trunc('hour', datetime), user_id "
+    "FROM activity WHERE datetime >= %(start)s AND datetime < %(end)s"
+)
+
+
+def hour_start(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+class ActivityRollup:
+    """Hourly counts and active account holders of a set of activities, to be added to the rollup tables"""
+
+    def __init__(self) -> None:
+        self.counts: Counter[tuple[str, datetime, str, str]] = Counter()
+        self.users: set[tuple[str, datetime, str]] = set()
+
+    def add(self, activity: dict, tz: tzinfo) -> None:
+        activity_datetime = activity["datetime"]
+        # activity datetimes are stored as timestamps in the session time zone, see CopyActivityWriter
+        if activity_datetime.tzinfo is not None:
+            activity_datetime = activity_datetime.astimezone(tz).replace(tzinfo=None)
+
+        hour = hour_start(activity_datetime)
+        retailer, activity_type = str(activity["retailer"]), str(activity["type"])
+        for campaign in (ALL_CAMPAIGNS, *activity["campaigns"]):
+            self.counts[(retailer, hour, activity_type, str(campaign))] += 1
+        self.users.add((retailer, hour, str(activity["user_id"])))
+
+    @classmethod
+    def of_inserted(cls, activities: list[dict], inserted: "Collection[UUID]", tz: tzinfo) -> "ActivityRollup":
+        """Rolls up the activities written by an ActivityWriter, leaving out the ones it skipped or rejected"""
+        rollup = cls()
+        for activity in activities:
+            if activity["id"] in inserted:
+                rollup.add(activity, tz)
+
+        return rollup
+
+    def _params(self) -> tuple[list[list], list[list]]:
+        # one array per column, for unnest
+        counts = [(*key, activities) for key, activities in sorted(self.counts.items())]
+        users = sorted(self.users)
+        return [list(column) for column in zip(*counts, strict=True)], [
+            list(column) for column in zip(*users, strict=True)
+        ]
+
+    def flush(self, cur: "Cursor") -> None:
+        """Adds the rollup to the rollup tables, leaving the transaction to the caller"""
+        if not self.counts:
+            return
+
+        counts, users = self._params()
+        cur.execute(UPSERT_COUNTS_SQL, counts)
+        cur.execute(INSERT_USERS_SQL, users)
+
+    async def aflush(self, cur: "AsyncCursor") -> None:
+        """asyncio flavour of flush"""
+        if not self.counts:
+            return
+
+        counts, users = self._params()
+        await cur.execute(UPSERT_COUNTS_SQL, counts)
+        await cur.execute(INSERT_USERS_SQL, users)
+
+
+def rebuild_rollups(conn: "Connection", start: datetime, end: datetime, *, step: timedelta = REBUILD_STEP) -> int:
+    """
+    Recomputes the rollups of the hours from start to end, both UTC datetimes, from the activity table
+
+    Partial hours at either end are rebuilt whole. Every step is rebuilt in a transaction of its own, during
+    which consumers wait to update the rollups, so it is kept to an hour by default. Returns the number of hours
+    rebuilt.
+    """
+    # activity datetimes are stored as UTC timestamps without a time zone
+    start = hour_start(start.astimezone(UTC).replace(tzinfo=None))
+    end = end.astimezone(UTC).replace(tzinfo=None)
+    end = hour_start(end) + timedelta(hours=1) if end != hour_start(end) else end
+    step_start = start
+    while step_start < end:
+        step_end = min(step_start + step, end)
+        params = {"start": step_start, "end": step_end, "all_campaigns": ALL_CAMPAIGNS}
+        with conn.transaction(), conn.cursor() as cur:
+            cur.execute(LOCK_ROLLUPS_SQL)
+            cur.execute(DELETE_COUNTS_SQL, params)
+            cur.execute(DELETE_USERS_SQL, params)
+            cur.execute(REBUILD_COUNTS_SQL, params)
+            rebuilt = cur.rowcount
+            cur.execute(REBUILD_USERS_SQL, params)
+        logger.debug("Rebuilt %s activity rollups from %s to %s", rebuilt, step_start, step_end)
+        step_start = step_end
+
+    return (end - start) // timedelta(hours=1)
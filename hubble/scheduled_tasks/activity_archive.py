@@ -0,0 +1,225 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from typing import IO
+
+import psycopg
+
+from psycopg import sql
+from psycopg.types.json import Jsonb
+
+from hubble.anonymisation import ANONYMISED_ACTIVITY_TYPES
+from hubble.config import redis, settings
+from hubble.forgotten import anonymise_forgotten
+from hubble.messaging.writers import ACTIVITY_COLUMNS, ACTIVITY_CONFLICT_COLUMNS
+from hubble.scheduled_tasks.scheduler import acquire_lock, cron_scheduler
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+ARCHIVE_COLUMNS = (*ACTIVITY_COLUMNS, "created_at")
+_columns_sql = sql.SQL(", ").join(map(sql.Identifier, ARCHIVE_COLUMNS))
+
+# rows are copied out by the statement that deletes them, so a row is only ever deleted along with the batch
+# it was archived in, even if activities older than the cutoff keep arriving while the job runs
+ARCHIVE_BATCH_SQL = sql.SQL(
+    "COPY (DELETE FROM activity WHERE (id, datetime) IN "
+    "(SELECT id, datetime FROM activity WHERE datetime < {cutoff} LIMIT {rows}) RETURNING {columns}) TO STDOUT"
+)
+CREATE_RESTORE_TABLE_SQL = sql.SQL(
+    "CREATE TEMPORARY TABLE activity_restore (LIKE activity INCLUDING DEFAULTS) ON COMMIT DROP"
+)
+COPY_RESTORE_SQL = sql.SQL("COPY activity_restore ({}) FROM STDIN").format(_columns_sql)
+SELECT_RESTORED_SQL = sql.SQL(
+    "SELECT id, datetime, type, retailer, user_id, summary, associated_value, data FROM activity_restore "
+    "WHERE type = ANY(%s)"
+)
+UPDATE_RESTORED_SQL = sql.SQL(
+    "UPDATE activity_restore AS r SET summary = h.summary, associated_value = h.associated_value, data = h.data "
+    "FROM unnest(%s::uuid[], %s::timestamp[], %s::varchar[], %s::varchar[], %s::jsonb[]) "
+    "AS h(id, datetime, summary, associated_value, data) "
+    "WHERE r.id = h.id AND r.datetime = h.datetime"
+)
+MOVE_RESTORED_SQL = sql.SQL(
+    "INSERT INTO activity ({columns}) SELECT {columns} FROM activity_restore "
+    "ON CONFLICT ({conflict_columns}) DO NOTHING"
+).format(columns=_columns_sql, conflict_columns=sql.SQL(", ").join(map(sql.Identifier, ACTIVITY_CONFLICT_COLUMNS)))
+
+
+class ArchiveIntegrityError(Exception):
+    pass
+
+
+def archive_cutoff(now: datetime, retention_days: int) -> datetime:
+    """Start of the oldest day kept in the activity table, as a UTC timestamp without time zone like datetime"""
+    return now.astimezone(UTC).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0) - timedelta(
+        days=retention_days
+    )
+
+
+def _fsync(f: IO) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _write_manifest(directory: Path, manifest: dict) -> None:
+    # replaced atomically, so an interrupted run still leaves a manifest listing every file it archived
+    tmp_path = directory / f"{MANIFEST_NAME}.tmp"
+    with tmp_path.open("w") as f:
+        json.dump(manifest, f, indent=2)
+        _fsync(f)
+    tmp_path.replace(directory / MANIFEST_NAME)
+
+
+def archive_batch(conn: psycopg.Connection, directory: Path, manifest: dict, cutoff: datetime, rows: int) -> int:
+    """
+    Moves up to rows activities older than cutoff from the activity table to a new gzipped COPY file
+
+    The file and its manifest entry are on disk before the deletion is committed, so every archived activity
+    is either still in the table or in the archive. Returns the number of activities archived.
+    """
+    path = directory / f"{len(manifest['files']):06d}.copy.gz"
+    tmp_path = path.with_suffix(".tmp")
+    digest = hashlib.sha256()
+    archived = 0
+    statement = ARCHIVE_BATCH_SQL.format(cutoff=sql.Literal(cutoff), rows=sql.Literal(rows), columns=_columns_sql)
+    with conn.transaction(), conn.cursor() as cur:
+        with tmp_path.open("wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            with cur.copy(statement) as copy:
+                for data in copy:
+                    f.write(data)
+                    digest.update(data)
+                    # text format escapes newlines within values, so there is exactly one per row
+                    archived += bytes(data).count(b"\n")
+
+            f.close()
+            _fsync(raw)
+
+        if not archived:
+            tmp_path.unlink()
+            return 0
+
+        tmp_path.replace(path)
+        manifest["files"].append({"name": path.name, "rows": archived, "sha256": digest.hexdigest()})
+        manifest["rows"] += archived
+        _write_manifest(directory, manifest)
+
+    logger.info("Archived %s activities to %s", archived, path)
+    return archived
+
+
+def archive_activities(
+    conn: psycopg.Connection, directory: Path, cutoff: datetime, *, batch_rows: int, max_runtime: float
+) -> dict:
+    """
+    Archives activities older than cutoff into a new subdirectory of directory, returns its manifest
+
+    Every batch is committed on its own, so the table is never locked for long, and the run stops starting
+    new batches after max_runtime seconds, the next one picking up where it left off.
+    """
+    started = time.monotonic()
+    run_directory = directory / f"activity-{datetime.now(tz=UTC):%Y%m%dT%H%M%S}"
+    run_directory.mkdir(parents=True)
+    manifest: dict = {
+        "format": "postgres-copy-text+gzip",
+        "columns": ARCHIVE_COLUMNS,
+        "cutoff": cutoff.isoformat(),
+        "rows": 0,
+        "files": [],
+    }
+    while time.monotonic() - started < max_runtime:
+        if not archive_batch(conn, run_directory, manifest, cutoff, batch_rows):
+            break
+
+    if not manifest["files"]:
+        run_directory.rmdir()
+
+    return manifest
+
+
+def anonymise_restored(cur: psycopg.Cursor) -> int:
+    """
+    Hashes the activities of forgotten account holders loaded into activity_restore, as the consumers do, so that
+    an archive taken before they were forgotten does not bring their activities back. Returns the number hashed.
+    """
+    cur.execute(SELECT_RESTORED_SQL, [list(ANONYMISED_ACTIVITY_TYPES)])
+    columns = [column.name for column in cur.description or []]
+    activities = []
+    for row in cur.fetchall():
+        activity = dict(zip(columns, row, strict=True))
+        # wrapped as by the consumers, which anonymise_forgotten expects
+        activity["data"] = Jsonb(activity["data"])
+        activities.append(activity)
+    if not (hashed := anonymise_forgotten(redis, activities)):
+        return hashed
+
+    cur.execute(
+        UPDATE_RESTORED_SQL,
+        [
+            [activity[column] for activity in activities]
+            for column in ("id", "datetime", "summary", "associated_value", "data")
+        ],
+    )
+    return hashed
+
+
+def restore_activities(conn: psycopg.Connection, directory: Path) -> int:
+    """
+    Loads an archive back into the activity table, returns the number of activities restored
+
+    Each file is checked against its manifest entry and loaded in its own transaction, activities that
+    are already in the table are skipped, so an interrupted restore can be run again. Activities of account
+    holders forgotten since the archive was taken are hashed before they are inserted.
+    """
+    manifest = json.loads((directory / MANIFEST_NAME).read_text())
+    if tuple(manifest["columns"]) != ARCHIVE_COLUMNS:
+        raise ArchiveIntegrityError(f"Unsupported archive columns: {manifest['columns']}")
+
+    restored = 0
+    for entry in manifest["files"]:
+        digest = hashlib.sha256()
+        with conn.transaction(), conn.cursor() as cur:
+            cur.execute(CREATE_RESTORE_TABLE_SQL)
+            with gzip.open(directory / entry["name"], "rb") as f, cur.copy(COPY_RESTORE_SQL) as copy:
+                while data := f.read(1024**2):
+                    copy.write(data)
+                    digest.update(data)
+
+            if digest.hexdigest() != entry["sha256"]:
+                # raised within the transaction, so nothing from the file is kept
+                raise ArchiveIntegrityError(f"Checksum mismatch for {entry['name']}")
+
+            if hashed := anonymise_restored(cur):
+                logger.info("Hashed %s activities of forgotten account holders from %s", hashed, entry["name"])
+            cur.execute(MOVE_RESTORED_SQL)
+            inserted = cur.rowcount
+
+        restored += inserted
+        logger.info("Restored %s of %s activities from %s", inserted, entry["rows"], entry["name"])
+
+    return restored
+
+
+@acquire_lock(runner=cron_scheduler)
+def archive_old_activities() -> None:
+    if not settings.ACTIVITY_ARCHIVE_DIR:
+        logger.warning("ACTIVITY_ARCHIVE_DIR is not set, not archiving activities")
+        return
+
+    cutoff = archive_cutoff(datetime.now(tz=UTC), settings.ACTIVITY_RETENTION_DAYS)
+    with psycopg.connect(settings.PSYCOPG_URI) as conn:
+        manifest = archive_activities(
+            conn,
+            Path(settings.ACTIVITY_ARCHIVE_DIR),
+            cutoff,
+            batch_rows=settings.ACTIVITY_ARCHIVE_BATCH_ROWS,
+            max_runtime=settings.ACTIVITY_ARCHIVE_MAX_RUNTIME_SECS,
+        )
+
+    logger.info("Archived %s activities older than %s", manifest["rows"], cutoff)
@@ -0,0 +1,95 @@
+import logging
+import re
+
+from datetime import UTC, datetime
+
+import psycopg
+
+from psycopg import sql
+
+from hubble.config import settings
+from hubble.scheduled_tasks.scheduler import acquire_lock, cron_scheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARTITION = "activity_default"
+# upper bound of a range partition as rendered by pg_get_expr, e.g. FOR VALUES FROM (...) TO ('2023-05-01 00:00:00')
+UPPER_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+CREATE_DEFAULT_PARTITION_SQL = sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF activity DEFAULT").format(
+    sql.Identifier(DEFAULT_PARTITION)
+)
+PARTITION_BOUNDS_SQL = sql.SQL(
+    "SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+    "WHERE i.inhparent = 'activity'::regclass"
+)
+
+
+def month_start(value: datetime, months_ahead: int = 0) -> datetime:
+    month_index = value.year * 12 + value.month - 1 + months_ahead
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=value.tzinfo)
+
+
+def partition_name(start: datetime) -> str:
+    return f"activity_{start:%Y_%m}"
+
+
+def _partition_upper_bounds(cur: psycopg.Cursor) -> list[datetime]:
+    cur.execute(PARTITION_BOUNDS_SQL)
+    return [
+        datetime.fromisoformat(match[1]).replace(tzinfo=UTC)
+        for (bound,) in cur.fetchall()
+        if (match := UPPER_BOUND_RE.search(bound))
+    ]
+
+
+def create_partition(cur: psycopg.Cursor, start: datetime, end: datetime) -> None:
+    partition = sql.Identifier(partition_name(start))
+    # activity datetimes are stored as UTC timestamps without a time zone
+    start, end = start.astimezone(UTC).replace(tzinfo=None), end.astimezone(UTC).replace(tzinfo=None)
+    cur.execute(sql.SQL("CREATE TABLE {} (LIKE activity INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(partition))
+    # activities that landed in the default partition for lack of this one must move before it can be attached
+    cur.execute(
+        sql.SQL(
+            "WITH moved AS (DELETE FROM {} WHERE datetime >= %(start)s AND datetime < %(end)s RETURNING *) "
+            "INSERT INTO {} SELECT * FROM moved"
+        ).format(sql.Identifier(DEFAULT_PARTITION), partition),
+        {"start": start, "end": end},
+    )
+    if cur.rowcount:
+        logger.warning("Moved %s activities from %s to %s", cur.rowcount, DEFAULT_PARTITION, partition_name(start))
+
+    cur.execute(
+        sql.SQL("ALTER TABLE activity ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+            partition, sql.Literal(start), sql.Literal(end)
+        )
+    )
+
+
+def ensure_activity_partitions(conn: psycopg.Connection, now: datetime, months_ahead: int) -> list[str]:
+    """
+    Creates the default partition and the monthly partitions missing up to months_ahead months after now,
+    which must be a UTC datetime
+
+    Partitions start where the latest existing one ends, so a gap left by the job not running for a while
+    is filled in too. Returns the names of the partitions created.
+    """
+    created: list[str] = []
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(CREATE_DEFAULT_PARTITION_SQL)
+        start = max(_partition_upper_bounds(cur), default=month_start(now))
+        while start < month_start(now, months_ahead + 1):
+            end = month_start(start, 1)
+            create_partition(cur, start, end)
+            created.append(partition_name(start))
+            start = end
+
+    return created
+
+
+@acquire_lock(runner=cron_scheduler)
+def create_activity_partitions() -> None:
+    with psycopg.connect(settings.PSYCOPG_URI) as conn:
+        created = ensure_activity_partitions(conn, datetime.now(tz=UTC), settings.ACTIVITY_PARTITION_PREMAKE_MONTHS)
+
+    logger.info("Created %s activity partitions: %s", len(created), ", ".join(created) or "none needed")
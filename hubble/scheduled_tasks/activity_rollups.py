@@ -0,0 +1,22 @@
+import logging
+
+from datetime import UTC, datetime, timedelta
+
+import psycopg
+
+from hubble.config import settings
+from hubble.rollups import hour_start, rebuild_rollups
+from hubble.scheduled_tasks.scheduler import acquire_lock, cron_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+@acquire_lock(runner=cron_scheduler)
+def reconcile_activity_rollups() -> None:
+    # the current hour is left to the consumers, it is reconciled by the next run
+    end = hour_start(datetime.now(tz=UTC))
+    start = end - timedelta(days=settings.ACTIVITY_ROLLUP_RECONCILE_DAYS)
+    with psycopg.connect(settings.PSYCOPG_URI) as conn:
+        hours = rebuild_rollups(conn, start, end)
+
+    logger.info("Reconciled %s hours of activity rollups from %s", hours, start)
@@ -0,0 +1,13 @@
+import logging
+
+from hubble.scheduled_tasks.scheduler import acquire_lock, cron_scheduler
+from hubble.tasks.right_to_be_forgotten import requeue_stale_claimed_tasks
+
+logger = logging.getLogger(__name__)
+
+
+@acquire_lock(runner=cron_scheduler)
+def requeue_stale_anonymise_activities() -> None:
+    # tasks claimed by runs that died, e.g. a bulk run killed mid way, are otherwise never picked up again
+    if requeued := requeue_stale_claimed_tasks():
+        logger.info("Requeued %s anonymise activities tasks with stale claims", len(requeued))
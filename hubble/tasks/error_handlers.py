@@ -17,10 +17,10 @@ if TYPE_CHECKING:
 def default_handler(
     job: rq.job.Job, exc_type: type, exc_value: Exception, traceback: "Traceback"  # noqa: ARG001
 ) -> Any:  # noqa: ANN401
-
-    # set task's status to FAILED
+    # set task's status to FAILED, unless another job has completed it since, e.g. a bulk anonymise activities run
     with SessionMaker() as db_session:
-        if retry_task := db_session.get(RetryTask, job.kwargs.get("retry_task_id", -1)):
+        retry_task = db_session.get(RetryTask, job.kwargs.get("retry_task_id", -1))
+        if retry_task and retry_task.status != RetryTaskStatuses.SUCCESS:
             retry_task.update_task(db_session, status=RetryTaskStatuses.FAILED, clear_next_attempt_time=True)
 
     return True  # defer to the RQ default handler
@@ -1,167 +1,695 @@
-import hashlib
-import re
+import json
+import time
 
-from collections.abc import Sequence
-from typing import TYPE_CHECKING, Any
+from collections import Counter
+from collections.abc import Collection, Iterable
+from dataclasses import dataclass, field
+from datetime import UTC, datetime, timedelta
+from typing import TYPE_CHECKING
 from uuid import UUID
 
+from redis import RedisError
 from retry_tasks_lib.db.models import RetryTask, RetryTaskStatuses, TaskTypeKey, TaskTypeKeyValue
-from retry_tasks_lib.utils.synchronous import retryable_task
-from sqlalchemy import select
+from retry_tasks_lib.utils.synchronous import enqueue_retry_task, retryable_task, sync_create_task
+from sqlalchemy import (
+    DateTime,
+    Integer,
+    String,
+    Uuid,
+    cast,
+    column,
+    delete,
+    literal,
+    or_,
+    select,
+    tuple_,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm.attributes import flag_modified
 
-from hubble.config import redis_raw, settings
+from hubble.anonymisation import (
+    ANONYMISATION_RULES,
+    ANONYMISED_ACTIVITY_TYPES,
+    ANONYMISED_VALUES_SQL,
+    Anonymiser,
+    anonymised_values_sql,
+)
+from hubble.config import redis, redis_raw, settings
 from hubble.db.models import Activity
 from hubble.db.session import SessionMaker
+from hubble.forgotten import forget_account_holders
+from hubble.query import select_account_holder_activities, select_account_holders_activities
 from hubble.tasks.prometheus import task_processing_time_callback_fn, tasks_run_total
 
 from . import logger
 
 if TYPE_CHECKING:
+    from sqlalchemy import ColumnElement, Select
     from sqlalchemy.orm import Session
 
 
-ACCOUNT_CREDENTIALS = (
-    "email",
-    "first_name",
-    "last_name",
-    "date_of_birth",
-    "phone",
-    "address_line1",
-    "address_line2",
-    "postcode",
-    "city",
-    "custom",
+ACCOUNT_HOLDER_KEYS = frozenset(("account_holder_uuid", "account_holder_email"))
+CHECKPOINT_KEY = "anonymise_checkpoint"
+CLAIM_KEY = "anonymise_claim"
+# a task in one of these has nothing left to be claimed for
+DONE_TASK_STATUSES = (
+    RetryTaskStatuses.SUCCESS,
+    RetryTaskStatuses.FAILED,
+    RetryTaskStatuses.CANCELLED,
 )
 
+activity_table = Activity.__table__
+# the order activities are hashed in, (datetime, id)
+ActivityKey = tuple[datetime, UUID]
+
+
+class LockedActivitiesError(Exception):
+    pass
+
+
+class ClaimLostError(Exception):
+    pass
+
+
+def _dump_key(key: ActivityKey) -> list[str]:
+    return [key[0].isoformat(), str(key[1])]
+
+
+def _load_key(value: list[str]) -> ActivityKey:
+    return datetime.fromisoformat(value[0]), UUID(value[1])
+
 
-def _encode_value(account_holder_uuid: str | UUID, value: Any | None) -> str:
+@dataclass
+class AnonymisationCheckpoint:
     """
-    Returns hashlib.sha224 encoded hash str of the input str account_holder_uuid
+    How far an anonymise-activities task got, saved in the task along with every chunk of activities hashed
 
-    If the value to hash isn't the account_holder_uuid, account_holder_uuid is still
-    required as it is used as suffix and the combined str is hashed
+    after is the last activity, in (datetime, id) order, of the chunks done and locked the activities among
+    them that were locked by another transaction, still to be hashed.
     """
-    identifier = value + str(account_holder_uuid) if value else str(account_holder_uuid)
-    return hashlib.sha224((identifier).encode("utf-8")).hexdigest()
 
+    after: ActivityKey | None = None
+    locked: set[ActivityKey] = field(default_factory=set)
+
+    @classmethod
+    def loads(cls, value: str) -> "AnonymisationCheckpoint":
+        checkpoint = json.loads(value)
+        return cls(
+            after=_load_key(checkpoint["after"]) if checkpoint["after"] else None,
+            locked={_load_key(key) for key in checkpoint["locked"]},
+        )
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {
+                "after": _dump_key(self.after) if self.after else None,
+                "locked": [_dump_key(key) for key in sorted(self.locked)],
+            }
+        )
 
-def _encode_email_in_string(account_holder_uuid: str, str_val: str) -> str:
-    """
-    Return the original string with an email with the email replaced with
-    a hashed email + account_holder_uuid value
 
-    i.e 'Enrolment Requested for qatest+011@bink.com' becomes
-    'Enrolment Requested for 5a8612c878a17ec322d90d6ae2c26007533b4cb4699b4392d44f106d'
+def _save_checkpoint(db_session: "Session", retry_task_id: int, checkpoint: AnonymisationCheckpoint) -> None:
+    checkpoint_key_id = (
+        select(TaskTypeKey.task_type_key_id)
+        .join(RetryTask, RetryTask.task_type_id == TaskTypeKey.task_type_id)
+        .where(RetryTask.retry_task_id == retry_task_id, TaskTypeKey.name == CHECKPOINT_KEY)
+        .scalar_subquery()
+    )
+    statement = pg_insert(TaskTypeKeyValue).values(
+        retry_task_id=retry_task_id, task_type_key_id=checkpoint_key_id, value=checkpoint.dumps()
+    )
+    db_session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[TaskTypeKeyValue.retry_task_id, TaskTypeKeyValue.task_type_key_id],
+            set_={"value": statement.excluded.value},
+        )
+    )
 
-    Parameters:
-            account_holder_uuid (str): the account holder uuid
-            str_val (str): The original string containing an email
 
-    Returns:
-            hashed_str (str): Original string with hashed email
+def _stale_claim_before() -> datetime:
+    return datetime.now(tz=UTC) - timedelta(seconds=settings.ANONYMISE_ACTIVITIES_CLAIM_STALE_SECS)
+
+
+def _claimed_at() -> "ColumnElement[datetime]":
+    return cast(cast(TaskTypeKeyValue.value, JSONB)["at"].astext, DateTime(timezone=True))
+
+
+def _claim_tasks(db_session: "Session", owner: int, retry_task_ids: "Collection[int] | Select") -> set[int]:
+    """
+    Claims the tasks of retry_task_ids that are not done for the run of task owner, returning the ids of those
+    claimed. A task claimed by another run is left alone, unless that run has not refreshed its claim, by claiming
+    it again, for ANONYMISE_ACTIVITIES_CLAIM_STALE_SECS.
+
+    The claim is a single INSERT ... ON CONFLICT of the task's claim key, a concurrent claim of the same task waits
+    for this transaction and then finds it taken.
     """
-    pattern = r"[\w.+-]+@[\w-]+\.[\w.-]+"
-    extracted_val = re.findall(pattern, str_val)
-    encoded_val = _encode_value(account_holder_uuid, extracted_val[0])
-    return re.sub(pattern, encoded_val, str_val)
+    claim = json.dumps({"owner": owner, "at": datetime.now(tz=UTC).isoformat()})
+    claim_values = (
+        select(RetryTask.retry_task_id, TaskTypeKey.task_type_key_id, literal(claim))
+        .join(TaskTypeKey, TaskTypeKey.task_type_id == RetryTask.task_type_id)
+        .where(
+            RetryTask.retry_task_id.in_(retry_task_ids),
+            RetryTask.status.not_in(DONE_TASK_STATUSES),
+            TaskTypeKey.name == CLAIM_KEY,
+        )
+    )
+    statement = pg_insert(TaskTypeKeyValue).from_select(["retry_task_id", "task_type_key_id", "value"], claim_values)
+    claimed = db_session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[TaskTypeKeyValue.retry_task_id, TaskTypeKeyValue.task_type_key_id],
+            set_={"value": statement.excluded.value},
+            where=or_(
+                cast(TaskTypeKeyValue.value, JSONB)["owner"].as_integer() == owner,
+                _claimed_at() < _stale_claim_before(),
+            ),
+        ).returning(TaskTypeKeyValue.retry_task_id)
+    )
+    return set(claimed.scalars())
+
 
+def _refresh_claims(db_session: "Session", owner: int, retry_task_ids: Collection[int]) -> None:
+    """Refreshes the claims of a run in its current transaction, raises ClaimLostError if another run took one"""
+    if lost := set(retry_task_ids) - _claim_tasks(db_session, owner, retry_task_ids):
+        db_session.rollback()
+        raise ClaimLostError(f"Anonymise activities tasks {sorted(lost)} were claimed by another run")
 
-def _encode_field_values_in_data(account_holder_uuid: str, data: dict) -> dict:
+
+def _delete_task_values(db_session: "Session", retry_task_ids: Collection[int], *names: str) -> None:
+    db_session.execute(
+        TaskTypeKeyValue.__table__.delete().where(
+            TaskTypeKeyValue.retry_task_id.in_(retry_task_ids),
+            TaskTypeKeyValue.task_type_key_id == TaskTypeKey.task_type_key_id,
+            TaskTypeKey.name.in_(names),
+        )
+    )
+
+
+def _release_claims(db_session: "Session", owner: int, retry_task_ids: Collection[int]) -> list[int]:
+    """Releases the claims owner still holds on tasks, returning the ids of the tasks released"""
+    return list(
+        db_session.execute(
+            delete(TaskTypeKeyValue)
+            .where(
+                TaskTypeKeyValue.retry_task_id.in_(retry_task_ids),
+                TaskTypeKeyValue.task_type_key_id == TaskTypeKey.task_type_key_id,
+                TaskTypeKey.name == CLAIM_KEY,
+                cast(TaskTypeKeyValue.value, JSONB)["owner"].as_integer() == owner,
+            )
+            .returning(TaskTypeKeyValue.retry_task_id),
+            execution_options={"synchronize_session": False},
+        ).scalars()
+    )
+
+
+def _requeue_tasks(db_session: "Session", retry_task_ids: Collection[int]) -> None:
+    """
+    Puts claimed tasks back to PENDING and enqueues them, for their own jobs to carry on from their checkpoints.
+    The claims must have been released in the current transaction, which is committed.
     """
-    Returns the input AccountRequestActivityData with the specified
-    field values hashed with _encode_value fn
+    _set_tasks_status(db_session, retry_task_ids, RetryTaskStatuses.PENDING)
+    db_session.commit()
+    for retry_task in db_session.scalars(select(RetryTask).where(RetryTask.retry_task_id.in_(retry_task_ids))):
+        enqueue_retry_task(connection=redis_raw, retry_task=retry_task)
 
-    Parameters:
-            account_holder_uuid (str): the account holder uuid
-            data (AccountRequestActivityData): The original activity data
 
-    Returns:
-            data (AccountRequestActivityData): Original data with hashed field values
+def requeue_stale_claimed_tasks() -> list[int]:
     """
-    for field in data["fields"]:
-        if field["field_name"] in ACCOUNT_CREDENTIALS:
-            field["value"] = _encode_value(account_holder_uuid, field["value"])
-    return data
+    Requeues the anonymise-activities tasks whose claims have gone stale, left behind by runs that died, e.g. a
+    bulk run killed after claiming the tasks of its retailer. Returns their ids.
+    """
+    with SessionMaker() as db_session:
+        stale = list(
+            db_session.execute(
+                delete(TaskTypeKeyValue)
+                .where(
+                    TaskTypeKeyValue.task_type_key_id == TaskTypeKey.task_type_key_id,
+                    TaskTypeKey.name == CLAIM_KEY,
+                    TaskTypeKeyValue.retry_task_id == RetryTask.retry_task_id,
+                    RetryTask.status.not_in(DONE_TASK_STATUSES),
+                    _claimed_at() < _stale_claim_before(),
+                )
+                .returning(TaskTypeKeyValue.retry_task_id),
+                execution_options={"synchronize_session": False},
+            ).scalars()
+        )
+        if stale:
+            logger.warning("Requeueing anonymise activities tasks %s with stale claims", stale)
+            _requeue_tasks(db_session, stale)
+        else:
+            db_session.commit()
+
+    return stale
 
 
-def _anonymise_account_request_activity(activity: Activity, account_holder_uuid: str) -> str:
-    match activity.type:
-        case "ACCOUNT_REQUEST":
-            activity.summary = _encode_email_in_string(account_holder_uuid, activity.summary)
-            activity.associated_value = _encode_value(account_holder_uuid, activity.associated_value)
-            activity.data = _encode_field_values_in_data(account_holder_uuid, activity.data)
-            flag_modified(activity, "data")
+def _anonymise_activity(anonymiser: Anonymiser, activity: Activity) -> ActivityKey:
+    """Hashes a loaded activity with the rule for its type"""
+    columns = ANONYMISATION_RULES[activity.type].anonymised_columns
+    row = {name: getattr(activity, name) for name in columns}
+    anonymiser.anonymise(activity.type, row)
+    for name, value in row.items():
+        setattr(activity, name, value)
+    if "data" in row:
+        # hashed in place, which SQLAlchemy cannot see
+        flag_modified(activity, "data")
 
-        case "EMAIL_EVENT":
-            if "email" in activity.data:
-                activity.data["email"] = _encode_value(account_holder_uuid, activity.data["email"])
-                flag_modified(activity, "data")
+    return activity.datetime, activity.id
 
-    return str(activity.id)
+
+def _anonymise_chunk_sql(
+    db_session: "Session", keys: Collection[ActivityKey], anonymiser: Anonymiser
+) -> set[ActivityKey]:
+    """Hashes the activities of keys in postgres, skipping those locked. Returns the keys of the ones hashed."""
+    columns = activity_table.c
+    lockable = (
+        select(columns.id, columns.datetime)
+        .where(tuple_(columns.datetime, columns.id).in_(keys))
+        .with_for_update(skip_locked=True)
+    )
+    rows = db_session.execute(
+        update(Activity)
+        .where(tuple_(columns.id, columns.datetime).in_(lockable))
+        .values(ANONYMISED_VALUES_SQL)
+        .returning(columns.datetime, columns.id),
+        {"account_holder_uuid": anonymiser.account_holder_uuid},
+        # the hashed values are only known to postgres, any loaded Activity is stale until refreshed
+        execution_options={"synchronize_session": False},
+    )
+    return {(activity_datetime, activity_id) for activity_datetime, activity_id in rows}
 
 
-def _get_account_activities(
-    db_session: "Session",
-    retailer_slug: str,
-    account_holder_uuid: str,
-    account_holder_email: str,
-    activity_types: set[str],
-) -> "Sequence[Activity]":
-    return (
+def _anonymise_chunk_orm(
+    db_session: "Session", keys: Collection[ActivityKey], anonymiser: Anonymiser
+) -> set[ActivityKey]:
+    """_anonymise_chunk_sql loading and hashing the activities one by one in python"""
+    activities = (
         db_session.execute(
-            select(Activity)
+            select(Activity).where(tuple_(Activity.datetime, Activity.id).in_(keys)).with_for_update(skip_locked=True)
+        )
+        .scalars()
+        .all()
+    )
+    return {_anonymise_activity(anonymiser, activity) for activity in activities}
+
+
+class _AccountHolderAnonymisation:
+    """
+    Hashes the activities of the account holder of an anonymise-activities task with the configured engine, in
+    chunks of ANONYMISE_ACTIVITIES_CHUNK_ROWS each committed along with the task's checkpoint, so locks are only
+    held for a chunk and a retry carries on from the last chunk committed
+
+    Activities locked by another transaction are skipped, then retried up to ANONYMISE_ACTIVITIES_LOCKED_RETRIES
+    times once every chunk is done. The task's claim is refreshed with every chunk, ClaimLostError is raised once
+    another run has taken it over.
+    """
+
+    def __init__(self, db_session: "Session", retry_task_id: int, task_params: dict[str, str]) -> None:
+        self.db_session = db_session
+        self.retry_task_id = retry_task_id
+        self.anonymiser = Anonymiser(task_params["account_holder_uuid"])
+        self.anonymise_chunk = (
+            _anonymise_chunk_sql if settings.ANONYMISE_ACTIVITIES_ENGINE == "sql" else _anonymise_chunk_orm
+        )
+        self.checkpoint = (
+            AnonymisationCheckpoint.loads(task_params[CHECKPOINT_KEY])
+            if CHECKPOINT_KEY in task_params
+            else AnonymisationCheckpoint()
+        )
+        self.hashed = 0
+
+        columns = activity_table.c
+        self.account_activities = select(columns.datetime, columns.id).where(
+            tuple_(columns.id, columns.datetime).in_(
+                select_account_holder_activities(
+                    task_params["retailer_slug"],
+                    user_id=task_params["account_holder_uuid"],
+                    email=task_params["account_holder_email"],
+                    types=ANONYMISED_ACTIVITY_TYPES,
+                )
+            )
+        )
+
+    def _keys(self, query: "Select") -> list[ActivityKey]:
+        return [(activity_datetime, activity_id) for activity_datetime, activity_id in self.db_session.execute(query)]
+
+    def _anonymise(self, keys: list[ActivityKey]) -> set[ActivityKey]:
+        """Hashes a chunk and commits it with the checkpoint, returning the keys of the activities still locked"""
+        anonymised = self.anonymise_chunk(self.db_session, keys, self.anonymiser)
+        self.hashed += len(anonymised)
+        return set(keys) - anonymised
+
+    def _save(self) -> None:
+        _save_checkpoint(self.db_session, self.retry_task_id, self.checkpoint)
+        _refresh_claims(self.db_session, self.retry_task_id, [self.retry_task_id])
+        self.db_session.commit()
+
+    def hash_chunks(self) -> None:
+        columns = activity_table.c
+        ordered = self.account_activities.order_by(columns.datetime, columns.id).limit(
+            settings.ANONYMISE_ACTIVITIES_CHUNK_ROWS
+        )
+        while True:
+            chunk = ordered
+            if self.checkpoint.after is not None:
+                chunk = chunk.where(tuple_(columns.datetime, columns.id) > self.checkpoint.after)
+            if not (keys := self._keys(chunk)):
+                return
+
+            self.checkpoint.locked |= self._anonymise(keys)
+            self.checkpoint.after = keys[-1]
+            self._save()
+
+    def retry_locked(self) -> None:
+        columns = activity_table.c
+        chunk_rows = settings.ANONYMISE_ACTIVITIES_CHUNK_ROWS
+        locked = sorted(self.checkpoint.locked)
+        for start in range(0, len(locked), chunk_rows):
+            locked_chunk = locked[start : start + chunk_rows]
+            # activities archived since or no longer the account holder's are dropped
+            keys = self._keys(self.account_activities.where(tuple_(columns.datetime, columns.id).in_(locked_chunk)))
+            self.checkpoint.locked.difference_update(locked_chunk)
+            self.checkpoint.locked |= self._anonymise(keys)
+            self._save()
+
+    def run(self) -> int:
+        """Returns the number of activities hashed, raises LockedActivitiesError when some are still locked"""
+        self.hash_chunks()
+        for _ in range(settings.ANONYMISE_ACTIVITIES_LOCKED_RETRIES):
+            if not self.checkpoint.locked:
+                break
+
+            logger.info(
+                "Retrying %s locked activities of retry task %s", len(self.checkpoint.locked), self.retry_task_id
+            )
+            time.sleep(settings.ANONYMISE_ACTIVITIES_LOCKED_RETRY_DELAY_SECS)
+            self.retry_locked()
+
+        if self.checkpoint.locked:
+            raise LockedActivitiesError(
+                f"{len(self.checkpoint.locked)} activities of retry task {self.retry_task_id} are still locked, "
+                "they are retried with the task"
+            )
+
+        return self.hashed
+
+
+def _anonymise_account_holder_activities(db_session: "Session", retry_task_id: int, task_params: dict[str, str]) -> int:
+    return _AccountHolderAnonymisation(db_session, retry_task_id, task_params).run()
+
+
+class _BulkAnonymisation:
+    """
+    Hashes the activities of the account holders of many anonymise-activities tasks of a retailer together, in
+    chunks of ANONYMISE_ACTIVITIES_CHUNK_ROWS activities each hashed with one UPDATE, joined from a VALUES list of
+    the activities of the chunk and the uuid of the account holder each belongs to
+
+    As with _AccountHolderAnonymisation, activities locked by another transaction are skipped and every chunk is
+    committed along with the checkpoint of each task and the refresh of the run's claims. The chunks go through
+    all of the account holders' activities in (datetime, id) order, so each checkpoint is also valid for its task
+    on its own, which carries on from there to retry its locked activities or should the run fail.
+    """
+
+    def __init__(
+        self, db_session: "Session", owner: int, retailer_slug: str, tasks_params: dict[int, dict[str, str]]
+    ) -> None:
+        self.db_session = db_session
+        self.owner = owner
+        self.checkpoints = {retry_task_id: AnonymisationCheckpoint() for retry_task_id in tasks_params}
+        # the checkpoints as last committed, which the tasks carry on from should a chunk fail
+        self.committed: dict[int, str] = {}
+        self.hashed: Counter[int] = Counter()
+
+        account_holders = values(
+            column("retry_task_id", Integer),
+            column("account_holder_uuid", String),
+            column("account_holder_email", String),
+            name="account_holders",
+        ).data(
+            [
+                (retry_task_id, params["account_holder_uuid"], params["account_holder_email"])
+                for retry_task_id, params in tasks_params.items()
+            ]
+        )
+        self.matched = select_account_holders_activities(
+            retailer_slug, account_holders, types=ANONYMISED_ACTIVITY_TYPES
+        ).subquery()
+
+    def _next_chunk(self, after: ActivityKey | None) -> list[tuple[datetime, UUID, int, str]]:
+        matched = self.matched.c
+        chunk = (
+            select(matched.datetime, matched.id, matched.retry_task_id, matched.account_holder_uuid)
+            .order_by(matched.datetime, matched.id)
+            .limit(settings.ANONYMISE_ACTIVITIES_CHUNK_ROWS)
+        )
+        if after is not None:
+            chunk = chunk.where(tuple_(matched.datetime, matched.id) > after)
+
+        return [tuple(row) for row in self.db_session.execute(chunk)]
+
+    def _anonymise(self, chunk: list[tuple[datetime, UUID, int, str]]) -> set[ActivityKey]:
+        """Hashes the activities of a chunk, skipping those locked. Returns the keys of the ones hashed."""
+        columns = activity_table.c
+        chunk_activities = values(
+            column("datetime", DateTime), column("id", Uuid), column("account_holder_uuid", String), name="chunk"
+        ).data([(activity_datetime, activity_id, uuid) for activity_datetime, activity_id, _, uuid in chunk])
+        lockable = (
+            select(columns.id, columns.datetime)
+            .where(tuple_(columns.datetime, columns.id).in_([activity[:2] for activity in chunk]))
             .with_for_update(skip_locked=True)
+        )
+        rows = self.db_session.execute(
+            update(Activity)
             .where(
-                Activity.retailer == retailer_slug,
-                Activity.type.in_(activity_types),
-                (Activity.associated_value.ilike(account_holder_email)) | (Activity.user_id == account_holder_uuid),
+                columns.id == chunk_activities.c.id,
+                columns.datetime == chunk_activities.c.datetime,
+                tuple_(columns.id, columns.datetime).in_(lockable),
             )
+            .values(anonymised_values_sql(ANONYMISATION_RULES, chunk_activities.c.account_holder_uuid))
+            .returning(columns.datetime, columns.id),
+            execution_options={"synchronize_session": False},
         )
-        .scalars()
-        .all()
+        return {(activity_datetime, activity_id) for activity_datetime, activity_id in rows}
+
+    def _save(self) -> None:
+        for retry_task_id, checkpoint in self.checkpoints.items():
+            _save_checkpoint(self.db_session, retry_task_id, checkpoint)
+        _refresh_claims(self.db_session, self.owner, self.checkpoints)
+        self.db_session.commit()
+        self.committed = {retry_task_id: checkpoint.dumps() for retry_task_id, checkpoint in self.checkpoints.items()}
+
+    def run(self) -> Counter[int]:
+        """Returns the number of activities hashed by retry task id"""
+        after: ActivityKey | None = None
+        while chunk := self._next_chunk(after):
+            anonymised = self._anonymise(chunk)
+            for activity_datetime, activity_id, retry_task_id, _ in chunk:
+                if (activity_datetime, activity_id) in anonymised:
+                    self.hashed[retry_task_id] += 1
+                else:
+                    self.checkpoints[retry_task_id].locked.add((activity_datetime, activity_id))
+
+            after = chunk[-1][0], chunk[-1][1]
+            for checkpoint in self.checkpoints.values():
+                checkpoint.after = after
+            self._save()
+
+        return self.hashed
+
+
+def _forget_account_holders(retailer_slug: str, tasks_params: Collection[dict[str, str]]) -> None:
+    """
+    Records the account holders of tasks in the index hubble.forgotten keeps for the consumers, while their emails
+    are still known, so that activities of theirs arriving later are hashed too
+    """
+    forget_account_holders(
+        redis,
+        retailer_slug,
+        ((params["account_holder_uuid"], params["account_holder_email"]) for params in tasks_params),
+    )
+
+
+def _set_tasks_status(db_session: "Session", retry_task_ids: Collection[int], status: RetryTaskStatuses) -> None:
+    db_session.execute(
+        update(RetryTask)
+        .where(RetryTask.retry_task_id.in_(retry_task_ids))
+        .values(status=status, next_attempt_time=None),
+        execution_options={"synchronize_session": False},
+    )
+
+
+def _claim_pending_tasks(db_session: "Session", retry_task: RetryTask, retailer_slug: str) -> dict[int, dict[str, str]]:
+    """
+    Claims up to ANONYMISE_ACTIVITIES_BULK_MAX_TASKS - 1 other pending anonymise-activities tasks of the retailer
+    for the run of retry_task, so that their own jobs leave them alone. Tasks with a checkpoint have activities
+    hashed already and are left to their own jobs.
+
+    Returns the params of the claimed tasks by retry task id. Tasks missing an account holder are failed.
+    """
+    retailer_tasks = (
+        select(TaskTypeKeyValue.retry_task_id)
+        .join(TaskTypeKey)
+        .where(TaskTypeKey.name == "retailer_slug", TaskTypeKeyValue.value == retailer_slug)
+    )
+    started_tasks = select(TaskTypeKeyValue.retry_task_id).join(TaskTypeKey).where(TaskTypeKey.name == CHECKPOINT_KEY)
+    pending_tasks = (
+        select(RetryTask.retry_task_id)
+        .where(
+            RetryTask.task_type_id == retry_task.task_type_id,
+            RetryTask.status == RetryTaskStatuses.PENDING,
+            RetryTask.retry_task_id != retry_task.retry_task_id,
+            RetryTask.retry_task_id.in_(retailer_tasks),
+            RetryTask.retry_task_id.not_in(started_tasks),
+        )
+        .order_by(RetryTask.retry_task_id)
+        .limit(settings.ANONYMISE_ACTIVITIES_BULK_MAX_TASKS - 1)
     )
+    claimed = _claim_tasks(db_session, retry_task.retry_task_id, pending_tasks)
+    tasks_params: dict[int, dict[str, str]] = {retry_task_id: {} for retry_task_id in claimed}
+    for retry_task_id, name, value in db_session.execute(
+        select(TaskTypeKeyValue.retry_task_id, TaskTypeKey.name, TaskTypeKeyValue.value)
+        .join(TaskTypeKey)
+        .where(TaskTypeKeyValue.retry_task_id.in_(claimed))
+    ):
+        tasks_params[retry_task_id][name] = value
+
+    if incomplete := [
+        retry_task_id for retry_task_id, params in tasks_params.items() if not params.keys() >= ACCOUNT_HOLDER_KEYS
+    ]:
+        logger.error("Failing anonymise activities tasks %s missing an account holder", incomplete)
+        _set_tasks_status(db_session, incomplete, RetryTaskStatuses.FAILED)
+        for retry_task_id in incomplete:
+            del tasks_params[retry_task_id]
+
+    db_session.commit()
+    return tasks_params
+
+
+def _anonymise_claimed_tasks(
+    db_session: "Session", retry_task: RetryTask, task_params: dict[str, str], claimed: dict[int, dict[str, str]]
+) -> None:
+    """
+    Hashes the activities of retry_task's account holder along with those of the tasks claimed for its run, then
+    updates task_params with retry_task's checkpoint for it to carry on from on its own
+
+    The claimed tasks with no activities left locked are marked SUCCESS. The others are released and requeued for
+    their own jobs to retry their locked activities, as are all of them should the run fail.
+    """
+    owner, retailer_slug = retry_task.retry_task_id, task_params["retailer_slug"]
+    bulk = _BulkAnonymisation(db_session, owner, retailer_slug, {owner: task_params} | claimed)
+    requeued: Collection[int] = claimed
+    try:
+        hashed = bulk.run()
+        complete = {
+            retry_task_id: params
+            for retry_task_id, params in claimed.items()
+            if not bulk.checkpoints[retry_task_id].locked
+        }
+        _forget_account_holders(retailer_slug, complete.values())
+        _delete_task_values(db_session, complete, "account_holder_email", CLAIM_KEY)
+        _set_tasks_status(db_session, complete, RetryTaskStatuses.SUCCESS)
+        requeued = claimed.keys() - complete.keys()
+        logger.info(
+            "Anonymised %s activities of %s account holders in bulk, by retry task id: %s",
+            hashed.total(),
+            len(claimed) + 1,
+            dict(hashed),
+        )
+    except (DBAPIError, RedisError, ClaimLostError):
+        db_session.rollback()
+        logger.exception("Failed to anonymise the activities of %s account holders in bulk", len(claimed) + 1)
+
+    _requeue_tasks(db_session, _release_claims(db_session, owner, requeued))
+    if owner in bulk.committed:
+        task_params[CHECKPOINT_KEY] = bulk.committed[owner]
+
+
+def _log_anonymised(hashed: int, account_holder_uuid: str) -> None:
+    if hashed:
+        logger.info("Successfully anonymised %s activities for account_holder_uuid: %s", hashed, account_holder_uuid)
+    else:
+        logger.info("No activities to update")
+
+
+def enqueue_anonymise_activities(account_holders: Iterable[tuple[str, str, str]]) -> list[int]:
+    """
+    Creates and enqueues an anonymise-activities task for each (retailer slug, account holder uuid, email),
+    returning the ids of the tasks
+    """
+    with SessionMaker() as db_session:
+        retry_tasks = [
+            sync_create_task(
+                db_session,
+                task_type_name=settings.ANONYMISE_ACTIVITIES_TASK_NAME,
+                params={
+                    "retailer_slug": retailer_slug,
+                    "account_holder_uuid": account_holder_uuid,
+                    "account_holder_email": email,
+                },
+            )
+            for retailer_slug, account_holder_uuid, email in account_holders
+        ]
+        db_session.commit()
+        for retry_task in retry_tasks:
+            enqueue_retry_task(connection=redis_raw, retry_task=retry_task)
+
+        return [retry_task.retry_task_id for retry_task in retry_tasks]
 
 
 # NOTE: Inter-dependency: If this function's name or module changes, ensure that
 # it is relevantly reflected in the TaskType table
+def anonymise_activities(retry_task_id: int) -> None:
+    """
+    Claims an anonymise-activities task for its job and runs it, unless it is done or the run of another task holds
+    a claim on it, which is then left to finish or requeue it. A claim gone stale is taken over.
+    """
+    with SessionMaker() as db_session:
+        claimed = _claim_tasks(db_session, retry_task_id, [retry_task_id])
+        db_session.commit()
+    if not claimed:
+        logger.info("Anonymise activities task %s is done or claimed by another run", retry_task_id)
+        return
+
+    _anonymise_activities(retry_task_id=retry_task_id)
+
+
 @retryable_task(
     db_session_factory=SessionMaker, redis_connection=redis_raw, metrics_callback_fn=task_processing_time_callback_fn
 )
-def anonymise_activities(retry_task: RetryTask, db_session: "Session") -> None:
+def _anonymise_activities(retry_task: RetryTask, db_session: "Session") -> None:
     if settings.ACTIVATE_TASKS_METRICS:
         tasks_run_total.labels(app=settings.PROJECT_NAME, task_name=settings.ANONYMISE_ACTIVITIES_TASK_NAME).inc()
 
     task_params: dict[str, str] = retry_task.get_params()
-    account_holder_uuid = task_params["account_holder_uuid"]
-
-    # At the time of writing (09/03/2023). ACCOUNT_REQUEST is the only activity which contains information
-    # needing to be hashed
-    account_activities = _get_account_activities(
-        db_session,
-        task_params["retailer_slug"],
-        account_holder_uuid,
-        task_params["account_holder_email"],
-        {"ACCOUNT_REQUEST", "EMAIL_EVENT"},
-    )
-    if updated_activities := [
-        _anonymise_account_request_activity(activity, account_holder_uuid) for activity in account_activities
-    ]:
-        db_session.commit()
-        logger.info(
-            "Successfully anonymised the following activities: %s for account_holder_uuid: %s",
-            updated_activities,
-            account_holder_uuid,
-        )
-    else:
-        logger.info("No activities to update")
 
-    db_session.execute(
-        TaskTypeKeyValue.__table__.delete().where(
-            TaskTypeKeyValue.retry_task_id == retry_task.retry_task_id,
-            TaskTypeKeyValue.task_type_key_id == TaskTypeKey.task_type_key_id,
-            TaskTypeKey.name == "account_holder_email",
-        )
-    )
+    claimed: dict[int, dict[str, str]] = {}
+    # a task resuming from a checkpoint has activities that are already hashed, only its chunks skip them
+    if (
+        settings.ANONYMISE_ACTIVITIES_ENGINE == "sql"
+        and settings.ANONYMISE_ACTIVITIES_BULK_MAX_TASKS > 1
+        and CHECKPOINT_KEY not in task_params
+    ):
+        claimed = _claim_pending_tasks(db_session, retry_task, task_params["retailer_slug"])
+        if settings.ACTIVATE_TASKS_METRICS and claimed:
+            tasks_run_total.labels(app=settings.PROJECT_NAME, task_name=settings.ANONYMISE_ACTIVITIES_TASK_NAME).inc(
+                len(claimed)
+            )
+
+    if claimed:
+        _anonymise_claimed_tasks(db_session, retry_task, task_params, claimed)
+
+    try:
+        # after a bulk run, only what it left locked or what has arrived since
+        hashed = _anonymise_account_holder_activities(db_session, retry_task.retry_task_id, task_params)
+    except ClaimLostError:
+        # the run that took the task over sees it through
+        logger.warning("Anonymise activities task %s taken over by another run", retry_task.retry_task_id)
+        return
+
+    _log_anonymised(hashed, task_params["account_holder_uuid"])
+    _forget_account_holders(task_params["retailer_slug"], [task_params])
+    _delete_task_values(db_session, [retry_task.retry_task_id], "account_holder_email", CLAIM_KEY)
     db_session.flush()
     retry_task.update_task(db_session, status=RetryTaskStatuses.SUCCESS, clear_next_attempt_time=True)
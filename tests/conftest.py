@@ -90,6 +90,8 @@ def anonymise_activities_task_type(db_session: "Session") -> TaskType:
                 ("retailer_slug", "STRING"),
                 ("account_holder_uuid", "STRING"),
                 ("account_holder_email", "STRING"),
+                ("anonymise_checkpoint", "STRING"),
+                ("anonymise_claim", "STRING"),
             )
         ]
     )
@@ -99,7 +101,6 @@ def anonymise_activities_task_type(db_session: "Session") -> TaskType:
 
 @pytest.fixture(scope="function")
 def anonymise_activities_task(db_session: "Session", anonymise_activities_task_type: TaskType) -> TaskType:
-
     rt = RetryTask(task_type_id=anonymise_activities_task_type.task_type_id)
     db_session.add(rt)
     db_session.flush()
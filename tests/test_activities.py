@@ -0,0 +1,98 @@
+import uuid
+
+from datetime import UTC, datetime
+from typing import Any
+
+import pytest
+
+from cosmos_message_lib import ActivitySchema
+
+from hubble.messaging.activities import activities_from_body, prepare_for_insert, validate_activity
+
+VALID_ACTIVITY = {
+    "id": str(uuid.uuid4()),
+    "type": "TX_HISTORY",
+    "datetime": datetime.now(tz=UTC).isoformat(),
+    "underlying_datetime": "2023-03-09T14:35:35.639490",
+    "summary": "Headline!",
+    "reasons": ["a reason", "another reason"],
+    "activity_identifier": "a_id",
+    "user_id": str(uuid.uuid4()),
+    "associated_value": "42",
+    "retailer": "asos",
+    "campaigns": ["ASOS_EXTRA"],
+    "data": {"some": "data", "nested": {"list": [1, 2, 3]}},
+}
+
+PAYLOADS: list[Any] = [
+    VALID_ACTIVITY,
+    {k: v for k, v in VALID_ACTIVITY.items() if k != "id"},
+    VALID_ACTIVITY | {"datetime": datetime.now(tz=UTC)},
+    VALID_ACTIVITY | {"datetime": 1681396492},
+    VALID_ACTIVITY | {"user_id": uuid.uuid4()},
+    VALID_ACTIVITY | {"associated_value": 42},
+    VALID_ACTIVITY | {"reasons": []},
+    VALID_ACTIVITY | {"campaigns": ("a", "b")},
+    VALID_ACTIVITY | {"data": {}},
+    VALID_ACTIVITY | {"unexpected": "field"},
+    VALID_ACTIVITY | {"id": "not-a-uuid"},
+    VALID_ACTIVITY | {"id": None},
+    VALID_ACTIVITY | {"datetime": "not a date"},
+    VALID_ACTIVITY | {"datetime": None},
+    VALID_ACTIVITY | {"summary": None},
+    VALID_ACTIVITY | {"summary": ["a", "list"]},
+    VALID_ACTIVITY | {"reasons": "a reason"},
+    VALID_ACTIVITY | {"reasons": [None]},
+    VALID_ACTIVITY | {"campaigns": None},
+    VALID_ACTIVITY | {"data": None},
+    VALID_ACTIVITY | {"data": ["not", "a", "dict"]},
+    VALID_ACTIVITY | {"data": "string"},
+    *({k: v for k, v in VALID_ACTIVITY.items() if k != missing} for missing in VALID_ACTIVITY if missing != "id"),
+    {},
+    {"some": "bad data"},
+    [],
+    "activity",
+    None,
+    42,
+]
+
+
+def _schema_result(payload: Any) -> dict | None:  # noqa: ANN401
+    try:
+        return prepare_for_insert(ActivitySchema(**payload))
+    except Exception:  # noqa: BLE001
+        return None
+
+
+def _fast_path_result(payload: Any) -> dict | None:  # noqa: ANN401
+    try:
+        return validate_activity(payload)
+    except Exception:  # noqa: BLE001
+        return None
+
+
+def _comparable(row: dict) -> dict:
+    return row | {"id": None, "data": row["data"].obj}
+
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_validate_activity_parity(payload: Any) -> None:  # noqa: ANN401
+    expected, result = _schema_result(payload), _fast_path_result(payload)
+
+    assert (expected is None) == (result is None)
+    if expected is not None and result is not None:
+        assert _comparable(result) == _comparable(expected)
+        if "id" in payload:
+            assert result["id"] == expected["id"]
+
+
+def test_activities_from_body_list() -> None:
+    rows = activities_from_body([VALID_ACTIVITY] * 3)
+
+    assert len(rows) == 3
+    assert all(_comparable(row) == _comparable(prepare_for_insert(ActivitySchema(**VALID_ACTIVITY))) for row in rows)
+
+
+def test_activities_from_body_rejects_whole_list() -> None:
+    with pytest.raises(ValueError):
+        activities_from_body([VALID_ACTIVITY, {"some": "bad data"}])
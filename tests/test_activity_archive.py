@@ -0,0 +1,126 @@
+import json
+import uuid
+
+from datetime import UTC, datetime, timedelta, timezone
+from typing import TYPE_CHECKING
+from unittest import mock
+
+import pytest
+
+from hubble.anonymisation import encode_value
+from hubble.config import redis
+from hubble.forgotten import forget_account_holders, forgotten_key
+from hubble.scheduled_tasks.activity_archive import (
+    MANIFEST_NAME,
+    ArchiveIntegrityError,
+    anonymise_restored,
+    archive_activities,
+    archive_cutoff,
+    restore_activities,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+    from psycopg import Connection
+    from psycopg.rows import DictRow
+
+    from hubble.db.models import Activity
+
+
+def test_archive_cutoff() -> None:
+    assert archive_cutoff(datetime(2023, 5, 17, 0, 30, tzinfo=UTC), 30) == datetime(2023, 4, 17)  # noqa: DTZ001
+    # it is still the 16th in UTC, so that is the day the cutoff is based on
+    bst = timezone(timedelta(hours=1))
+    assert archive_cutoff(datetime(2023, 5, 17, 0, 30, tzinfo=bst), 30) == datetime(2023, 4, 16)  # noqa: DTZ001
+
+
+def test_restore_activities_rejects_unknown_columns(tmp_path: "Path") -> None:
+    (tmp_path / MANIFEST_NAME).write_text(json.dumps({"columns": ["id", "type"], "files": []}))
+    with pytest.raises(ArchiveIntegrityError):
+        restore_activities(mock.MagicMock(), tmp_path)
+
+
+def _activity_ids(conn: "Connection[DictRow]") -> set[uuid.UUID]:
+    return {row["id"] for row in conn.execute("SELECT id FROM activity").fetchall()}
+
+
+def test_activity_archive_roundtrip(
+    tmp_path: "Path", psycopg_connection: "Connection[DictRow]", create_activity: "Callable[..., Activity]"
+) -> None:
+    now = datetime.now(tz=UTC)
+    old = {create_activity(id=uuid.uuid4(), datetime=now - timedelta(days=40 + i)).id for i in range(5)}
+    kept = {create_activity(id=uuid.uuid4(), datetime=now - timedelta(days=i)).id for i in range(3)}
+
+    manifest = archive_activities(psycopg_connection, tmp_path, archive_cutoff(now, 30), batch_rows=2, max_runtime=60)
+
+    assert manifest["rows"] == 5
+    assert [entry["rows"] for entry in manifest["files"]] == [2, 2, 1]
+    (run_directory,) = tmp_path.iterdir()
+    assert json.loads((run_directory / MANIFEST_NAME).read_text()) == manifest | {"columns": list(manifest["columns"])}
+    assert _activity_ids(psycopg_connection) == kept
+
+    assert restore_activities(psycopg_connection, run_directory) == 5
+    assert _activity_ids(psycopg_connection) == old | kept
+    # already restored activities are skipped
+    assert restore_activities(psycopg_connection, run_directory) == 0
+
+    # a tampered file is not restored
+    psycopg_connection.execute("DELETE FROM activity")
+    entry = manifest["files"][0]
+    (run_directory / MANIFEST_NAME).write_text(json.dumps(manifest | {"files": [entry | {"sha256": "0" * 64}]}))
+    with pytest.raises(ArchiveIntegrityError):
+        restore_activities(psycopg_connection, run_directory)
+    assert not _activity_ids(psycopg_connection)
+
+
+def test_anonymise_restored_without_forgotten_account_holders() -> None:
+    mock_cur = mock.MagicMock()
+    mock_cur.description = [mock.Mock() for _ in range(3)]
+    for description, column in zip(mock_cur.description, ("id", "type", "data"), strict=True):
+        description.name = column
+    mock_cur.fetchall.return_value = [(uuid.uuid4(), "EMAIL_EVENT", {"email": "holder@user.email"})]
+
+    with mock.patch("hubble.scheduled_tasks.activity_archive.anonymise_forgotten", return_value=0) as mock_anonymise:
+        assert anonymise_restored(mock_cur) == 0
+
+    (activity,) = mock_anonymise.call_args.args[1]
+    assert activity["data"].obj == {"email": "holder@user.email"}
+    # only the SELECT, nothing to write back
+    assert mock_cur.execute.call_count == 1
+
+
+def test_activity_archive_restore_hashes_forgotten_account_holders(
+    tmp_path: "Path", psycopg_connection: "Connection[DictRow]", create_activity: "Callable[..., Activity]"
+) -> None:
+    now = datetime.now(tz=UTC)
+    account_holder_uuid, email = str(uuid.uuid4()), "forgotten@user.email"
+    forgotten, other = (
+        create_activity(
+            id=uuid.uuid4(),
+            type="EMAIL_EVENT",
+            retailer="test-retailer",
+            user_id=user_id,
+            datetime=now - timedelta(days=40),
+            data={"email": user_email},
+        )
+        for user_id, user_email in ((account_holder_uuid, email), (str(uuid.uuid4()), "other@user.email"))
+    )
+    archive_activities(psycopg_connection, tmp_path, archive_cutoff(now, 30), batch_rows=10, max_runtime=60)
+    (run_directory,) = tmp_path.iterdir()
+
+    # forgotten after the archive was taken
+    forget_account_holders(redis, "test-retailer", [(account_holder_uuid, email)])
+    try:
+        assert restore_activities(psycopg_connection, run_directory) == 2
+    finally:
+        redis.delete(forgotten_key("test-retailer"))
+
+    restored = {
+        row["id"]: row["data"] for row in psycopg_connection.execute("SELECT id, data FROM activity").fetchall()
+    }
+    assert restored == {
+        forgotten.id: {"email": encode_value(account_holder_uuid, email)},
+        other.id: {"email": "other@user.email"},
+    }
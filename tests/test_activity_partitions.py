@@ -0,0 +1,73 @@
+import uuid
+
+from datetime import UTC, datetime
+from typing import TYPE_CHECKING
+
+import pytest
+
+from psycopg import sql
+
+from hubble.scheduled_tasks.activity_partitions import (
+    DEFAULT_PARTITION,
+    ensure_activity_partitions,
+    month_start,
+    partition_name,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from psycopg import Connection
+    from psycopg.rows import DictRow
+
+    from hubble.db.models import Activity
+
+
+@pytest.mark.parametrize(
+    ("value", "months_ahead", "expected"),
+    [
+        (datetime(2023, 5, 17, 13, 45, tzinfo=UTC), 0, datetime(2023, 5, 1, tzinfo=UTC)),
+        (datetime(2023, 5, 17, 13, 45, tzinfo=UTC), 1, datetime(2023, 6, 1, tzinfo=UTC)),
+        (datetime(2023, 11, 30, tzinfo=UTC), 3, datetime(2024, 2, 1, tzinfo=UTC)),
+        (datetime(2023, 12, 1, tzinfo=UTC), 1, datetime(2024, 1, 1, tzinfo=UTC)),
+    ],
+)
+def test_month_start(value: datetime, months_ahead: int, expected: datetime) -> None:
+    assert month_start(value, months_ahead) == expected
+
+
+def test_partition_name() -> None:
+    assert partition_name(datetime(2023, 2, 1, tzinfo=UTC)) == "activity_2023_02"
+
+
+def _partitions(conn: "Connection[DictRow]") -> list[str]:
+    rows = conn.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'activity'::regclass ORDER BY c.relname"
+    ).fetchall()
+    return [row["relname"] for row in rows]
+
+
+def test_ensure_activity_partitions(
+    psycopg_connection: "Connection[DictRow]", create_activity: "Callable[..., Activity]"
+) -> None:
+    now = datetime(2023, 5, 17, 13, 45, tzinfo=UTC)
+    create_activity(id=uuid.uuid4(), datetime=datetime(2023, 6, 3, tzinfo=UTC))
+    create_activity(id=uuid.uuid4(), datetime=datetime(2019, 1, 1, tzinfo=UTC))
+
+    created = ensure_activity_partitions(psycopg_connection, now, 2)
+
+    assert created == ["activity_2023_05", "activity_2023_06", "activity_2023_07"]
+    assert _partitions(psycopg_connection) == [*created, DEFAULT_PARTITION]
+    # the June activity has moved to its partition, the one with no partition stays in the default one
+    assert psycopg_connection.execute("SELECT count(*) AS n FROM activity_2023_06").fetchone() == {"n": 1}
+    count_default = sql.SQL("SELECT count(*) AS n FROM {}").format(sql.Identifier(DEFAULT_PARTITION))
+    assert psycopg_connection.execute(count_default).fetchone() == {"n": 1}
+
+    # runs later on only add the months that are missing
+    assert ensure_activity_partitions(psycopg_connection, now, 2) == []
+    assert ensure_activity_partitions(psycopg_connection, datetime(2023, 8, 2, tzinfo=UTC), 2) == [
+        "activity_2023_08",
+        "activity_2023_09",
+        "activity_2023_10",
+    ]
@@ -0,0 +1,81 @@
+from unittest import mock
+from uuid import uuid4
+
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql
+
+from hubble.anonymisation import AnonymisationRule, Anonymiser, anonymised_values_sql, encode_value
+from hubble.db.models import Activity
+
+ACCOUNT_HOLDER_UUID = str(uuid4())
+
+
+def test_anonymiser_account_request() -> None:
+    email = "qatest+011@bink.com"
+    row = {
+        "summary": f"Enrolment Requested for {email}",
+        "associated_value": email,
+        "data": {
+            "fields": [
+                {"field_name": "first_name", "value": "Jane"},
+                {"field_name": "marketing_pref", "value": "True"},
+                {"field_name": "phone", "value": None},
+            ]
+        },
+    }
+
+    assert Anonymiser(ACCOUNT_HOLDER_UUID).anonymise("ACCOUNT_REQUEST", row) is True
+
+    hashed_email = encode_value(ACCOUNT_HOLDER_UUID, email)
+    assert row == {
+        "summary": f"Enrolment Requested for {hashed_email}",
+        "associated_value": hashed_email,
+        "data": {
+            "fields": [
+                {"field_name": "first_name", "value": encode_value(ACCOUNT_HOLDER_UUID, "Jane")},
+                {"field_name": "marketing_pref", "value": "True"},
+                {"field_name": "phone", "value": encode_value(ACCOUNT_HOLDER_UUID, None)},
+            ]
+        },
+    }
+
+
+def test_anonymiser_leaves_what_the_rules_do_not_cover() -> None:
+    anonymiser = Anonymiser(ACCOUNT_HOLDER_UUID)
+    row = {"summary": "Enrolment Requested", "associated_value": "", "data": {}}
+
+    assert anonymiser.anonymise("TX_HISTORY", row) is False
+    assert anonymiser.anonymise("EMAIL_EVENT", row) is True
+    assert row == {"summary": "Enrolment Requested", "associated_value": "", "data": {}}
+    assert anonymiser.anonymise("ACCOUNT_REQUEST", row) is True
+    assert row["summary"] == "Enrolment Requested"
+
+
+def test_anonymiser_hashes_each_value_once() -> None:
+    anonymiser = Anonymiser(ACCOUNT_HOLDER_UUID)
+    rows = [{"data": {"email": "qatest@bink.com"}} for _ in range(3)]
+
+    with mock.patch("hubble.anonymisation.encode_value", wraps=encode_value) as mock_encode_value:
+        for row in rows:
+            anonymiser.anonymise("EMAIL_EVENT", row)
+
+    mock_encode_value.assert_called_once_with(ACCOUNT_HOLDER_UUID, "qatest@bink.com")
+    assert {row["data"]["email"] for row in rows} == {encode_value(ACCOUNT_HOLDER_UUID, "qatest@bink.com")}
+
+
+def test_custom_rules() -> None:
+    rules = {"REWARD_STATUS": AnonymisationRule(columns=("user_id",), data_paths=(("new_values", "email"),))}
+    row = {"user_id": "user-1", "data": {"new_values": {"email": "qatest@bink.com", "status": "ISSUED"}}}
+
+    assert Anonymiser(ACCOUNT_HOLDER_UUID, rules).anonymise("REWARD_STATUS", row) is True
+    assert row == {
+        "user_id": encode_value(ACCOUNT_HOLDER_UUID, "user-1"),
+        "data": {"new_values": {"email": encode_value(ACCOUNT_HOLDER_UUID, "qatest@bink.com"), "status": "ISSUED"}},
+    }
+
+    values = anonymised_values_sql(rules)
+    assert set(values) == {"user_id", "data"}
+    compiled = str(update(Activity).values(values).compile(dialect=postgresql.dialect()))
+    assert "WHEN (activity.type = %(type_1)s)" in compiled
+    assert "jsonb_set(activity.data" in compiled
+    assert "summary" not in compiled
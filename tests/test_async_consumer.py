@@ -0,0 +1,257 @@
+import asyncio
+import threading
+import uuid
+
+from datetime import UTC, datetime
+from typing import TYPE_CHECKING
+from unittest import mock
+
+import psycopg
+import pytest
+
+from cosmos_message_lib import ActivitySchema
+from kombu.serialization import dumps, loads
+from psycopg_pool import PoolTimeout
+from redis import RedisError
+
+from hubble.config import settings
+from hubble.messaging.async_consumer import AsyncActivityConsumer
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def _incoming_message(body: dict | list[dict]) -> mock.AsyncMock:
+    content_type, content_encoding, data = dumps(body, serializer="json")
+    return mock.AsyncMock(body=data, content_type=content_type, content_encoding=content_encoding)
+
+
+def _activity_payload() -> dict:
+    return ActivitySchema(
+        **{
+            "type": "TX_HISTORY",
+            "datetime": datetime.now(tz=UTC),
+            "underlying_datetime": datetime.now(tz=UTC),
+            "summary": "Headline!",
+            "reasons": ["a reason"],
+            "activity_identifier": "a_id",
+            "user_id": str(uuid.uuid4()),
+            "associated_value": "42",
+            "retailer": "asos",
+            "campaigns": ["ASOS_EXTRA"],
+            "data": {"some": "data"},
+        }
+    ).dict()
+
+
+def _async_consumer(mock_writer: mock.MagicMock, max_rows: int) -> AsyncActivityConsumer:
+    with (
+        mock.patch.object(settings, "CONSUMER_BATCHING", True),
+        mock.patch.object(settings, "CONSUMER_BATCH_MAX_ROWS", max_rows),
+        mock.patch.object(settings, "ACTIVITY_ROLLUPS_ENABLED", False),
+    ):
+        consumer = AsyncActivityConsumer(
+            mock.MagicMock(), mock.MagicMock(), queue_name="queue-name", routing_key="routing-key"
+        )
+
+    mock_pg_conn_pool = mock.MagicMock()
+    mock_pg_conn_pool.connection.return_value.__aenter__.return_value = mock.MagicMock()
+    if mock_writer.awrite.side_effect is None:
+        mock_writer.awrite.side_effect = lambda _, activities: {activity["id"] for activity in activities}
+    consumer._pg_conn_pool = mock_pg_conn_pool
+    consumer._activity_writer = mock_writer
+    return consumer
+
+
+def test_async_consumer_bad_data_rejected() -> None:
+    consumer = _async_consumer(mock.AsyncMock(), max_rows=1)
+    mock_message = _incoming_message({"some": "bad data"})
+
+    asyncio.run(consumer.on_message(mock_message))
+
+    mock_message.reject.assert_awaited_once()
+    assert not consumer._batch.messages
+
+
+def test_async_consumer_batch_persisted_and_acked() -> None:
+    mock_writer = mock.AsyncMock()
+    consumer = _async_consumer(mock_writer, max_rows=3)
+    mock_messages = [
+        _incoming_message(_activity_payload()),
+        _incoming_message([_activity_payload(), _activity_payload()]),
+    ]
+
+    async def _consume() -> None:
+        for mock_message in mock_messages:
+            await consumer.on_message(mock_message)
+        await consumer.shutdown()
+
+    asyncio.run(_consume())
+
+    mock_writer.awrite.assert_awaited_once()
+    assert len(mock_writer.awrite.call_args.args[1]) == 3
+    for mock_message in mock_messages:
+        mock_message.ack.assert_awaited_once()
+        mock_message.nack.assert_not_awaited()
+
+
+def test_async_consumer_db_problem_requeued() -> None:
+    mock_writer = mock.AsyncMock()
+    mock_writer.awrite.side_effect = psycopg.Error("Boom")
+    consumer = _async_consumer(mock_writer, max_rows=1)
+    mock_message = _incoming_message(_activity_payload())
+
+    async def _consume() -> None:
+        await consumer.on_message(mock_message)
+        await consumer.shutdown()
+
+    asyncio.run(_consume())
+
+    mock_message.nack.assert_awaited_once_with(requeue=True)
+    mock_message.ack.assert_not_awaited()
+
+
+@pytest.mark.parametrize(
+    ("error", "spooled"),
+    [
+        (psycopg.OperationalError("server closed the connection unexpectedly"), True),
+        (PoolTimeout("couldn't get a connection after 30.00 sec"), False),
+        (psycopg.errors.QueryCanceled("canceling statement due to statement timeout"), False),
+        (psycopg.errors.LockNotAvailable("canceling statement due to lock timeout"), False),
+    ],
+)
+def test_async_consumer_spools_only_when_postgres_is_unreachable(
+    tmp_path: "Path", error: Exception, spooled: bool
+) -> None:
+    mock_writer = mock.AsyncMock()
+    mock_writer.awrite.side_effect = error
+    with mock.patch.object(settings, "CONSUMER_SPOOL_DIR", str(tmp_path)):
+        consumer = _async_consumer(mock_writer, max_rows=1)
+    mock_message = _incoming_message(_activity_payload())
+
+    async def _consume() -> None:
+        await consumer.on_message(mock_message)
+        await consumer.shutdown()
+
+    asyncio.run(_consume())
+
+    assert consumer._spool
+    assert bool(consumer._spool.size) is spooled
+    if spooled:
+        mock_message.ack.assert_awaited_once()
+        mock_message.nack.assert_not_awaited()
+    else:
+        mock_message.nack.assert_awaited_once_with(requeue=True)
+        mock_message.ack.assert_not_awaited()
+
+
+def test_async_consumer_redis_problem_requeued_after_delay() -> None:
+    mock_writer = mock.AsyncMock()
+    with mock.patch.object(settings, "CONSUMER_ANONYMISE_FORGOTTEN", True):
+        consumer = _async_consumer(mock_writer, max_rows=1)
+    mock_message = _incoming_message(_activity_payload())
+
+    async def _consume() -> None:
+        await consumer.on_message(mock_message)
+        await consumer.shutdown()
+
+    with (
+        mock.patch("hubble.messaging.async_consumer.anonymise_forgotten", side_effect=RedisError("Connection refused")),
+        mock.patch("hubble.messaging.async_consumer.asyncio.sleep") as mock_sleep,
+    ):
+        asyncio.run(_consume())
+
+    mock_writer.awrite.assert_not_awaited()
+    mock_sleep.assert_awaited_once_with(settings.CONSUMER_FORGOTTEN_RETRY_DELAY_SECS)
+    mock_message.nack.assert_awaited_once_with(requeue=True)
+    mock_message.ack.assert_not_awaited()
+
+
+def test_async_consumer_unexpected_problem_requeued() -> None:
+    mock_writer = mock.AsyncMock()
+    mock_writer.awrite.side_effect = KeyError("id")
+    consumer = _async_consumer(mock_writer, max_rows=1)
+    mock_message = _incoming_message(_activity_payload())
+
+    async def _consume() -> None:
+        await consumer.on_message(mock_message)
+        await consumer.shutdown()
+
+    asyncio.run(_consume())
+
+    mock_message.nack.assert_awaited_once_with(requeue=True)
+    mock_message.ack.assert_not_awaited()
+
+
+def test_async_consumer_dead_letter_problem_requeued() -> None:
+    mock_writer = mock.AsyncMock()
+    mock_writer.awrite.side_effect = psycopg.errors.NotNullViolation("null value in column")
+    consumer = _async_consumer(mock_writer, max_rows=1)
+    # not running yet, so there is no dead letter exchange to publish to
+    mock_message = _incoming_message(_activity_payload())
+
+    async def _consume() -> None:
+        await consumer.on_message(mock_message)
+        await consumer.shutdown()
+
+    asyncio.run(_consume())
+
+    mock_message.nack.assert_awaited_once_with(requeue=True)
+    mock_message.ack.assert_not_awaited()
+
+
+def test_async_consumer_dead_letters_poison_rows() -> None:
+    async def _awrite(_: object, activities: list[dict]) -> set[uuid.UUID]:
+        if any(activity["summary"] == "poison" for activity in activities):
+            raise psycopg.errors.NotNullViolation("null value in column")
+        return {activity["id"] for activity in activities}
+
+    mock_writer = mock.AsyncMock()
+    mock_writer.awrite.side_effect = _awrite
+    consumer = _async_consumer(mock_writer, max_rows=3)
+    consumer._deadletter_exchange = mock_deadletter_exchange = mock.AsyncMock()
+    poison = _activity_payload() | {"summary": "poison"}
+    mock_messages = [
+        _incoming_message(_activity_payload()),
+        _incoming_message([poison, _activity_payload()]),
+    ]
+    mock_messages[1].routing_key = "activity.rk"
+
+    async def _consume() -> None:
+        for mock_message in mock_messages:
+            await consumer.on_message(mock_message)
+        await consumer.shutdown()
+
+    asyncio.run(_consume())
+
+    mock_deadletter_exchange.publish.assert_awaited_once()
+    dead_letter = mock_deadletter_exchange.publish.call_args.args[0]
+    assert loads(dead_letter.body, dead_letter.content_type, dead_letter.content_encoding)["id"] == poison["id"]
+    assert dead_letter.headers == {
+        "x-hubble-error": "NotNullViolation: null value in column",
+        "x-hubble-sqlstate": "23502",
+    }
+    assert mock_deadletter_exchange.publish.call_args.kwargs == {"routing_key": "activity.rk"}
+    assert len(consumer._recent_ids) == 2
+    for mock_message in mock_messages:
+        mock_message.ack.assert_awaited_once()
+        mock_message.nack.assert_not_awaited()
+
+
+def test_async_consumer_declares_topology_off_the_event_loop() -> None:
+    consumer = _async_consumer(mock.AsyncMock(), max_rows=1)
+    mock_rmq_conn = consumer._rmq_conn.clone.return_value.__enter__.return_value
+    event_loop_thread = []
+
+    def _declare(rmq_conn: object) -> str:
+        event_loop_thread.append(threading.current_thread() is threading.main_thread())
+        assert rmq_conn is mock_rmq_conn
+        return "queue-name-dlx"
+
+    with mock.patch.object(consumer._topology, "declare", side_effect=_declare):
+        assert asyncio.run(consumer.declare_topology()) == "queue-name-dlx"
+    assert event_loop_thread == [False]
+
+    # a failure to declare again on reconnection is logged rather than raised
+    with mock.patch.object(consumer._topology, "declare", side_effect=OSError("connection refused")):
+        asyncio.run(consumer.redeclare_topology(mock.MagicMock()))
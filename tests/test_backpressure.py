@@ -0,0 +1,42 @@
+import pytest
+
+from hubble.messaging.backpressure import AdaptiveBatchController
+
+
+def _controller() -> AdaptiveBatchController:
+    return AdaptiveBatchController(min_rows=10, max_rows=100, target_latency=0.5, increase_step=20, decrease_factor=0.5)
+
+
+def test_adaptive_batch_controller_backs_off() -> None:
+    controller = _controller()
+
+    assert controller.record_success(100, latency=0.8)
+    assert controller.batch_rows == 50
+    assert controller.record_failure()
+    assert controller.batch_rows == 25
+    assert controller.record_failure()
+    assert controller.record_failure()
+    assert controller.batch_rows == 10
+    assert not controller.record_failure()
+
+
+def test_adaptive_batch_controller_recovers() -> None:
+    controller = _controller()
+    controller.record_failure()
+
+    # partial batches do not grow the limit
+    assert not controller.record_success(20, latency=0.1)
+    assert controller.record_success(50, latency=0.1)
+    assert controller.batch_rows == 70
+    assert controller.record_success(70, latency=0.1)
+    assert controller.record_success(90, latency=0.1)
+    assert controller.batch_rows == 100
+    assert not controller.record_success(100, latency=0.1)
+
+
+@pytest.mark.parametrize(("min_rows", "max_rows", "decrease_factor"), [(0, 10, 0.5), (20, 10, 0.5), (1, 10, 1)])
+def test_adaptive_batch_controller_invalid_settings(min_rows: int, max_rows: int, decrease_factor: float) -> None:
+    with pytest.raises(ValueError):
+        AdaptiveBatchController(
+            min_rows=min_rows, max_rows=max_rows, target_latency=1, increase_step=1, decrease_factor=decrease_factor
+        )
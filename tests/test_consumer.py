@@ -10,13 +10,17 @@ import pytest
 
 from cosmos_message_lib import ActivitySchema, get_connection_and_exchange, send_message
 from kombu import Connection, Exchange, Message
+from prometheus_client import REGISTRY
 from psycopg import sql
-from psycopg_pool import ConnectionPool
+from psycopg_pool import ConnectionPool, PoolTimeout
+from redis import RedisError
 
 from hubble.config import settings
 from hubble.messaging.consumer import ActivityConsumer
 
 if TYPE_CHECKING:
+    from pathlib import Path
+
     from psycopg import Cursor
     from psycopg.rows import DictRow
 
@@ -41,17 +45,18 @@ def pg_conn_pool() -> ConnectionPool:
 @pytest.fixture(name="consumer")
 def fixture_consumer(connection_and_exchange: tuple[Connection, Exchange], pg_conn_pool: ConnectionPool) -> Generator:
     rmq_conn, exchange = connection_and_exchange
-    activity_consumer = ActivityConsumer(
-        rmq_conn,
-        exchange,
-        queue_name=f"{settings.MESSAGE_QUEUE_NAME}-test",
-        routing_key=settings.MESSAGE_ROUTING_KEY,
-    )
+    with mock.patch.object(settings, "ACTIVITY_ROLLUPS_ENABLED", True):
+        activity_consumer = ActivityConsumer(
+            rmq_conn,
+            exchange,
+            queue_name=f"{settings.MESSAGE_QUEUE_NAME}-test",
+            routing_key=settings.MESSAGE_ROUTING_KEY,
+        )
     yield activity_consumer
     channel = rmq_conn.channel()
     activity_consumer.deadletter_queue(channel).delete()
     activity_consumer.deadletter_exchange(channel).delete()
-    activity_consumer.queue.delete()
+    activity_consumer.queue(channel).delete()
 
 
 def test_consumer_single(
@@ -143,6 +148,12 @@ def test_consumer_multiple_list(
     assert (res := db_dict_cursor.fetchone())
     assert res.get("count") == 10
 
+    db_dict_cursor.execute(sql.SQL("SELECT campaign, activities FROM activity_hourly_rollup ORDER BY campaign;"))
+    assert db_dict_cursor.fetchall() == [
+        {"campaign": "", "activities": 10},
+        {"campaign": "ASOS_EXTRA", "activities": 10},
+    ]
+
 
 def test_consumer_bad_data_rejected() -> None:
     mock_pg_conn_pool = mock.MagicMock()
@@ -158,12 +169,36 @@ def test_consumer_bad_data_rejected() -> None:
     mock_message.reject.assert_called_once()
 
 
+def test_consumer_declares_deadletter_exchange_before_consuming() -> None:
+    mock_rabbit_conn = mock.MagicMock()
+    channel = mock_rabbit_conn.channel.return_value.__enter__.return_value
+    consumer = ActivityConsumer(
+        mock_rabbit_conn,
+        Exchange("hubble-activities", type="topic"),
+        queue_name="queue-name",
+        routing_key="routing-key",
+    )
+    channel.exchange_declare.assert_not_called()
+
+    consumer.get_consumers(mock.MagicMock(), mock.MagicMock())
+
+    # everything the consumer dead-letters is published to an exchange declared by then
+    assert consumer.deadletter_exchange(channel).name == "queue-name-dlx"
+    assert {call.kwargs["exchange"] for call in channel.exchange_declare.call_args_list} == {
+        "queue-name-dlx",
+        "hubble-activities",
+    }
+    assert [call.kwargs["queue"] for call in channel.queue_declare.call_args_list] == ["queue-name-dlq", "queue-name"]
+    assert consumer.queue.no_declare
+
+
 def test_consumer_db_problem_requeued() -> None:
     mock_pg_conn_pool = mock.MagicMock()
     mock_conn = mock.MagicMock()
     mock_pg_conn_pool.getconn.return_value = mock_conn
     mock_cursor = mock.MagicMock()
     mock_cursor.executemany.side_effect = psycopg.Error("Boom")
+    mock_cursor.copy.side_effect = psycopg.Error("Boom")
     mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
     mock_rabbit_conn = mock.MagicMock()
     mock_rabbit_exchange = mock.MagicMock()
@@ -194,3 +229,274 @@ def test_consumer_db_problem_requeued() -> None:
     ).dict()
     consumer.on_message(data, mock_message)
     mock_message.requeue.assert_called_once()
+
+
+def _activity_payload() -> dict:
+    return ActivitySchema(
+        **{
+            "type": "TX_HISTORY",
+            "datetime": datetime.now(tz=UTC),
+            "underlying_datetime": datetime.now(tz=UTC),
+            "summary": "Headline!",
+            "reasons": ["a reason"],
+            "activity_identifier": "a_id",
+            "user_id": str(uuid.uuid4()),
+            "associated_value": "42",
+            "retailer": "asos",
+            "campaigns": ["ASOS_EXTRA"],
+            "data": {"some": "data"},
+        }
+    ).dict()
+
+
+def _batching_consumer(mock_writer: mock.MagicMock, max_rows: int) -> ActivityConsumer:
+    with (
+        mock.patch.object(settings, "CONSUMER_BATCHING", True),
+        mock.patch.object(settings, "CONSUMER_BATCH_MAX_ROWS", max_rows),
+        mock.patch.object(settings, "CONSUMER_BATCH_MAX_WAIT_MS", 60_000),
+        mock.patch.object(settings, "ACTIVITY_ROLLUPS_ENABLED", False),
+    ):
+        consumer = ActivityConsumer(
+            mock.MagicMock(), mock.MagicMock(), queue_name="queue-name", routing_key="routing-key"
+        )
+
+    if mock_writer.write.side_effect is None:
+        mock_writer.write.side_effect = lambda _, activities: {activity["id"] for activity in activities}
+    consumer._pg_conn_pool = mock.MagicMock()
+    consumer._activity_writer = mock_writer
+    return consumer
+
+
+def test_consumer_batching_bulk_ack() -> None:
+    mock_writer = mock.MagicMock()
+    consumer = _batching_consumer(mock_writer, max_rows=3)
+    mock_messages = [mock.MagicMock(spec=Message) for _ in range(2)]
+
+    consumer.on_message(_activity_payload(), mock_messages[0])
+    mock_writer.write.assert_not_called()
+
+    consumer.on_message([_activity_payload(), _activity_payload()], mock_messages[1])
+    mock_writer.write.assert_called_once()
+    assert len(mock_writer.write.call_args.args[1]) == 3
+    mock_messages[0].ack.assert_not_called()
+    mock_messages[1].ack.assert_called_once_with(multiple=True)
+
+
+def test_consumer_batching_time_limit_flush() -> None:
+    mock_writer = mock.MagicMock()
+    consumer = _batching_consumer(mock_writer, max_rows=100)
+    mock_message = mock.MagicMock(spec=Message)
+
+    consumer.on_message(_activity_payload(), mock_message)
+    consumer.on_iteration()
+    mock_writer.write.assert_not_called()
+
+    consumer._batch_max_wait = 0
+    consumer.on_iteration()
+    mock_writer.write.assert_called_once()
+    mock_message.ack.assert_called_once_with(multiple=True)
+
+
+def test_consumer_batching_failed_flush_requeues_batch() -> None:
+    mock_writer = mock.MagicMock()
+    mock_writer.write.side_effect = psycopg.Error("Boom")
+    consumer = _batching_consumer(mock_writer, max_rows=2)
+    mock_bad_message = mock.MagicMock(spec=Message)
+    mock_messages = [mock.MagicMock(spec=Message) for _ in range(2)]
+
+    consumer.on_message(_activity_payload(), mock_messages[0])
+    consumer.on_message({"some": "bad data"}, mock_bad_message)
+    consumer.on_message(_activity_payload(), mock_messages[1])
+
+    mock_bad_message.reject.assert_called_once()
+    mock_bad_message.requeue.assert_not_called()
+    for mock_message in mock_messages:
+        mock_message.requeue.assert_called_once()
+        mock_message.ack.assert_not_called()
+
+
+def test_consumer_drops_recently_persisted_activities() -> None:
+    mock_writer = mock.MagicMock()
+    consumer = _batching_consumer(mock_writer, max_rows=1)
+    payload = _activity_payload()
+    mock_messages = [mock.MagicMock(spec=Message) for _ in range(2)]
+
+    with mock.patch("hubble.messaging.consumer.record_dropped_duplicates") as mock_record_dropped_duplicates:
+        consumer.on_message(payload, mock_messages[0])
+        consumer.on_message(payload, mock_messages[1])
+
+    mock_writer.write.assert_called_once()
+    for mock_message in mock_messages:
+        mock_message.ack.assert_called_once_with(multiple=True)
+    mock_record_dropped_duplicates.assert_called_with(cached=1, database=0)
+
+
+def test_consumer_dead_letters_poison_rows() -> None:
+    persisted: list[dict] = []
+
+    def _write(_: object, activities: list[dict]) -> set[uuid.UUID]:
+        if any(activity["summary"] == "poison" for activity in activities):
+            raise psycopg.errors.CharacterNotInRepertoire("invalid byte sequence")
+        persisted.extend(activities)
+        return {activity["id"] for activity in activities}
+
+    mock_writer = mock.MagicMock()
+    mock_writer.write.side_effect = _write
+    consumer = _batching_consumer(mock_writer, max_rows=5)
+    mock_messages = [mock.MagicMock(spec=Message, delivery_info={"routing_key": "activity.rk"}) for _ in range(2)]
+    poison = _activity_payload() | {"summary": "poison"}
+
+    with (
+        mock.patch("hubble.messaging.consumer.Producer") as mock_producer,
+        mock.patch.object(consumer, "deadletter_exchange") as mock_deadletter_exchange,
+    ):
+        consumer.on_message(_activity_payload(), mock_messages[0])
+        consumer.on_message([_activity_payload(), poison, _activity_payload(), _activity_payload()], mock_messages[1])
+
+    assert len(persisted) == 4
+    assert poison["id"] not in {activity["id"] for activity in persisted}
+    assert poison["id"] not in consumer._recent_ids
+    assert len(consumer._recent_ids) == 4
+    mock_producer.assert_called_once_with(mock_messages[1].channel)
+    mock_producer.return_value.publish.assert_called_once()
+    body = mock_producer.return_value.publish.call_args.args[0]
+    assert body["id"] == poison["id"]
+    assert body["data"] == poison["data"]
+    assert mock_producer.return_value.publish.call_args.kwargs == {
+        "exchange": mock_deadletter_exchange.return_value,
+        "routing_key": "activity.rk",
+        "serializer": "json",
+        "headers": {"x-hubble-error": "CharacterNotInRepertoire: invalid byte sequence", "x-hubble-sqlstate": "22021"},
+    }
+    mock_messages[1].ack.assert_called_once_with(multiple=True)
+    for mock_message in mock_messages:
+        mock_message.requeue.assert_not_called()
+
+
+def test_consumer_rolls_up_inserted_activities() -> None:
+    mock_writer = mock.MagicMock()
+    consumer = _batching_consumer(mock_writer, max_rows=2)
+    consumer._rollups = True
+    duplicate, new = _activity_payload(), _activity_payload()
+    mock_writer.write.side_effect = lambda *_: {new["id"]}
+
+    with mock.patch("hubble.messaging.consumer.ActivityRollup") as mock_rollup:
+        consumer.on_message([duplicate, new], mock.MagicMock(spec=Message))
+
+    activities, inserted, _ = mock_rollup.of_inserted.call_args.args
+    assert [activity["id"] for activity in activities] == [duplicate["id"], new["id"]]
+    assert inserted == {new["id"]}
+    mock_rollup.of_inserted.return_value.flush.assert_called_once()
+
+
+def test_consumer_metrics() -> None:
+    def _sample(name: str, **labels: str) -> float:
+        return REGISTRY.get_sample_value(name, {"app": settings.PROJECT_NAME} | labels) or 0.0
+
+    samples: dict[str, tuple[str, dict[str, str]]] = {
+        "consumed_messages": ("bpl_activity_messages_total", {"outcome": "consumed"}),
+        "rejected_messages": ("bpl_activity_messages_total", {"outcome": "rejected"}),
+        "consumed_rows": ("bpl_activity_rows_total", {"outcome": "consumed"}),
+        "asos_rows": ("bpl_activities_consumed_total", {"retailer": "asos", "activity_type": "TX_HISTORY"}),
+        "batches": ("bpl_activity_batch_rows_count", {}),
+        "validations": ("bpl_activity_validation_time_count", {}),
+        "commits": ("bpl_activity_commit_time_count", {}),
+    }
+    before = {key: _sample(name, **labels) for key, (name, labels) in samples.items()}
+    consumer = _batching_consumer(mock.MagicMock(), max_rows=3)
+
+    consumer.on_message({"some": "bad data"}, mock.MagicMock(spec=Message))
+    consumer.on_message(_activity_payload(), mock.MagicMock(spec=Message))
+    consumer.on_message([_activity_payload(), _activity_payload()], mock.MagicMock(spec=Message))
+
+    after = {key: _sample(name, **labels) for key, (name, labels) in samples.items()}
+    assert {key: after[key] - before[key] for key in samples} == {
+        "consumed_messages": 2,
+        "rejected_messages": 1,
+        "consumed_rows": 3,
+        "asos_rows": 3,
+        "batches": 1,
+        "validations": 3,
+        "commits": 1,
+    }
+
+
+def test_consumer_adaptive_batching_shrinks_prefetch() -> None:
+    mock_writer = mock.MagicMock()
+    mock_writer.write.side_effect = psycopg.OperationalError("server closed the connection unexpectedly")
+    with (
+        mock.patch.object(settings, "CONSUMER_ADAPTIVE_BATCHING", True),
+        mock.patch.object(settings, "CONSUMER_BATCH_MIN_ROWS", 1),
+    ):
+        consumer = _batching_consumer(mock_writer, max_rows=4)
+    mock_channel_consumer = mock.MagicMock()
+    consumer.on_consume_ready(mock.MagicMock(), mock.MagicMock(), [mock_channel_consumer])
+    mock_channel_consumer.qos.assert_called_once_with(prefetch_count=4)
+
+    consumer.on_message([_activity_payload() for _ in range(4)], mock.MagicMock(spec=Message))
+
+    assert consumer._batch_max_rows == 2
+    mock_channel_consumer.qos.assert_called_with(prefetch_count=2)
+
+
+def test_consumer_spools_when_postgres_is_unavailable(tmp_path: "Path") -> None:
+    mock_writer = mock.MagicMock()
+    mock_writer.write.side_effect = psycopg.OperationalError("Connection refused")
+    with mock.patch.object(settings, "CONSUMER_SPOOL_DIR", str(tmp_path)):
+        consumer = _batching_consumer(mock_writer, max_rows=2)
+    mock_messages = [mock.MagicMock(spec=Message) for _ in range(2)]
+
+    consumer.on_message(_activity_payload(), mock_messages[0])
+    consumer.on_message(_activity_payload(), mock_messages[1])
+
+    assert consumer._spool
+    assert consumer._spool.size
+    mock_messages[1].ack.assert_called_once_with(multiple=True)
+    for mock_message in mock_messages:
+        mock_message.requeue.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        PoolTimeout("couldn't get a connection after 30.00 sec"),
+        psycopg.errors.QueryCanceled("canceling statement due to statement timeout"),
+        psycopg.errors.LockNotAvailable("canceling statement due to lock timeout"),
+    ],
+)
+def test_consumer_requeues_rather_than_spools_on_live_connection(tmp_path: "Path", error: Exception) -> None:
+    mock_writer = mock.MagicMock()
+    mock_writer.write.side_effect = error
+    with mock.patch.object(settings, "CONSUMER_SPOOL_DIR", str(tmp_path)):
+        consumer = _batching_consumer(mock_writer, max_rows=1)
+    mock_message = mock.MagicMock(spec=Message)
+
+    consumer.on_message(_activity_payload(), mock_message)
+
+    assert consumer._spool
+    assert not consumer._spool.size
+    mock_message.requeue.assert_called_once()
+    mock_message.ack.assert_not_called()
+
+
+def test_consumer_redis_problem_requeued_after_delay(tmp_path: "Path") -> None:
+    mock_writer = mock.MagicMock()
+    with (
+        mock.patch.object(settings, "CONSUMER_SPOOL_DIR", str(tmp_path)),
+        mock.patch.object(settings, "CONSUMER_ANONYMISE_FORGOTTEN", True),
+    ):
+        consumer = _batching_consumer(mock_writer, max_rows=1)
+    mock_message = mock.MagicMock(spec=Message)
+
+    with (
+        mock.patch("hubble.messaging.consumer.anonymise_forgotten", side_effect=RedisError("Connection refused")),
+        mock.patch("hubble.messaging.consumer.time.sleep") as mock_sleep,
+    ):
+        consumer.on_message(_activity_payload(), mock_message)
+
+    mock_writer.write.assert_not_called()
+    mock_sleep.assert_called_once_with(settings.CONSUMER_FORGOTTEN_RETRY_DELAY_SECS)
+    mock_message.requeue.assert_called_once()
+    mock_message.ack.assert_not_called()
+    assert consumer._spool
+    assert not consumer._spool.size
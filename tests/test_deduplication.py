@@ -0,0 +1,40 @@
+from uuid import uuid4
+
+from hubble.messaging.deduplication import RecentActivityIds
+
+
+def test_recent_activity_ids_filter_new() -> None:
+    recent_ids = RecentActivityIds(max_size=10)
+    persisted, new = uuid4(), uuid4()
+    recent_ids.add([persisted])
+
+    activities: list[dict] = [{"id": persisted}, {"id": new}, {"id": str(new)}]
+
+    assert recent_ids.filter_new(activities) == [{"id": new}]
+    assert str(persisted) in recent_ids
+    assert persisted in recent_ids
+    assert new not in recent_ids
+
+
+def test_recent_activity_ids_bounded_lru() -> None:
+    recent_ids = RecentActivityIds(max_size=2)
+    first, second, third = uuid4(), uuid4(), uuid4()
+    recent_ids.add([first, second])
+
+    # seeing a redelivery of first makes it the most recently used id
+    recent_ids.filter_new([{"id": first}])
+    recent_ids.add([third])
+
+    assert len(recent_ids) == 2
+    assert first in recent_ids
+    assert second not in recent_ids
+    assert third in recent_ids
+
+
+def test_recent_activity_ids_disabled() -> None:
+    recent_ids = RecentActivityIds(max_size=0)
+    activity_id = uuid4()
+    recent_ids.add([activity_id])
+
+    assert not len(recent_ids)
+    assert recent_ids.filter_new([{"id": activity_id}]) == [{"id": activity_id}]
@@ -0,0 +1,62 @@
+import csv
+import io
+import json
+import uuid
+
+from datetime import UTC, datetime, timedelta
+from typing import TYPE_CHECKING
+
+import pytest
+
+from hubble.export import ExportFormat, _compile, export_activities
+from hubble.query import ActivityFilter, select_activities
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from psycopg import Connection
+    from psycopg.rows import DictRow
+
+    from hubble.db.models import Activity
+
+
+def test_compile_binds_filters_as_parameters() -> None:
+    filters = ActivityFilter(retailer="test-retailer", types=["A", "B"])
+    statement, params = _compile(select_activities(filters, newest_first=False))
+
+    assert sorted(params.values()) == ["A", "B", "test-retailer"]
+    assert "test-retailer" not in statement.as_string(None)
+
+
+def _parse(export_format: ExportFormat, exported: bytes) -> list[dict]:
+    if export_format == ExportFormat.CSV:
+        return list(csv.DictReader(io.StringIO(exported.decode())))
+
+    return [json.loads(line) for line in exported.decode().splitlines()]
+
+
+@pytest.mark.parametrize("export_format", ExportFormat)
+def test_export_activities(
+    export_format: ExportFormat,
+    psycopg_connection: "Connection[DictRow]",
+    create_activity: "Callable[..., Activity]",
+) -> None:
+    now = datetime.now(tz=UTC)
+    expected = [
+        create_activity(
+            id=uuid.uuid4(), type="TX_HISTORY", datetime=now - timedelta(hours=i), summary=f'line\none "{i}" \\'
+        ).id
+        for i in range(3)
+    ]
+    create_activity(id=uuid.uuid4(), type="OTHER")
+    create_activity(id=uuid.uuid4(), type="TX_HISTORY", retailer="other-retailer")
+    create_activity(id=uuid.uuid4(), type="TX_HISTORY", datetime=now - timedelta(days=2))
+
+    out = io.BytesIO()
+    filters = ActivityFilter(retailer="test-retailer", types=["TX_HISTORY"], datetime_from=now - timedelta(days=1))
+    assert export_activities(psycopg_connection, out, filters, export_format) == 3
+
+    rows = _parse(export_format, out.getvalue())
+    # oldest first
+    assert [uuid.UUID(row["id"]) for row in rows] == expected[::-1]
+    assert rows[0]["summary"] == 'line\none "2" \\'
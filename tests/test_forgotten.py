@@ -0,0 +1,96 @@
+from collections import defaultdict
+from typing import Any
+from uuid import uuid4
+
+from psycopg.types.json import Jsonb
+
+from hubble.anonymisation import encode_value
+from hubble.forgotten import anonymise_forgotten, forget_account_holders, forgotten_key
+
+
+class FakeRedis:
+    """The hash and pipeline commands hubble.forgotten uses"""
+
+    def __init__(self) -> None:
+        self.hashes: defaultdict[str, dict] = defaultdict(dict)
+        self.commands: list[tuple] = []
+        self._results: list[list] = []
+
+    def hset(self, key: str, mapping: dict) -> None:
+        self.hashes[key].update(mapping)
+
+    def pipeline(self, transaction: bool) -> "FakeRedis":  # noqa: ARG002
+        return self
+
+    def __enter__(self) -> "FakeRedis":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        pass
+
+    def hmget(self, key: str, fields: list[str]) -> None:
+        self.commands.append(("hmget", key, fields))
+        self._results.append([self.hashes[key].get(field) for field in fields])
+
+    def execute(self) -> list[list]:
+        results, self._results = self._results, []
+        return results
+
+
+def _activity(**values: Any) -> dict:  # noqa: ANN401
+    return {
+        "id": uuid4(),
+        "type": "ACCOUNT_REQUEST",
+        "retailer": "test-retailer",
+        "user_id": str(uuid4()),
+        "summary": "Enrolment Requested",
+        "associated_value": "N/A",
+        "data": Jsonb({}),
+    } | values
+
+
+def test_forget_account_holders() -> None:
+    redis: Any = FakeRedis()
+    account_holder_uuid = str(uuid4())
+
+    forget_account_holders(redis, "test-retailer", [(account_holder_uuid, "Holder@Example.com")])
+
+    fields = redis.hashes[forgotten_key("test-retailer")]
+    assert fields[f"uuid:{account_holder_uuid}"] == account_holder_uuid
+    assert list(fields.values()) == [account_holder_uuid] * 2
+    assert "Holder@Example.com" not in str(fields)
+
+
+def test_anonymise_forgotten() -> None:
+    redis: Any = FakeRedis()
+    account_holder_uuid, email = str(uuid4()), "holder@example.com"
+    forget_account_holders(redis, "test-retailer", [(account_holder_uuid, email)])
+
+    by_email = _activity(summary=f"Enrolment Requested for {email}", associated_value=email.upper())
+    by_uuid = _activity(
+        type="EMAIL_EVENT", user_id=account_holder_uuid, associated_value="open", data=Jsonb({"email": email})
+    )
+    other_type = _activity(type="TX_HISTORY", user_id=account_holder_uuid, associated_value=email)
+    other_retailer = _activity(retailer="other-retailer", user_id=account_holder_uuid, associated_value=email)
+    not_forgotten = _activity(associated_value="other@example.com")
+
+    assert anonymise_forgotten(redis, [by_email, by_uuid, other_type, other_retailer, not_forgotten]) == 2
+
+    assert by_email["associated_value"] == encode_value(account_holder_uuid, email.upper())
+    assert by_email["summary"] == f"Enrolment Requested for {encode_value(account_holder_uuid, email)}"
+    assert by_uuid["data"].obj == {"email": encode_value(account_holder_uuid, email)}
+    assert isinstance(by_uuid["data"], Jsonb)
+    for activity in (other_type, other_retailer, not_forgotten):
+        assert activity["associated_value"] in (email, "other@example.com")
+    # one lookup per retailer, activity types that are never anonymised are not looked up
+    assert [(key, len(fields)) for _, key, fields in redis.commands] == [
+        (forgotten_key("test-retailer"), 6),
+        (forgotten_key("other-retailer"), 2),
+    ]
+
+
+def test_anonymise_forgotten_without_candidates() -> None:
+    redis: Any = FakeRedis()
+
+    assert anonymise_forgotten(redis, [_activity(type="TX_HISTORY")]) == 0
+    assert redis.commands == []
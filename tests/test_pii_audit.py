@@ -0,0 +1,144 @@
+import io
+import json
+
+from datetime import UTC, datetime, timedelta, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING
+from unittest import mock
+from uuid import uuid4
+
+from hubble.anonymisation import encode_value
+from hubble.forgotten import email_field, uuid_field
+from hubble.pii_audit import AuditCheckpoint, PIIAudit, PIIFinding, ScanRange, find_residue, plan_audit, split_ranges
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from psycopg import Connection
+    from psycopg.rows import DictRow
+
+    from hubble.db.models import Activity
+
+NOW = datetime(2026, 10, 18, tzinfo=UTC)
+ACCOUNT_HOLDER_UUID = str(uuid4())
+EMAIL = "qatest+011@bink.com"
+
+
+def _row(user_id: str = ACCOUNT_HOLDER_UUID, **values: object) -> tuple:
+    activity = {
+        "summary": "Enrolment Requested",
+        "associated_value": "N/A",
+        "fields": [{"field_name": "first_name", "value": "Jane"}],
+    } | values
+    return (uuid4(), NOW, "test-retailer", "ACCOUNT_REQUEST", user_id, *activity.values())
+
+
+def test_split_ranges() -> None:
+    assert split_ranges(NOW, NOW + timedelta(days=2, hours=12), timedelta(days=1)) == [
+        ScanRange(NOW, NOW + timedelta(days=1)),
+        ScanRange(NOW + timedelta(days=1), NOW + timedelta(days=2)),
+        ScanRange(NOW + timedelta(days=2), NOW + timedelta(days=2, hours=12)),
+    ]
+    assert split_ranges(NOW, NOW, timedelta(days=1)) == []
+
+
+def test_plan_audit_from_oldest_activity(
+    psycopg_connection: "Connection[DictRow]", create_activity: "Callable[..., Activity]"
+) -> None:
+    oldest = datetime.now(tz=UTC).replace(tzinfo=None, microsecond=0) - timedelta(days=2, hours=6)
+    create_activity(id=str(uuid4()), datetime=oldest)
+    create_activity(id=str(uuid4()))
+
+    # the oldest activity is stored as naive UTC, the default end is an aware now
+    ranges = plan_audit(psycopg_connection, timedelta(days=1)).ranges
+    assert len(ranges) == 3
+    assert ranges[0].start == oldest
+    assert all(scan.start.tzinfo is scan.end.tzinfo is None for scan in ranges)
+
+    end = (oldest + timedelta(days=1)).replace(tzinfo=UTC)
+    assert plan_audit(psycopg_connection, timedelta(days=1), end=end).ranges == [
+        ScanRange(oldest, oldest + timedelta(days=1))
+    ]
+
+
+def test_plan_audit_without_activities() -> None:
+    conn = mock.MagicMock()
+    conn.execute.return_value.fetchone.return_value = (None,)
+
+    assert plan_audit(conn, timedelta(days=1)).ranges == []
+
+
+def test_plan_audit_bounds_are_naive_utc() -> None:
+    conn = mock.MagicMock()
+    naive_now = NOW.replace(tzinfo=None)
+    conn.execute.return_value.fetchone.return_value = (naive_now,)
+    bst = timezone(timedelta(hours=1))
+
+    assert plan_audit(conn, timedelta(days=1), end=NOW.astimezone(bst) + timedelta(days=1)).ranges == [
+        ScanRange(naive_now, naive_now + timedelta(days=1))
+    ]
+
+
+def test_find_residue() -> None:
+    forgotten = {"test-retailer": {uuid_field(ACCOUNT_HOLDER_UUID): ACCOUNT_HOLDER_UUID}}
+    forgotten_with_email = {"test-retailer": forgotten["test-retailer"] | {email_field(EMAIL): ACCOUNT_HOLDER_UUID}}
+    hashed = _row(summary=f"Enrolment Requested for {encode_value(ACCOUNT_HOLDER_UUID, EMAIL)}")
+    by_uuid = _row(summary=f"Enrolment Requested for {EMAIL}", fields=[{"field_name": "email", "value": EMAIL}])
+    by_email = _row(user_id=str(uuid4()), associated_value=EMAIL.upper())
+
+    assert find_residue(hashed, forgotten_with_email) is None
+    assert find_residue(by_email, forgotten) is None
+    assert find_residue(by_uuid, {"other-retailer": forgotten["test-retailer"]}) is None
+
+    finding = find_residue(by_uuid, forgotten)
+    assert finding is not None
+    assert (finding.account_holder_uuid, finding.columns, finding.email) == (
+        ACCOUNT_HOLDER_UUID,
+        ["summary", "data.fields"],
+        None,
+    )
+
+    finding = find_residue(by_email, forgotten_with_email)
+    assert finding is not None
+    assert (finding.account_holder_uuid, finding.columns, finding.email) == (
+        ACCOUNT_HOLDER_UUID,
+        ["associated_value"],
+        EMAIL.upper(),
+    )
+    assert EMAIL.upper() not in finding.report_line()
+
+
+def test_audit_checkpoint_roundtrip(tmp_path: Path) -> None:
+    path = tmp_path / "audit.checkpoint"
+    checkpoint = AuditCheckpoint(ranges=split_ranges(NOW, NOW + timedelta(days=3), timedelta(days=1)))
+    checkpoint.done.add(checkpoint.ranges[1])
+    checkpoint.requeued.add(("test-retailer", ACCOUNT_HOLDER_UUID))
+
+    checkpoint.save(path)
+
+    loaded = AuditCheckpoint.load(path)
+    assert loaded == checkpoint
+    assert loaded.pending == [checkpoint.ranges[0], checkpoint.ranges[2]]
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_pii_audit_record(tmp_path: Path) -> None:
+    path = tmp_path / "audit.checkpoint"
+    scans = split_ranges(NOW, NOW + timedelta(days=2), timedelta(days=1))
+    checkpoint = AuditCheckpoint(ranges=scans)
+    report = io.StringIO()
+    requeue = mock.Mock()
+    audit = PIIAudit("", {}, checkpoint, path, report, requeue=requeue)
+
+    def finding(email: str | None) -> PIIFinding:
+        return PIIFinding(
+            str(uuid4()), NOW, "test-retailer", "ACCOUNT_REQUEST", ACCOUNT_HOLDER_UUID, ["summary"], email
+        )
+
+    audit.record(scans[0], [finding(None), finding(EMAIL), finding(EMAIL)])
+    audit.record(scans[1], [finding(EMAIL)])
+
+    # each account holder is requeued once, across ranges and resumed runs
+    requeue.assert_called_once_with([("test-retailer", ACCOUNT_HOLDER_UUID, EMAIL)])
+    assert [json.loads(line)["requeueable"] for line in report.getvalue().splitlines()] == [False, True, True, True]
+    assert AuditCheckpoint.load(path).pending == []
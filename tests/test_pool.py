@@ -0,0 +1,75 @@
+from unittest import mock
+
+import psycopg
+import pytest
+
+from prometheus_client import REGISTRY
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+from hubble.config import settings
+from hubble.messaging.pool import is_connection_failure, make_connection_pool, report_pool_stats
+
+
+def test_make_connection_pool() -> None:
+    with (
+        mock.patch.object(settings, "PG_POOL_MAX_SIZE", 4),
+        mock.patch.object(settings, "PG_POOL_CHECK_CONNECTIONS", True),
+        mock.patch("hubble.messaging.pool.ConnectionPool") as mock_pool_class,
+    ):
+        mock_pool_class.check_connection = ConnectionPool.check_connection
+        make_connection_pool()
+
+    mock_pool_class.assert_called_once_with(
+        settings.PSYCOPG_URI,
+        check=ConnectionPool.check_connection,
+        configure=None,
+        kwargs={"application_name": "hubble", "prepare_threshold": settings.PG_PREPARE_THRESHOLD},
+        min_size=settings.PG_POOL_MIN_SIZE,
+        max_size=4,
+        max_idle=settings.PG_POOL_MAX_IDLE_SECS,
+        max_lifetime=settings.PG_POOL_MAX_LIFETIME_SECS,
+        timeout=settings.PG_POOL_TIMEOUT_SECS,
+        name="activity-consumer",
+    )
+
+
+def test_report_pool_stats() -> None:
+    def _sample(name: str, **labels: str) -> float:
+        return REGISTRY.get_sample_value(name, {"app": settings.PROJECT_NAME} | labels) or 0.0
+
+    errors_before = _sample("bpl_pg_pool_errors_total", error="connections_lost")
+    mock_pool = mock.MagicMock()
+    mock_pool.pop_stats.return_value = {
+        "pool_min": 1,
+        "pool_max": 10,
+        "pool_size": 10,
+        "pool_available": 0,
+        "requests_waiting": 3,
+        "requests_num": 120,
+        "connections_lost": 2,
+    }
+
+    report_pool_stats(mock_pool)
+
+    assert _sample("bpl_pg_pool_connections", state="in_use") == 10
+    assert _sample("bpl_pg_pool_connections", state="idle") == 0
+    assert _sample("bpl_pg_pool_requests_waiting") == 3
+    assert _sample("bpl_pg_pool_errors_total", error="connections_lost") - errors_before == 2
+
+
+@pytest.mark.parametrize(
+    ("error", "expected"),
+    [
+        (psycopg.OperationalError("connection failed: Connection refused"), True),
+        (psycopg.OperationalError("server closed the connection unexpectedly"), True),
+        (psycopg.errors.ConnectionFailure("connection failure"), True),
+        (psycopg.errors.AdminShutdown("terminating connection due to administrator command"), True),
+        (PoolTimeout("couldn't get a connection after 30.00 sec"), False),
+        (psycopg.errors.QueryCanceled("canceling statement due to statement timeout"), False),
+        (psycopg.errors.LockNotAvailable("canceling statement due to lock timeout"), False),
+        (psycopg.errors.UniqueViolation("duplicate key value"), False),
+        (ValueError("not a postgres error"), False),
+    ],
+)
+def test_is_connection_failure(error: Exception, expected: bool) -> None:
+    assert is_connection_failure(error) is expected
@@ -0,0 +1,139 @@
+import base64
+import uuid
+
+from datetime import UTC, datetime, timedelta
+from typing import TYPE_CHECKING
+from unittest import mock
+
+import pytest
+
+from sqlalchemy import Column, MetaData, String, Table
+from sqlalchemy.dialects import postgresql
+
+from hubble.db.session import engine
+from hubble.query import (
+    MAX_PAGE_SIZE,
+    ActivityFilter,
+    InvalidCursorError,
+    build_activities_query,
+    decode_cursor,
+    encode_cursor,
+    query_activities,
+    select_account_holder_activities,
+    select_account_holders_activities,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from hubble.db.models import Activity
+
+
+def test_cursor_roundtrip() -> None:
+    activity = {"datetime": datetime(2023, 5, 17, 13, 45, 1, 123), "id": uuid.uuid4()}  # noqa: DTZ001
+    assert decode_cursor(encode_cursor(activity)) == (activity["datetime"], activity["id"])
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    ["not base64!", base64.urlsafe_b64encode(b"42").decode(), base64.urlsafe_b64encode(b'["a", "b"]').decode()],
+)
+def test_decode_cursor_rejects_invalid_cursors(cursor: str) -> None:
+    with pytest.raises(InvalidCursorError):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize("page_size", [0, MAX_PAGE_SIZE + 1])
+def test_query_activities_rejects_unbounded_page_sizes(page_size: int) -> None:
+    with pytest.raises(ValueError, match="page_size"):
+        query_activities(mock.MagicMock(), ActivityFilter(retailer="test-retailer"), page_size=page_size)
+
+
+def test_build_activities_query() -> None:
+    cursor = encode_cursor({"datetime": datetime(2023, 5, 17, tzinfo=UTC), "id": uuid.uuid4()})
+    query = build_activities_query(
+        ActivityFilter(retailer="test-retailer", types=["A", "B"], campaigns={"C"}), page_size=10, cursor=cursor
+    )
+
+    compiled = str(query.compile(dialect=postgresql.dialect()))
+    assert "activity.campaigns && " in compiled
+    assert "activity.datetime <= " in compiled
+    assert "ORDER BY activity.datetime DESC, activity.id DESC" in compiled
+    assert "OFFSET" not in compiled
+
+
+def test_query_activities_pages(create_activity: "Callable[..., Activity]") -> None:
+    now = datetime.now(tz=UTC).replace(tzinfo=None)
+    # every other activity shares its datetime with the previous one, so pages have to break ties on id
+    activities = [
+        create_activity(id=uuid.uuid4(), datetime=now - timedelta(minutes=i // 2), campaigns=[f"C{i % 3}"])
+        for i in range(7)
+    ]
+    create_activity(id=uuid.uuid4(), retailer="other-retailer")
+    filters = ActivityFilter(retailer="test-retailer", campaigns=["C0", "C1"])
+
+    pages = []
+    cursor = None
+    with engine.connect() as conn:
+        while True:
+            page = query_activities(conn, filters, page_size=2, cursor=cursor)
+            pages.append([activity["id"] for activity in page.activities])
+            if (cursor := page.next_cursor) is None:
+                break
+
+    expected = [
+        activity.id
+        for activity in sorted(activities, key=lambda activity: (activity.datetime, activity.id), reverse=True)
+        if activity.campaigns[0] != "C2"
+    ]
+    assert pages == [expected[:2], expected[2:4], expected[4:]]
+
+
+def test_select_account_holder_activities_is_a_union_of_index_lookups() -> None:
+    query = select_account_holder_activities("test-retailer", user_id="user", email="Holder@Example.com", types=["A"])
+
+    compiled = str(query.compile(dialect=postgresql.dialect()))
+    assert " UNION " in compiled
+    assert "lower(activity.associated_value) = lower(" in compiled
+    assert " OR " not in compiled
+    assert "ILIKE" not in compiled
+
+
+def test_select_account_holder_activities(create_activity: "Callable[..., Activity]") -> None:
+    user_id, email = str(uuid.uuid4()), "Holder_1@Example.com"
+    expected = {
+        create_activity(id=uuid.uuid4(), type="A", user_id=user_id).id,
+        create_activity(id=uuid.uuid4(), type="A", associated_value=email.lower()).id,
+        create_activity(id=uuid.uuid4(), type="B", user_id=user_id, associated_value=email).id,
+    }
+    create_activity(id=uuid.uuid4(), type="C", user_id=user_id)
+    create_activity(id=uuid.uuid4(), type="A", user_id=user_id, retailer="other-retailer")
+    # unlike with ILIKE, _ is not a wildcard
+    create_activity(id=uuid.uuid4(), type="A", associated_value="holderX1@example.com")
+
+    query = select_account_holder_activities("test-retailer", user_id=user_id, email=email, types=["A", "B"])
+    with engine.connect() as conn:
+        assert {activity_id for activity_id, _ in conn.execute(query)} == expected
+
+
+def test_select_account_holders_activities_joins_each_lookup() -> None:
+    account_holders = Table(
+        "account_holders",
+        MetaData(),
+        Column("account_holder_uuid", String),
+        Column("account_holder_email", String),
+    )
+    query = select_account_holders_activities("test-retailer", account_holders, types=["A"])
+
+    compiled = str(query.compile(dialect=postgresql.dialect()))
+    assert compiled.startswith("SELECT DISTINCT ON (anon_1.id, anon_1.datetime) ")
+    assert " UNION ALL " in compiled
+    assert "JOIN account_holders ON activity.user_id = account_holders.account_holder_uuid" in compiled
+    assert "lower(activity.associated_value) = lower(account_holders.account_holder_email)" in compiled
+    assert " OR " not in compiled
+    assert [column.name for column in query.selected_columns] == [
+        "id",
+        "datetime",
+        "account_holder_uuid",
+        "account_holder_email",
+    ]
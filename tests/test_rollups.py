@@ -0,0 +1,87 @@
+import uuid
+
+from datetime import UTC, datetime, timedelta, timezone
+from typing import TYPE_CHECKING
+
+from hubble.rollups import ActivityRollup, rebuild_rollups
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from psycopg import Connection
+    from psycopg.rows import DictRow
+
+    from hubble.db.models import Activity
+
+
+def _activity(**values: object) -> dict:
+    return {
+        "id": uuid.uuid4(),
+        "type": "TX_HISTORY",
+        "datetime": datetime(2023, 5, 17, 13, 45, tzinfo=UTC),
+        "retailer": "test-retailer",
+        "user_id": "user-1",
+        "campaigns": [],
+    } | values
+
+
+def test_activity_rollup_of_inserted() -> None:
+    bst = timezone(timedelta(hours=1))
+    activities = [
+        _activity(campaigns=["C1", "C2"]),
+        _activity(campaigns=["C1"], datetime=datetime(2023, 5, 17, 14, 15, tzinfo=bst)),
+        _activity(user_id="user-2", datetime=datetime(2023, 5, 17, 14, 5, tzinfo=UTC)),
+        _activity(type="OTHER"),
+    ]
+    skipped = _activity()
+
+    rollup = ActivityRollup.of_inserted([*activities, skipped], {activity["id"] for activity in activities}, UTC)
+
+    hour = datetime(2023, 5, 17, 13)  # noqa: DTZ001
+    assert rollup.counts == {
+        ("test-retailer", hour, "TX_HISTORY", ""): 2,
+        ("test-retailer", hour, "TX_HISTORY", "C1"): 2,
+        ("test-retailer", hour, "TX_HISTORY", "C2"): 1,
+        ("test-retailer", hour + timedelta(hours=1), "TX_HISTORY", ""): 1,
+        ("test-retailer", hour, "OTHER", ""): 1,
+    }
+    assert rollup.users == {("test-retailer", hour, "user-1"), ("test-retailer", hour + timedelta(hours=1), "user-2")}
+
+
+def _rollups(conn: "Connection[DictRow]") -> tuple[list[dict], list[dict]]:
+    return (
+        conn.execute("SELECT * FROM activity_hourly_rollup ORDER BY retailer, hour, type, campaign").fetchall(),
+        conn.execute("SELECT * FROM activity_hourly_user ORDER BY retailer, hour, user_id").fetchall(),
+    )
+
+
+def test_rebuild_rollups_matches_incremental_rollups(
+    psycopg_connection: "Connection[DictRow]", create_activity: "Callable[..., Activity]"
+) -> None:
+    now = datetime.now(tz=UTC)
+    activities = [
+        create_activity(
+            id=uuid.uuid4(),
+            datetime=now - timedelta(minutes=40 * i),
+            type=f"TYPE_{i % 2}",
+            user_id=f"user-{i % 3}",
+            campaigns=[f"C{i % 3}"] if i % 4 else [],
+        )
+        for i in range(12)
+    ]
+    rollup = ActivityRollup()
+    for activity in activities:
+        rollup.add(
+            {column: getattr(activity, column) for column in ("datetime", "type", "retailer", "user_id", "campaigns")},
+            UTC,
+        )
+    with psycopg_connection.transaction(), psycopg_connection.cursor() as cur:
+        rollup.flush(cur)
+    incremental = _rollups(psycopg_connection)
+
+    with psycopg_connection.transaction():
+        psycopg_connection.execute("UPDATE activity_hourly_rollup SET activities = activities + 1")
+        psycopg_connection.execute("DELETE FROM activity_hourly_user WHERE user_id = 'user-1'")
+
+    assert rebuild_rollups(psycopg_connection, now - timedelta(hours=10), now, step=timedelta(hours=3)) == 11
+    assert _rollups(psycopg_connection) == incremental
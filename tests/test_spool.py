@@ -0,0 +1,104 @@
+import uuid
+
+from datetime import UTC, datetime
+from pathlib import Path
+from unittest import mock
+
+import psycopg
+import pytest
+
+from hubble.messaging.activities import activities_from_body, activity_body
+from hubble.messaging.spool import ActivitySpool, SpoolFullError, SpoolReplayer
+
+
+def _activities(count: int) -> list[dict]:
+    return activities_from_body(
+        [
+            {
+                "type": "TX_HISTORY",
+                "datetime": datetime.now(tz=UTC),
+                "underlying_datetime": datetime.now(tz=UTC),
+                "summary": "Headline!",
+                "reasons": ["a reason"],
+                "activity_identifier": str(i),
+                "user_id": str(uuid.uuid4()),
+                "associated_value": "42",
+                "retailer": "asos",
+                "campaigns": ["ASOS_EXTRA"],
+                "data": {"some": "data", "nested": [i]},
+            }
+            for i in range(count)
+        ]
+    )
+
+
+def _spooled(spool: ActivitySpool) -> list[dict]:
+    spooled: list[dict] = []
+    while (segment := spool.take_segment()) is not None:
+        spooled.extend(map(activity_body, spool.read_segment(segment)))
+        spool.release_segment(segment)
+    return spooled
+
+
+def test_activity_spool_round_trip(tmp_path: Path) -> None:
+    spool = ActivitySpool(tmp_path, max_bytes=1024**2, segment_max_bytes=2048)
+    activities = _activities(10)
+
+    spool.append(activities[:5])
+    spool.append(activities[5:])
+
+    assert len(list(tmp_path.glob("segment-*.log"))) > 1
+    assert _spooled(spool) == [activity_body(activity) for activity in activities]
+    assert spool.size == 0
+    assert not list(tmp_path.glob("segment-*.log"))
+
+
+def test_activity_spool_survives_restart(tmp_path: Path) -> None:
+    spool = ActivitySpool(tmp_path, max_bytes=1024**2, segment_max_bytes=1024**2)
+    activities = _activities(3)
+    spool.append(activities)
+    with pytest.raises(RuntimeError):
+        ActivitySpool(tmp_path, max_bytes=1024**2, segment_max_bytes=1024**2)
+    spool.close()
+
+    # a torn write at the end of the segment is skipped
+    with next(tmp_path.glob("segment-*.log")).open("ab") as f:
+        f.write(b"\x00\x00\x01")
+
+    restarted = ActivitySpool(tmp_path, max_bytes=1024**2, segment_max_bytes=1024**2)
+    assert restarted.size == spool.size + 3
+    assert _spooled(restarted) == [activity_body(activity) for activity in activities]
+
+
+def test_activity_spool_size_limit(tmp_path: Path) -> None:
+    spool = ActivitySpool(tmp_path, max_bytes=1024, segment_max_bytes=1024)
+    spool.append(_activities(1))
+
+    with pytest.raises(SpoolFullError):
+        spool.append(_activities(5))
+
+
+def test_spool_replayer(tmp_path: Path) -> None:
+    spool = ActivitySpool(tmp_path, max_bytes=1024**2, segment_max_bytes=1024)
+    activities = _activities(5)
+    spool.append(activities)
+    mock_writer = mock.MagicMock()
+    mock_writer.write.side_effect = lambda _, activities: len(activities)
+    replayer = SpoolReplayer(spool, mock_writer, batch_rows=2, interval=1)
+
+    with (
+        mock.patch("hubble.messaging.spool.connect", side_effect=psycopg.OperationalError("Connection refused")),
+        pytest.raises(psycopg.OperationalError),
+    ):
+        replayer.replay()
+    assert spool.size
+
+    with mock.patch("hubble.messaging.spool.connect") as mock_connect:
+        replayer.replay()
+
+    mock_writer.prepare.assert_called_once_with(mock_connect.return_value.__enter__.return_value)
+
+    assert [len(call.args[1]) for call in mock_writer.write.call_args_list] == [2, 2, 1]
+    replayed = [activity for call in mock_writer.write.call_args_list for activity in call.args[1]]
+    assert [activity["id"] for activity in replayed] == [activity["id"] for activity in activities]
+    assert spool.size == 0
@@ -0,0 +1,56 @@
+import signal
+import time
+
+from hubble.messaging.supervisor import ConsumerSupervisor
+
+
+def _sleep(_: int) -> None:
+    time.sleep(60)
+
+
+def _crash(slot: int) -> None:
+    raise SystemExit(1 + slot)
+
+
+def test_supervisor_restarts_crashed_workers() -> None:
+    supervisor = ConsumerSupervisor(_crash, workers=2, restart_delay=0, shutdown_timeout=5)
+    for slot in range(2):
+        supervisor._start_worker(slot)
+
+    crashed = list(supervisor._processes.values())
+    for slot, process in enumerate(crashed):
+        process.join(5)
+        assert process.exitcode == 1 + slot
+
+    supervisor._supervise()
+
+    assert len(supervisor._processes) == 2
+    assert {process.pid for process in crashed}.isdisjoint(process.pid for process in supervisor._processes.values())
+
+    supervisor._stopping = True
+    supervisor._shutdown()
+    assert not supervisor._processes
+
+
+def test_supervisor_waits_restart_delay() -> None:
+    supervisor = ConsumerSupervisor(_crash, workers=1, restart_delay=60, shutdown_timeout=5)
+    supervisor._start_worker(0)
+    supervisor._processes[0].join(5)
+
+    supervisor._supervise()
+
+    assert not supervisor._processes
+
+
+def test_supervisor_shutdown_terminates_workers() -> None:
+    supervisor = ConsumerSupervisor(_sleep, workers=2, restart_delay=0, shutdown_timeout=5)
+    for slot in range(2):
+        supervisor._start_worker(slot)
+    processes = list(supervisor._processes.values())
+
+    supervisor._on_signal(signal.SIGTERM, None)
+    supervisor._shutdown()
+
+    assert not supervisor._processes
+    for process in processes:
+        assert process.exitcode == -signal.SIGTERM
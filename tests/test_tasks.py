@@ -1,21 +1,47 @@
+from copy import deepcopy
 from random import choice
-from typing import TYPE_CHECKING
-from uuid import uuid4
+from typing import TYPE_CHECKING, Any
+from unittest import mock
+from uuid import UUID, uuid4
 
+import pytest
+
+from retry_tasks_lib.db.models import RetryTask, TaskTypeKeyValue
 from retry_tasks_lib.enums import RetryTaskStatuses
+from sqlalchemy.exc import DBAPIError
 
-from hubble.db.models import Activity
-from hubble.tasks.right_to_be_forgotten import ACCOUNT_CREDENTIALS, anonymise_activities
+from hubble.anonymisation import ACCOUNT_CREDENTIALS, Anonymiser, encode_value
+from hubble.config import redis, settings
+from hubble.forgotten import forgotten_key
+from hubble.tasks.right_to_be_forgotten import (
+    CHECKPOINT_KEY,
+    CLAIM_KEY,
+    AnonymisationCheckpoint,
+    LockedActivitiesError,
+    _anonymise_account_holder_activities,
+    _BulkAnonymisation,
+    _claim_tasks,
+    anonymise_activities,
+    requeue_stale_claimed_tasks,
+)
 
 if TYPE_CHECKING:
     from collections.abc import Callable
 
-    from retry_tasks_lib.db.models import RetryTask
+    from psycopg import Connection
+    from psycopg.rows import DictRow
+    from retry_tasks_lib.db.models import TaskType
     from sqlalchemy.orm import Session
 
+    from hubble.db.models import Activity
+
 
+@pytest.mark.parametrize("engine", ["orm", "sql"])
 def test_anonymise_activities(
-    db_session: "Session", create_activity: "Callable[..., Activity]", anonymise_activities_task: "RetryTask"
+    engine: str,
+    db_session: "Session",
+    create_activity: "Callable[..., Activity]",
+    anonymise_activities_task: "RetryTask",
 ) -> None:
     task_params = anonymise_activities_task.get_params()
 
@@ -72,11 +98,15 @@ def test_anonymise_activities(
         )
     )
 
-    anonymise_activities(anonymise_activities_task.retry_task_id)
+    with mock.patch.object(settings, "ANONYMISE_ACTIVITIES_ENGINE", engine):
+        anonymise_activities(anonymise_activities_task.retry_task_id)
 
     db_session.refresh(anonymise_activities_task)
     assert anonymise_activities_task.status == RetryTaskStatuses.SUCCESS
     assert "account_holder_email" not in anonymise_activities_task.get_params()
+    assert redis.hget(forgotten_key(task_params["retailer_slug"]), f"uuid:{task_params['account_holder_uuid']}") == (
+        task_params["account_holder_uuid"]
+    )
 
     def compare_activities(activity_list: list["Activity"], expect_anon: bool) -> None:
         def get_sorting_key(item: dict) -> str:
@@ -119,3 +149,370 @@ def test_anonymise_activities(
 
     compare_activities(non_releavant_activities, expect_anon=False)
     compare_activities(releavant_activities, expect_anon=True)
+
+
+def test_sql_anonymisation_matches_python_hashing(
+    db_session: "Session", create_activity: "Callable[..., Activity]", anonymise_activities_task_type: "TaskType"
+) -> None:
+    account_holder_uuid, email = str(uuid4()), "qa.test+011@bink-test.co.uk"
+    account_request_data = [
+        {
+            "fields": [
+                {"field_name": "email", "value": email},
+                {"field_name": "first_name", "value": "Zoë"},
+                {"field_name": "last_name", "value": ""},
+                {"field_name": "date_of_birth", "value": None},
+                {"field_name": "marketing_pref", "value": "yes"},
+                {"field_name": "custom", "value": "ünïcödé ✓"},
+            ],
+            "datetime": "2023-05-17T13:45:01",
+        },
+        {"fields": []},
+    ]
+    payloads: list[dict[str, Any]] = [
+        {
+            "type": "ACCOUNT_REQUEST",
+            "summary": f"Enrolment Requested for {email}, again {email} and other.user@bink.com",
+            "associated_value": email.upper(),
+            "data": data,
+        }
+        for data in account_request_data
+    ]
+    payloads += [
+        {"type": "ACCOUNT_REQUEST", "summary": f"{email} ✓", "associated_value": "", "data": data}
+        for data in account_request_data
+    ]
+    payloads += [
+        {"type": "EMAIL_EVENT", "summary": "open Mailjet event received", "associated_value": "open", "data": data}
+        for data in ({"email": email, "event": "open", "MessageID": 1152921521743153642}, {"email": None}, {})
+    ]
+    activities = [
+        create_activity(id=uuid4(), user_id=account_holder_uuid, retailer="test-retailer", **payload)
+        for payload in payloads
+    ]
+    other = create_activity(id=uuid4(), type="ACCOUNT_REQUEST", retailer="other-retailer", associated_value=email)
+
+    expected = {}
+    anonymiser = Anonymiser(account_holder_uuid)
+    for activity, payload in zip(activities, payloads, strict=True):
+        anonymised = deepcopy(payload)
+        anonymiser.anonymise(anonymised["type"], anonymised)
+        expected[activity.id] = (anonymised["summary"], anonymised["associated_value"], anonymised["data"])
+
+    retry_task = _create_anonymise_activities_task(
+        db_session, anonymise_activities_task_type, "test-retailer", account_holder_uuid, email
+    )
+    with mock.patch.object(settings, "ANONYMISE_ACTIVITIES_CHUNK_ROWS", 2):
+        hashed = _anonymise_account_holder_activities(db_session, retry_task.retry_task_id, retry_task.get_params())
+
+    assert hashed == len(activities)
+    db_session.refresh(retry_task)
+    checkpoint = AnonymisationCheckpoint.loads(retry_task.get_params()[CHECKPOINT_KEY])
+    assert checkpoint.after == max((activity.datetime, activity.id) for activity in activities)
+    assert checkpoint.locked == set()
+    for activity in (*activities, other):
+        db_session.refresh(activity)
+    assert {activity.id: (activity.summary, activity.associated_value, activity.data) for activity in activities} == (
+        expected
+    )
+    assert other.associated_value == email
+
+
+def _create_anonymise_activities_task(
+    db_session: "Session", task_type: "TaskType", retailer_slug: str, account_holder_uuid: str, email: str
+) -> RetryTask:
+    retry_task = RetryTask(task_type_id=task_type.task_type_id)
+    db_session.add(retry_task)
+    db_session.flush()
+    key_ids = task_type.get_key_ids_by_name()
+    db_session.add_all(
+        TaskTypeKeyValue(task_type_key_id=key_ids[name], value=value, retry_task_id=retry_task.retry_task_id)
+        for name, value in (
+            ("retailer_slug", retailer_slug),
+            ("account_holder_uuid", account_holder_uuid),
+            ("account_holder_email", email),
+        )
+    )
+    db_session.commit()
+    return retry_task
+
+
+def test_anonymise_activities_in_bulk(
+    db_session: "Session",
+    create_activity: "Callable[..., Activity]",
+    anonymise_activities_task_type: "TaskType",
+) -> None:
+    holders = [(str(uuid4()), f"holder.{i}@user.email") for i in range(3)]
+    tasks = [
+        _create_anonymise_activities_task(db_session, anonymise_activities_task_type, "test-retailer", *holder)
+        for holder in holders
+    ]
+    other_retailer_task = _create_anonymise_activities_task(
+        db_session, anonymise_activities_task_type, "other-retailer", *holders[0]
+    )
+    payloads: list[dict[str, Any]] = []
+    for account_holder_uuid, email in holders:
+        payloads += [
+            {
+                "type": "ACCOUNT_REQUEST",
+                "user_id": account_holder_uuid,
+                "summary": f"Enrolment Requested for {email}",
+                "associated_value": email,
+                "data": {"fields": [{"field_name": "email", "value": email}]},
+            },
+            {
+                "type": "EMAIL_EVENT",
+                "user_id": "N/A",
+                "summary": "open Mailjet event received",
+                "associated_value": email.upper(),
+                "data": {"email": email},
+            },
+        ]
+    activities = [create_activity(id=uuid4(), retailer="test-retailer", **payload) for payload in payloads]
+    other = create_activity(
+        id=uuid4(),
+        type="ACCOUNT_REQUEST",
+        retailer="other-retailer",
+        user_id=holders[0][0],
+        associated_value=holders[0][1],
+    )
+
+    expected: dict[UUID, tuple] = {}
+    for i, (activity, payload) in enumerate(zip(activities, payloads, strict=True)):
+        # two activities per account holder, in the order of holders
+        anonymised = deepcopy(payload)
+        Anonymiser(holders[i // 2][0]).anonymise(anonymised["type"], anonymised)
+        expected[activity.id] = (anonymised["summary"], anonymised["associated_value"], anonymised["data"])
+
+    with (
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_BULK_MAX_TASKS", 10),
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_CHUNK_ROWS", 4),
+    ):
+        anonymise_activities(tasks[0].retry_task_id)
+        # the jobs of the claimed tasks have nothing left to do
+        anonymise_activities(tasks[1].retry_task_id)
+
+    for task in (*tasks, other_retailer_task):
+        db_session.refresh(task)
+    assert [task.status for task in tasks] == [RetryTaskStatuses.SUCCESS] * 3
+    assert all("account_holder_email" not in task.get_params() for task in tasks)
+    assert other_retailer_task.status == RetryTaskStatuses.PENDING
+
+    for activity in (*activities, other):
+        db_session.refresh(activity)
+    assert {activity.id: (activity.summary, activity.associated_value, activity.data) for activity in activities} == (
+        expected
+    )
+    assert other.associated_value == holders[0][1]
+
+
+def test_anonymise_activities_retries_locked_activities(
+    db_session: "Session",
+    psycopg_connection: "Connection[DictRow]",
+    create_activity: "Callable[..., Activity]",
+    anonymise_activities_task: "RetryTask",
+) -> None:
+    task_params = anonymise_activities_task.get_params()
+    account_holder_uuid, email = task_params["account_holder_uuid"], task_params["account_holder_email"]
+    activities = [
+        create_activity(
+            id=uuid4(),
+            type="EMAIL_EVENT",
+            retailer=task_params["retailer_slug"],
+            user_id=account_holder_uuid,
+            data={"email": email},
+        )
+        for _ in range(3)
+    ]
+    locked = activities[1]
+    psycopg_connection.execute("SELECT id FROM activity WHERE id = %s FOR UPDATE", (locked.id,))
+
+    with (
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_CHUNK_ROWS", 2),
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_LOCKED_RETRIES", 1),
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_LOCKED_RETRY_DELAY_SECS", 0),
+        pytest.raises(LockedActivitiesError),
+    ):
+        _anonymise_account_holder_activities(db_session, anonymise_activities_task.retry_task_id, task_params)
+
+    psycopg_connection.rollback()
+    hashed_email = encode_value(account_holder_uuid, email)
+    for activity in activities:
+        db_session.refresh(activity)
+    assert [activity.data["email"] for activity in activities] == [hashed_email, email, hashed_email]
+    db_session.refresh(anonymise_activities_task)
+    task_params = anonymise_activities_task.get_params()
+    assert AnonymisationCheckpoint.loads(task_params[CHECKPOINT_KEY]).locked == {(locked.datetime, locked.id)}
+
+    # the retry only hashes the activity that was locked
+    assert _anonymise_account_holder_activities(db_session, anonymise_activities_task.retry_task_id, task_params) == 1
+    for activity in activities:
+        db_session.refresh(activity)
+    assert [activity.data["email"] for activity in activities] == [hashed_email] * 3
+
+
+def test_anonymise_activities_claimed_by_another_run(
+    db_session: "Session",
+    create_activity: "Callable[..., Activity]",
+    anonymise_activities_task: "RetryTask",
+) -> None:
+    task_params = anonymise_activities_task.get_params()
+    activity = create_activity(
+        id=uuid4(),
+        type="EMAIL_EVENT",
+        retailer=task_params["retailer_slug"],
+        user_id=task_params["account_holder_uuid"],
+        data={"email": task_params["account_holder_email"]},
+    )
+    other_run = anonymise_activities_task.retry_task_id + 1
+    assert _claim_tasks(db_session, other_run, [anonymise_activities_task.retry_task_id]) == {
+        anonymise_activities_task.retry_task_id
+    }
+    db_session.commit()
+
+    # left to the run holding the claim
+    anonymise_activities(anonymise_activities_task.retry_task_id)
+    db_session.refresh(anonymise_activities_task)
+    assert anonymise_activities_task.status == RetryTaskStatuses.PENDING
+    assert CLAIM_KEY in anonymise_activities_task.get_params()
+
+    # taken over once the claim is stale
+    with mock.patch.object(settings, "ANONYMISE_ACTIVITIES_CLAIM_STALE_SECS", 0):
+        anonymise_activities(anonymise_activities_task.retry_task_id)
+
+    db_session.refresh(anonymise_activities_task)
+    db_session.refresh(activity)
+    assert anonymise_activities_task.status == RetryTaskStatuses.SUCCESS
+    assert CLAIM_KEY not in anonymise_activities_task.get_params()
+    assert activity.data["email"] == encode_value(
+        task_params["account_holder_uuid"], task_params["account_holder_email"]
+    )
+
+
+def _create_email_events(create_activity: "Callable[..., Activity]", tasks: list[RetryTask]) -> dict[int, "Activity"]:
+    activities = {}
+    for task in tasks:
+        task_params = task.get_params()
+        activities[task.retry_task_id] = create_activity(
+            id=uuid4(),
+            type="EMAIL_EVENT",
+            retailer=task_params["retailer_slug"],
+            user_id=task_params["account_holder_uuid"],
+            data={"email": task_params["account_holder_email"]},
+        )
+    return activities
+
+
+def test_anonymise_activities_in_bulk_requeues_tasks_with_locked_activities(
+    db_session: "Session",
+    psycopg_connection: "Connection[DictRow]",
+    create_activity: "Callable[..., Activity]",
+    anonymise_activities_task_type: "TaskType",
+) -> None:
+    tasks = [
+        _create_anonymise_activities_task(
+            db_session, anonymise_activities_task_type, "test-retailer", str(uuid4()), f"holder.{i}@user.email"
+        )
+        for i in range(3)
+    ]
+    activities = _create_email_events(create_activity, tasks)
+    locked = activities[tasks[1].retry_task_id]
+    psycopg_connection.execute("SELECT id FROM activity WHERE id = %s FOR UPDATE", (locked.id,))
+
+    with (
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_BULK_MAX_TASKS", 10),
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_CHUNK_ROWS", 2),
+        mock.patch("hubble.tasks.right_to_be_forgotten.enqueue_retry_task") as mock_enqueue_retry_task,
+    ):
+        anonymise_activities(tasks[0].retry_task_id)
+
+    psycopg_connection.rollback()
+    for task in tasks:
+        db_session.refresh(task)
+    # the task with a locked activity is back with its own job, to retry it from its checkpoint
+    assert [task.status for task in tasks] == [
+        RetryTaskStatuses.SUCCESS,
+        RetryTaskStatuses.PENDING,
+        RetryTaskStatuses.SUCCESS,
+    ]
+    mock_enqueue_retry_task.assert_called_once()
+    assert mock_enqueue_retry_task.call_args.kwargs["retry_task"].retry_task_id == tasks[1].retry_task_id
+    task_params = tasks[1].get_params()
+    assert CLAIM_KEY not in task_params
+    assert AnonymisationCheckpoint.loads(task_params[CHECKPOINT_KEY]).locked == {(locked.datetime, locked.id)}
+
+    anonymise_activities(tasks[1].retry_task_id)
+    db_session.refresh(tasks[1])
+    assert tasks[1].status == RetryTaskStatuses.SUCCESS
+    for task in tasks:
+        db_session.refresh(activities[task.retry_task_id])
+    assert all(
+        activities[task.retry_task_id].data["email"]
+        == encode_value(task.get_params()["account_holder_uuid"], f"holder.{i}@user.email")
+        for i, task in enumerate(tasks)
+    )
+
+
+def test_anonymise_activities_in_bulk_requeues_claimed_tasks_on_failure(
+    db_session: "Session",
+    create_activity: "Callable[..., Activity]",
+    anonymise_activities_task_type: "TaskType",
+) -> None:
+    tasks = [
+        _create_anonymise_activities_task(
+            db_session, anonymise_activities_task_type, "test-retailer", str(uuid4()), f"holder.{i}@user.email"
+        )
+        for i in range(3)
+    ]
+    activities = _create_email_events(create_activity, tasks)
+    anonymise_chunk = _BulkAnonymisation._anonymise
+
+    def fail_second_chunk(bulk: _BulkAnonymisation, chunk: list) -> set:
+        if bulk.committed:
+            raise DBAPIError("UPDATE activity", {}, Exception("deadlock detected"))
+        return anonymise_chunk(bulk, chunk)
+
+    with (
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_BULK_MAX_TASKS", 10),
+        mock.patch.object(settings, "ANONYMISE_ACTIVITIES_CHUNK_ROWS", 2),
+        mock.patch.object(_BulkAnonymisation, "_anonymise", autospec=True, side_effect=fail_second_chunk),
+        mock.patch("hubble.tasks.right_to_be_forgotten.enqueue_retry_task") as mock_enqueue_retry_task,
+    ):
+        anonymise_activities(tasks[0].retry_task_id)
+
+    for task in tasks:
+        db_session.refresh(task)
+    # the task of the run carries on alone, the claimed ones are back with their own jobs
+    assert [task.status for task in tasks] == [RetryTaskStatuses.SUCCESS] + [RetryTaskStatuses.PENDING] * 2
+    assert not any(CLAIM_KEY in task.get_params() for task in tasks)
+    assert sorted(call.kwargs["retry_task"].retry_task_id for call in mock_enqueue_retry_task.call_args_list) == [
+        task.retry_task_id for task in tasks[1:]
+    ]
+    # resuming from the first chunk, the one committed
+    first_chunk = sorted((activity.datetime, activity.id) for activity in activities.values())[:2]
+    for task in tasks[1:]:
+        assert AnonymisationCheckpoint.loads(task.get_params()[CHECKPOINT_KEY]).after == first_chunk[-1]
+
+
+def test_requeue_stale_claimed_tasks(
+    db_session: "Session", anonymise_activities_task_type: "TaskType", anonymise_activities_task: "RetryTask"
+) -> None:
+    done = _create_anonymise_activities_task(
+        db_session, anonymise_activities_task_type, "test-retailer", str(uuid4()), "done@user.email"
+    )
+    claimed = [anonymise_activities_task.retry_task_id, done.retry_task_id]
+    assert _claim_tasks(db_session, -1, claimed) == set(claimed)
+    db_session.commit()
+    done.status = RetryTaskStatuses.SUCCESS
+    db_session.commit()
+
+    with mock.patch("hubble.tasks.right_to_be_forgotten.enqueue_retry_task") as mock_enqueue_retry_task:
+        # fresh claims are left alone
+        assert requeue_stale_claimed_tasks() == []
+        with mock.patch.object(settings, "ANONYMISE_ACTIVITIES_CLAIM_STALE_SECS", 0):
+            assert requeue_stale_claimed_tasks() == [anonymise_activities_task.retry_task_id]
+
+    mock_enqueue_retry_task.assert_called_once()
+    db_session.refresh(anonymise_activities_task)
+    assert anonymise_activities_task.status == RetryTaskStatuses.PENDING
+    assert CLAIM_KEY not in anonymise_activities_task.get_params()
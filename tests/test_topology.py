@@ -0,0 +1,116 @@
+from unittest import mock
+
+import pytest
+
+from amqp.exceptions import NotFound, PreconditionFailed
+from kombu import Exchange
+
+from hubble.config import settings
+from hubble.messaging.topology import ActivityTopology, claim_partition, drain_legacy_queue, partition_exchange
+
+
+def test_activity_topology() -> None:
+    exchange = Exchange("hubble-activities", type="topic")
+    topology = ActivityTopology(exchange, queue_name="hubble-activities", routing_key="activity.#")
+    mock_rmq_conn = mock.MagicMock()
+    channel = mock_rmq_conn.channel.return_value.__enter__.return_value
+
+    assert topology.declare(mock_rmq_conn) == "hubble-activities-dlx"
+
+    assert [call.kwargs["queue"] for call in channel.queue_declare.call_args_list] == [
+        "hubble-activities-dlq",
+        "hubble-activities",
+    ]
+    assert topology.queue.queue_arguments == {"x-dead-letter-exchange": "hubble-activities-dlx"}
+    assert [call.kwargs["exchange"] for call in channel.exchange_declare.call_args_list] == [
+        "hubble-activities-dlx",
+        "hubble-activities",
+    ]
+    assert [call.kwargs["routing_key"] for call in channel.queue_bind.call_args_list] == ["#", "activity.#"]
+
+
+def test_activity_topology_keeps_existing_queue_arguments() -> None:
+    exchange = Exchange("hubble-activities", type="topic")
+    topology = ActivityTopology(exchange, queue_name="hubble-activities", routing_key="activity.#")
+    mock_rmq_conn = mock.MagicMock()
+    channel = mock_rmq_conn.channel.return_value.__enter__.return_value
+    # declared by an earlier release with other dead letter arguments
+    channel.queue_declare.side_effect = [None, PreconditionFailed("inequivalent arg 'x-dead-letter-exchange'"), None]
+
+    assert topology.declare(mock_rmq_conn) == "hubble-activities-dlx"
+
+    assert channel.queue_declare.call_args.kwargs["passive"] is True
+    assert channel.queue_bind.call_args.kwargs["queue"] == "hubble-activities"
+    assert channel.queue_bind.call_args.kwargs["routing_key"] == "activity.#"
+
+
+def test_partition_exchange() -> None:
+    exchange = Exchange("hubble-activities", type="topic")
+
+    assert partition_exchange(exchange).type == "x-consistent-hash"
+    assert partition_exchange(exchange).arguments == {"hash-header": "retailer"}
+    # hashing the routing key would spread each retailer's activities over every partition
+    with mock.patch.object(settings, "CONSUMER_PARTITION_HASH_HEADER", None), pytest.raises(ValueError):
+        partition_exchange(exchange)
+
+
+def test_claim_partition() -> None:
+    mock_rmq_conn = mock.MagicMock()
+    mock_exchange = mock.MagicMock()
+    mock_exchange.name = "hubble-activities"
+    partitioned = mock.MagicMock()
+
+    with (
+        mock.patch.object(settings, "CONSUMER_PARTITIONS", 3),
+        mock.patch("hubble.messaging.topology.partition_exchange", return_value=partitioned),
+        mock.patch("hubble.messaging.topology.ActivityTopology") as mock_topology,
+        mock.patch("hubble.messaging.topology.drain_legacy_queue") as mock_drain_legacy_queue,
+    ):
+        exchange, queue_name, routing_key = claim_partition(mock_rmq_conn, mock_exchange, 1)
+
+    assert exchange is partitioned
+    assert queue_name == f"{settings.MESSAGE_QUEUE_NAME}-1"
+    assert routing_key == "1"
+    partitioned.bind_to.assert_called_once_with(mock_exchange, routing_key=settings.MESSAGE_ROUTING_KEY)
+    # unclaimed partitions are declared too so that the hash ring does not change as consumers come and go
+    assert [call.kwargs["queue_name"] for call in mock_topology.call_args_list] == [
+        f"{settings.MESSAGE_QUEUE_NAME}-{partition}" for partition in range(3)
+    ]
+    assert mock_topology.return_value.declare.call_count == 3
+    mock_drain_legacy_queue.assert_called_once_with(mock_rmq_conn, mock_exchange)
+
+
+def test_claim_partition_out_of_range() -> None:
+    with mock.patch.object(settings, "CONSUMER_PARTITIONS", 2), pytest.raises(ValueError):
+        claim_partition(mock.MagicMock(), mock.MagicMock(), 2)
+
+
+def test_drain_legacy_queue() -> None:
+    mock_exchange = mock.MagicMock()
+    messages = [
+        mock.MagicMock(delivery_info={"routing_key": f"activity.{i}"}, headers={"retailer": "r"}) for i in range(2)
+    ]
+
+    with (
+        mock.patch("hubble.messaging.topology.Queue") as mock_queue,
+        mock.patch("hubble.messaging.topology.Producer") as mock_producer,
+    ):
+        legacy = mock_queue.return_value.return_value
+        legacy.get.side_effect = [*messages, None]
+        assert drain_legacy_queue(mock.MagicMock(), mock_exchange) == 2
+
+    legacy.unbind_from.assert_called_once_with(mock_exchange, routing_key=settings.MESSAGE_ROUTING_KEY)
+    assert [call.kwargs["routing_key"] for call in mock_producer.return_value.publish.call_args_list] == [
+        "activity.0",
+        "activity.1",
+    ]
+    assert all(message.ack.call_count == 1 for message in messages)
+
+
+def test_drain_legacy_queue_not_declared() -> None:
+    with mock.patch("hubble.messaging.topology.Queue") as mock_queue:
+        legacy = mock_queue.return_value.return_value
+        legacy.queue_declare.side_effect = NotFound("no queue 'hubble-activities'")
+        assert drain_legacy_queue(mock.MagicMock(), mock.MagicMock()) == 0
+
+    legacy.unbind_from.assert_not_called()
@@ -0,0 +1,146 @@
+import uuid
+
+from datetime import UTC, datetime, timedelta
+from typing import TYPE_CHECKING
+from unittest import mock
+
+import psycopg
+import pytest
+
+from cosmos_message_lib import ActivitySchema
+from psycopg.rows import tuple_row
+
+from hubble.messaging.activities import activities_from_body
+from hubble.messaging.writers import ACTIVITY_WRITERS, CopyActivityWriter, get_activity_writer, write_isolating_failures
+
+if TYPE_CHECKING:
+    from psycopg import Connection
+    from psycopg.rows import DictRow
+
+
+@pytest.mark.parametrize("engine", ACTIVITY_WRITERS.keys())
+def test_activity_writer(engine: str, psycopg_connection: "Connection[DictRow]") -> None:
+    now = datetime.now(tz=UTC)
+    activities = activities_from_body(
+        [
+            ActivitySchema(
+                **{
+                    "type": "TX_HISTORY",
+                    "datetime": now,
+                    "underlying_datetime": now - timedelta(days=1),
+                    "summary": "Headline!",
+                    "reasons": ["a reason", "another reason"],
+                    "activity_identifier": str(uuid.uuid4()),
+                    "user_id": str(uuid.uuid4()),
+                    "associated_value": "42",
+                    "retailer": "asos",
+                    "campaigns": [] if i % 2 else ["ASOS_EXTRA"],
+                    "data": {"some": "data", "nested": {"list": [1, 2, i]}},
+                }
+            ).dict()
+            for i in range(5)
+        ]
+    )
+
+    writer = get_activity_writer(engine)
+    writer.prepare(psycopg_connection)
+    assert writer.name == engine
+    with psycopg_connection.cursor(row_factory=tuple_row) as cur:
+        assert writer.write(cur, activities) == {activity["id"] for activity in activities}
+    psycopg_connection.commit()
+
+    with psycopg_connection.cursor() as cur:
+        cur.execute("SELECT * FROM activity ORDER BY activity_identifier")
+        rows = cur.fetchall()
+
+    assert len(rows) == len(activities)
+    for row, activity in zip(rows, sorted(activities, key=lambda act: act["activity_identifier"]), strict=True):
+        assert row["id"] == uuid.UUID(str(activity["id"]))
+        assert row["datetime"].replace(tzinfo=UTC) == now  # Note that timestamps are a naive
+        assert row["underlying_datetime"].replace(tzinfo=UTC) == now - timedelta(days=1)
+        assert row["reasons"] == ["a reason", "another reason"]
+        assert row["campaigns"] == activity["campaigns"]
+        assert row["user_id"] == str(activity["user_id"])
+        assert row["data"] == activity["data"].obj
+
+
+@pytest.mark.parametrize("engine", ACTIVITY_WRITERS.keys())
+def test_activity_writer_skips_existing_ids(engine: str, psycopg_connection: "Connection[DictRow]") -> None:
+    payload = {
+        "type": "TX_HISTORY",
+        "datetime": datetime.now(tz=UTC),
+        "underlying_datetime": datetime.now(tz=UTC),
+        "summary": "Headline!",
+        "reasons": [],
+        "activity_identifier": "a_id",
+        "user_id": str(uuid.uuid4()),
+        "associated_value": "42",
+        "retailer": "asos",
+        "campaigns": [],
+        "data": {},
+    }
+    existing, new = activities_from_body([payload, payload | {"summary": "new"}])
+    writer = get_activity_writer(engine)
+    writer.prepare(psycopg_connection)
+
+    with psycopg_connection.cursor(row_factory=tuple_row) as cur:
+        assert writer.write(cur, [existing]) == {existing["id"]}
+        psycopg_connection.commit()
+        assert writer.write(cur, [existing | {"summary": "redelivered"}, new]) == {new["id"]}
+        psycopg_connection.commit()
+
+    with psycopg_connection.cursor() as cur:
+        cur.execute("SELECT id, summary FROM activity")
+        assert {row["id"]: row["summary"] for row in cur.fetchall()} == {
+            existing["id"]: "Headline!",
+            new["id"]: "new",
+        }
+
+
+@pytest.mark.parametrize("engine", ACTIVITY_WRITERS.keys())
+def test_activity_writer_isolates_failures(engine: str, psycopg_connection: "Connection[DictRow]") -> None:
+    payload = {
+        "type": "TX_HISTORY",
+        "datetime": datetime.now(tz=UTC),
+        "underlying_datetime": datetime.now(tz=UTC),
+        "summary": "Headline!",
+        "reasons": [],
+        "activity_identifier": "a_id",
+        "user_id": str(uuid.uuid4()),
+        "associated_value": "42",
+        "retailer": "asos",
+        "campaigns": [],
+        "data": {},
+    }
+    activities = activities_from_body(
+        [payload | {"activity_identifier": str(i)} for i in range(6)] + [payload | {"summary": "nul \x00 byte"}]
+    )
+    poison = activities[-1]
+    activities.insert(2, activities.pop())
+    writer = get_activity_writer(engine)
+    writer.prepare(psycopg_connection)
+
+    with psycopg_connection.transaction(), psycopg_connection.cursor(row_factory=tuple_row) as cur:
+        inserted, rejected = write_isolating_failures(psycopg_connection, cur, writer, activities)
+
+    assert inserted == {activity["id"] for activity in activities if activity is not poison}
+    assert [activity for activity, _ in rejected] == [poison]
+    assert isinstance(rejected[0].error, psycopg.DataError)
+    with psycopg_connection.cursor() as cur:
+        cur.execute("SELECT activity_identifier FROM activity ORDER BY activity_identifier")
+        assert [row["activity_identifier"] for row in cur.fetchall()] == [str(i) for i in range(6)]
+
+
+def test_copy_activity_writer_creates_staging_table_once() -> None:
+    writer = CopyActivityWriter()
+    mock_conn = mock.MagicMock()
+    mock_cur = mock.MagicMock()
+    mock_cur.fetchall.return_value = []
+
+    writer.prepare(mock_conn)
+    writer.write(mock_cur, [])
+    writer.write(mock_cur, [])
+
+    mock_conn.execute.assert_called_once_with(writer.create_staging_sql)
+    mock_conn.commit.assert_called_once()
+    assert mock_cur.execute.call_args_list == [mock.call(writer.move_staged_sql)] * 2